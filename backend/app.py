@@ -10,17 +10,28 @@ from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse, parse_qs, unquote
 import os
 import sys
-import threading
 import time
 import requests
 
 from supabase_client import supabase, SUPABASE_URL
-from auth import get_user_id_from_token
+from auth import get_user_id_from_token, require_admin
 from constants import (
     STATUS_QUEUED, STATUS_PROCESSING, STATUS_EXTRACTING,
-    STATUS_SUCCESS, STATUS_ERROR, ACTIVE_NFCE_STATUSES,
-    MARKET_ID_QUEUED, MARKET_ID_UNRESOLVED,
+    STATUS_SUCCESS, STATUS_ERROR, STATUS_DEAD, ACTIVE_NFCE_STATUSES,
+    MARKET_ID_QUEUED, MARKET_ID_UNRESOLVED, LANE_INTERACTIVE, LANE_BATCH, LANES,
 )
+from nfce_retry import (
+    classify_error, failure_update, park_update,
+    ERROR_EMPTY_EXTRACTION, ERROR_SLOT_TIMEOUT, ERROR_STALE_LOCK, ERROR_CIRCUIT_OPEN,
+    ERROR_TIMEOUT, ERROR_NETWORK, ERROR_SERVER,
+)
+import enrichment_trigger
+import nfce_breaker
+import nfce_hosts
+import nfce_concurrency
+import nfce_lease
+import nfce_metrics
+import nfce_spool
 
 
 def _utcnow() -> datetime:
@@ -191,57 +202,41 @@ from enrichment_service import (
 # ============================================================================
 # Database-based extraction lock (works across Gunicorn workers)
 # ============================================================================
-STALE_LOCK_TIMEOUT_SECONDS = 300  # 5 minutes - if lock is older than this, consider it stale
-
 def cleanup_stale_locks():
-    """Clean up any stale 'extracting' status from crashed workers"""
+    """Clean up 'extracting' rows whose heartbeat lease expired (crashed workers).
+    They count as a failed attempt and are rescheduled (or dead-lettered)."""
     try:
-        # Find records stuck in 'extracting' status for too long
-        # We mark them as errors so they can be retried
-        stale = supabase.table('processed_urls').select('id,processed_at').eq('status', 'extracting').execute()
-        
-        if stale.data:
-            now = datetime.now(timezone.utc)
-            
-            for record in stale.data:
-                if record.get('processed_at'):
-                    try:
-                        processed_at_str = record['processed_at']
-                        # Handle both timezone-aware and naive timestamps
-                        if processed_at_str.endswith('Z'):
-                            processed_at_str = processed_at_str[:-1] + '+00:00'
-                        elif '+' not in processed_at_str and '-' not in processed_at_str[-6:]:
-                            # Naive datetime - assume UTC
-                            processed_at_str = processed_at_str + '+00:00'
-                        
-                        processed_at = datetime.fromisoformat(processed_at_str)
-                        
-                        # Make sure processed_at is timezone-aware
-                        if processed_at.tzinfo is None:
-                            processed_at = processed_at.replace(tzinfo=timezone.utc)
-                        
-                        age_seconds = (now - processed_at).total_seconds()
-                        
-                        if age_seconds > STALE_LOCK_TIMEOUT_SECONDS:
-                            supabase.table('processed_urls').update({
-                                'status': 'error',
-                                'error_message': f'Stale lock cleaned up (stuck for {age_seconds:.0f}s)'
-                            }).eq('id', record['id']).execute()
-                            print(f"[LOCK] Cleaned stale lock for record #{record['id']} (age: {age_seconds:.0f}s)")
-                    except Exception as e:
-                        print(f"[LOCK] Error checking stale lock for record #{record.get('id')}: {e}")
+        stale = nfce_lease.filter_expired(
+            supabase.table('processed_urls').select('id,attempts').eq('status', 'extracting')
+        ).execute()
+
+        for record in stale.data or []:
+            try:
+                nfce_lease.filter_expired(supabase.table('processed_urls').update(failure_update(
+                    (record.get('attempts') or 0) + 1,
+                    ERROR_STALE_LOCK,
+                    'Stale lock cleaned up (lease expired)'
+                )).eq('id', record['id']).eq('status', 'extracting')).execute()
+                print(f"[LOCK] Cleaned stale lock for record #{record['id']} (lease expired)")
+            except Exception as e:
+                print(f"[LOCK] Error cleaning stale lock for record #{record.get('id')}: {e}")
     except Exception as e:
         print(f"[LOCK] Error in cleanup_stale_locks: {e}")
 
+# Extraction slots across the cluster. Default 1 keeps the original one-at-a-time
+# behaviour; until it is raised, nfce_concurrency's per-worker limit changes nothing.
+MAX_CONCURRENT_EXTRACTIONS = max(1, int(os.getenv('NFCE_MAX_CONCURRENT_EXTRACTIONS', '1')))
+
+
 def acquire_extraction_lock(record_id, max_wait_seconds=600):
     """
-    Try to acquire extraction lock using database.
+    Try to acquire one of MAX_CONCURRENT_EXTRACTIONS extraction slots using database.
     Returns True if lock acquired, False if timeout.
     Uses processed_urls table with status='extracting' as the lock.
     """
     start_time = time.time()
     check_interval = 2  # seconds
-    stale_check_interval = 30  # Check for stale locks every 30 seconds
+    stale_check_interval = nfce_lease.LEASE_SECONDS  # a dead holder is noticed within ~2 leases
     last_stale_check = 0
     
     while True:
@@ -254,8 +249,8 @@ def acquire_extraction_lock(record_id, max_wait_seconds=600):
         # Check if any other record is currently extracting
         extracting = supabase.table('processed_urls').select('id').eq('status', 'extracting').execute()
         
-        if not extracting.data:
-            # No one is extracting, try to claim the lock
+        if len(extracting.data or []) < MAX_CONCURRENT_EXTRACTIONS:
+            # A slot is free, try to claim it
             try:
                 supabase.table('processed_urls').update({
                     'status': 'extracting',
@@ -265,17 +260,20 @@ def acquire_extraction_lock(record_id, max_wait_seconds=600):
                 # Small delay to let any concurrent updates settle
                 time.sleep(0.2)
                 
-                # CRITICAL: Verify we're the ONLY one extracting (race condition check)
-                all_extracting = supabase.table('processed_urls').select('id').eq('status', 'extracting').execute()
+                # CRITICAL: Verify we hold one of the slots (race condition check).
+                # On oversubscription the earliest claims keep their slots: every
+                # contender reaches the same verdict and running extractions never yield.
+                all_extracting = supabase.table('processed_urls').select('id') \
+                    .eq('status', 'extracting').order('processed_at').execute()
+                holders = [row['id'] for row in all_extracting.data or []]
                 
-                if all_extracting.data and len(all_extracting.data) == 1 and all_extracting.data[0]['id'] == record_id:
-                    # We're the only one - lock acquired successfully
+                if record_id in holders[:MAX_CONCURRENT_EXTRACTIONS]:
                     print(f"[LOCK #{record_id}] Acquired! Will query fresh data including all previous extractions")
                     return True
-                elif all_extracting.data and len(all_extracting.data) > 1:
-                    # Race condition! Multiple workers got the lock simultaneously
+                elif record_id in holders:
+                    # Race condition! More workers than slots got the lock simultaneously
                     # Back off: revert to 'processing' and wait
-                    print(f"[LOCK #{record_id}] Race condition detected ({len(all_extracting.data)} extracting), backing off...")
+                    print(f"[LOCK #{record_id}] Race condition detected ({len(holders)} extracting), backing off...")
                     supabase.table('processed_urls').update({
                         'status': 'processing'
                     }).eq('id', record_id).execute()
@@ -296,10 +294,18 @@ def acquire_extraction_lock(record_id, max_wait_seconds=600):
         time.sleep(check_interval)
 
 def release_extraction_lock(record_id, final_status, **kwargs):
-    """Release lock by updating status to final state"""
+    """Release lock by updating status to final state. Only a row still claimed
+    ('processing'/'extracting') is written: one the orphan sweep already took
+    back belongs to the queue now."""
     try:
         update_data = {'status': final_status, **kwargs}
-        supabase.table('processed_urls').update(update_data).eq('id', record_id).execute()
+        released = supabase.table('processed_urls').update(update_data) \
+            .eq('id', record_id) \
+            .in_('status', ['processing', 'extracting']) \
+            .execute()
+        if not released.data:
+            print(f"[LOCK #{record_id}] No longer claimed by this job, {final_status} not recorded")
+            return
         print(f"[LOCK #{record_id}] Released with status: {final_status}")
         if final_status == 'success':
             print(f"[LOCK #{record_id}] Database fully updated - next worker can now start and see new data")
@@ -308,60 +314,131 @@ def release_extraction_lock(record_id, final_status, **kwargs):
 
 print(f"[OK] API URL: {SUPABASE_URL}")
 
-# NOTE: Orphan recovery runs per-worker via gunicorn_config.py post_fork hook.
+# NOTE: Orphan recovery is triggered per-worker via gunicorn_config.py post_fork hook,
+# but only the worker holding the sweep lease in system_locks actually sweeps.
 # For local dev (python app.py), recovery is triggered in __main__ below.
 import task_queue
 
 
 # ==================== UTILITY FUNCTIONS ====================
 
-def extract_cnpj_from_url(url: str) -> str:
-    """Extract the 14-digit CNPJ from an NFCe URL's access key (positions 7-20, 1-based)."""
+def _nfce_access_key(url: str) -> str:
+    """Return the raw access key from an NFCe URL's `p` parameter (unvalidated)."""
     parsed = urlparse(url)
     p_value = parse_qs(parsed.query).get('p', [''])[0]
-    p_decoded = unquote(p_value)
-    access_key = p_decoded.split('|')[0]
+    return unquote(p_value).split('|')[0]
+
+
+def extract_cnpj_from_url(url: str) -> str:
+    """Extract the 14-digit CNPJ from an NFCe URL's access key (positions 7-20, 1-based)."""
+    access_key = _nfce_access_key(url)
     if len(access_key) != 44 or not access_key.isdigit():
         raise ValueError(f"Invalid NFCe access key: {access_key}")
     return access_key[6:20]
 
 
+def nfce_receipt_key(url: str) -> str:
+    """Identity of the receipt behind a URL: the 44-digit access key when the URL
+    carries one (QR variants of the same receipt share it), else the URL itself."""
+    access_key = _nfce_access_key(url)
+    if len(access_key) == 44 and access_key.isdigit():
+        return f'key:{access_key}'
+    return f'url:{url}'
+
+
 def trigger_enrichment(worker_id="auto"):
-    """Trigger enrichment process in a background thread if not already running"""
-    from enrichment_worker import process_pending_purchases
-    thread = threading.Thread(
-        target=process_pending_purchases,
-        args=(worker_id,),
-        daemon=True
-    )
-    thread.start()
+    """Mark enrichment work as pending; one debounced runner thread per process
+    picks it up (enrichment_trigger.py)."""
+    enrichment_trigger.request(worker_id)
     return True
 
-def process_nfce_in_background(url, url_record_id):
-    """Background task to process NFCe extraction and save to database.
-    Called by the task_queue consumer thread (one at a time)."""
-    import task_queue
-    start_time = time.time()
+def fail_nfce_job(url_record_id, attempts, error_class, error_message):
+    """Record a failed attempt: reschedule with backoff, dead-letter, or mark as error."""
+    update = failure_update(attempts, error_class, error_message)
+    status = update.pop('status')
+    release_extraction_lock(url_record_id, status, **update)
+    nfce_metrics.incr('nfce_failed_attempts_total', outcome=status, error_class=error_class)
+    if update.get('next_attempt_at'):
+        print(f"[RETRY #{url_record_id}] Attempt {attempts} failed ({error_class}), "
+              f"next attempt at {update['next_attempt_at']}")
+
+
+def park_nfce_job(url_record_id, delay_seconds, error_class, error_message):
+    """Put a claimed job back in the queue for later without counting an attempt."""
+    update = park_update(delay_seconds, error_class, error_message)
+    release_extraction_lock(url_record_id, update.pop('status'), **update)
+    nfce_metrics.incr('nfce_parked_jobs_total', reason=error_class)
+    print(f"[PARK #{url_record_id}] {error_message}, next attempt at {update['next_attempt_at']}")
+
+
+# Failure classes that say something about the SEFAZ host's health
+BREAKER_ERROR_CLASSES = {ERROR_TIMEOUT, ERROR_NETWORK, ERROR_SERVER, ERROR_EMPTY_EXTRACTION}
+
+
+# ----------------------------------------------------------------------------
+# NFCe job stages. nfce_pipeline.py runs them on separate thread pools connected
+# by bounded queues; process_nfce_in_background runs them inline. Each stage
+# takes the job dict, records its outcome in the DB when the job ends there,
+# and returns True to hand the job to the next stage.
+# ----------------------------------------------------------------------------
+
+def new_nfce_job(url, url_record_id, lane=LANE_INTERACTIVE):
+    """Job state passed between the NFCe stages."""
+    return {
+        'url': url,
+        'record_id': url_record_id,
+        'lane': lane,
+        'attempts': 1,
+        'start_time': time.time(),
+        'timings': {},
+    }
+
+
+# Server-side functions from migration_nfce_rpc.sql. Until they are deployed the
+# stages fall back to the equivalent sequence of PostgREST calls.
+_nfce_rpc_available = True
+
+
+def _is_missing_rpc(err) -> bool:
+    text = str(err)
+    return 'PGRST202' in text or 'Could not find the function' in text
+
+
+def _call_nfce_rpc(name, params):
+    """Call an NFCe RPC. Returns its JSON result, or None if it isn't deployed."""
+    global _nfce_rpc_available
+    if not _nfce_rpc_available:
+        return None
+    try:
+        return supabase.rpc(name, params).execute().data
+    except Exception as e:
+        if not _is_missing_rpc(e):
+            raise
+        _nfce_rpc_available = False
+        print(f"[RPC] {name} not deployed — using multi-request fallback (run migration_nfce_rpc.sql)")
+        return None
+
+
+def _claim_and_resolve_fallback(job, resolved_url):
+    """Multi-request equivalent of the nfce_claim_and_resolve RPC."""
+    url, url_record_id = job['url'], job['record_id']
 
     # Atomic claim: only proceed if still 'queued' (prevents duplicate work across workers)
+    attempts = 0
     try:
         claim = supabase.table('processed_urls') \
-            .update({'status': 'processing'}) \
+            .update({'status': 'processing', 'next_attempt_at': None, 'processed_at': _utcnow().isoformat()}) \
             .eq('id', url_record_id) \
             .eq('status', 'queued') \
             .execute()
         if not claim.data:
-            print(f"[BACKGROUND #{url_record_id}] Already claimed by another worker, skipping")
-            return
+            return {'outcome': 'already_claimed'}
+        attempts = claim.data[0].get('attempts') or 0
     except Exception as claim_err:
         print(f"[BACKGROUND #{url_record_id}] Claim check failed: {claim_err}")
 
-    # --- Pre-extraction phase (resolve URL, duplicate check) ---
     # Wrapped in try/except so any failure marks the record as error instead of leaving it stuck.
     try:
-        print(f"\n[BACKGROUND #{url_record_id}] Resolving URL...")
-        resolved_url = resolve_nfce_url(url)
-
         if resolved_url != url:
             try:
                 supabase.table('processed_urls').update({
@@ -376,8 +453,7 @@ def process_nfce_in_background(url, url_record_id):
                         'market_id': MARKET_ID_UNRESOLVED,
                         'error_message': 'Duplicado (URL resolvida já existe no banco)'
                     }).eq('id', url_record_id).execute()
-                    print(f"[BACKGROUND #{url_record_id}] UNIQUE constraint on resolved URL — duplicate")
-                    return
+                    return {'outcome': 'duplicate', 'attempts': attempts}
                 raise
 
         # Backfill original_url for records inserted before the column existed
@@ -396,126 +472,304 @@ def process_nfce_in_background(url, url_record_id):
                 'market_id': MARKET_ID_UNRESOLVED,
                 'error_message': 'Duplicado (URL já em processamento ou processada)'
             }).eq('id', url_record_id).execute()
-            print(f"[BACKGROUND #{url_record_id}] Duplicate detected after resolve, skipping")
-            return
+            return {'outcome': 'duplicate', 'attempts': attempts}
+
+        # Refresh timestamp (status already 'processing' from atomic claim above)
+        supabase.table('processed_urls').update({
+            'processed_at': _utcnow().isoformat()
+        }).eq('id', url_record_id).execute()
 
     except Exception as pre_err:
         print(f"[FAIL] [BACKGROUND #{url_record_id}] Pre-extraction error: {pre_err}")
         import traceback
         traceback.print_exc()
-        try:
-            supabase.table('processed_urls').update({
-                'status': 'error',
-                'market_id': MARKET_ID_UNRESOLVED,
-                'error_message': f'Erro na preparação: {str(pre_err)[:200]}'
-            }).eq('id', url_record_id).execute()
-        except Exception:
-            pass
-        return
+        fail_nfce_job(url_record_id, attempts + 1, classify_error(pre_err),
+                      f'Erro na preparação: {str(pre_err)[:200]}')
+        return {'outcome': 'failed', 'attempts': attempts}
 
-    # Refresh timestamp (status already 'processing' from atomic claim above)
-    supabase.table('processed_urls').update({
-        'processed_at': _utcnow().isoformat()
-    }).eq('id', url_record_id).execute()
+    return {'outcome': 'claimed', 'attempts': attempts}
 
-    print(f"[BACKGROUND #{url_record_id}] Waiting for extraction slot (database lock)...")
 
-    if not acquire_extraction_lock(url_record_id, max_wait_seconds=1800):
-        supabase.table('processed_urls').update({
-            'status': 'error',
-            'market_id': 'UNRESOLVED',
-            'error_message': 'Timeout waiting for extraction slot'
-        }).eq('id', url_record_id).execute()
-        print(f"[FAIL] [BACKGROUND #{url_record_id}] Timeout waiting for lock")
-        return
+def nfce_stage_resolve(job):
+    """Resolve the QR URL, then claim the row and run the post-resolve duplicate
+    check in a single nfce_claim_and_resolve round trip."""
+    url, url_record_id = job['url'], job['record_id']
+
+    print(f"\n[BACKGROUND #{url_record_id}] Resolving URL...")
+    resolved_url = resolve_nfce_url(url)  # never raises; falls back to the original URL
+
+    try:
+        result = _call_nfce_rpc('nfce_claim_and_resolve', {
+            'p_record_id': url_record_id,
+            'p_original_url': url,
+            'p_resolved_url': resolved_url,
+        })
+    except Exception as e:
+        # The function runs in one transaction, so the row is still 'queued'
+        # and will be picked up again once its pickup lease expires
+        print(f"[FAIL] [BACKGROUND #{url_record_id}] Claim/resolve RPC failed: {e}")
+        return False
+    if result is None:
+        result = _claim_and_resolve_fallback(job, resolved_url)
+
+    outcome = result.get('outcome')
+    if outcome == 'already_claimed':
+        print(f"[BACKGROUND #{url_record_id}] Already claimed by another worker, skipping")
+        return False
+    if outcome == 'duplicate':
+        print(f"[BACKGROUND #{url_record_id}] Duplicate detected after resolve, skipping")
+        return False
+    if outcome != 'claimed':
+        return False
+
+    job['attempts'] = (result.get('attempts') or 0) + 1
+    job['resolved_url'] = resolved_url
+    return True
+
 
-    wait_time = time.time() - start_time
-    print(f"[BACKGROUND #{url_record_id}] Got extraction slot after {wait_time:.1f}s")
+def nfce_stage_fetch(job):
+    """Hold the extraction slot (browser) only while loading the NFCe page."""
+    url_record_id = job['record_id']
+    host = nfce_breaker.host_for(job['resolved_url'])
+    allowed, retry_after = nfce_breaker.allow(host, owner=url_record_id)
+    if not allowed:
+        park_nfce_job(url_record_id, retry_after, ERROR_CIRCUIT_OPEN,
+                      f'SEFAZ host {host} unavailable (circuit open)')
+        return False
+
+    try:
+        return _fetch_nfce_page(job, host)
+    finally:
+        # The parse stage gives the verdict on a page that loaded; on any other exit
+        # a half-open probe that reported nothing must not keep the host parked
+        if 'html' not in job:
+            nfce_breaker.release_probe(host, url_record_id)
+
+
+def _fetch_nfce_page(job, host):
+    """Slot wait and page load for nfce_stage_fetch; sets job['html'] on success."""
+    url_record_id = job['record_id']
+    print(f"[BACKGROUND #{url_record_id}] Waiting for extraction slot (database lock)...")
 
+    # Wait for the host before taking the slot: with one slot cluster-wide, a job
+    # holding it while a slow host cools down would stall every other host
+    wait_start = time.time()
+    requested_at = time.monotonic()
+    while True:
+        nfce_hosts.wait_ready(host)
+        if not acquire_extraction_lock(url_record_id, max_wait_seconds=1800):
+            fail_nfce_job(url_record_id, job['attempts'], ERROR_SLOT_TIMEOUT, 'Timeout waiting for extraction slot')
+            print(f"[FAIL] [BACKGROUND #{url_record_id}] Timeout waiting for lock")
+            return False
+        if nfce_hosts.try_start_load(host, requested_at):
+            break
+        # Another job took the host meanwhile; don't sit on the slot while it loads
+        _free_extraction_slot(url_record_id)
+    job['timings']['slot_wait'] = time.time() - wait_start
+    print(f"[BACKGROUND #{url_record_id}] Got extraction slot after {job['timings']['slot_wait']:.1f}s")
+
+    extraction_start = time.time()  # read by the except path, so set before anything can fail
     try:
         print(f"[BACKGROUND #{url_record_id}] Starting Playwright extraction...")
 
         sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-        from nfce_extractor import extract_full_nfce_data
+        from nfce_extractor import fetch_nfce_html
+
+        html = fetch_nfce_html(job['resolved_url'], headless=True)
+        job['timings']['extraction'] = time.time() - extraction_start
+        job['html'] = html
+        nfce_concurrency.record(job['timings']['extraction'])
+        print(f"[BACKGROUND #{url_record_id}] Playwright extraction completed in {job['timings']['extraction']:.1f}s")
+    except Exception as e:
+        error_class = classify_error(e)
+        nfce_concurrency.record(time.time() - extraction_start, error_class)
+        if error_class in BREAKER_ERROR_CLASSES:
+            nfce_breaker.record_failure(host)
+        fail_nfce_job(url_record_id, job['attempts'], error_class, str(e)[:200])
+        print(f"[FAIL] [BACKGROUND #{url_record_id}] Extraction error: {e}")
+        return False
+    finally:
+        nfce_hosts.end_load(host)
+
+    # Free the slot for the next receipt; parsing and saving don't need the browser
+    _free_extraction_slot(url_record_id)
+    return True
 
-        extraction_start = time.time()
-        result = extract_full_nfce_data(resolved_url, headless=True)
-        extraction_time = time.time() - extraction_start
-        print(f"[BACKGROUND #{url_record_id}] Playwright extraction completed in {extraction_time:.1f}s")
 
-        market_info = result.get('market_info', {})
-        products = result.get('products', [])
-        purchase_date_str = result.get('purchase_date')
+def _free_extraction_slot(url_record_id):
+    """Hand the extraction slot back while keeping the job claimed ('processing')."""
+    supabase.table('processed_urls').update({
+        'status': 'processing',
+        'processed_at': _utcnow().isoformat()
+    }).eq('id', url_record_id).eq('status', 'extracting').execute()
+
 
-        purchase_date = None
-        if purchase_date_str:
+def nfce_stage_parse(job):
+    """Parse the fetched HTML into market info, purchase date and products."""
+    from nfce_extractor import parse_nfce_html
+    url_record_id = job['record_id']
+    host = nfce_breaker.host_for(job['resolved_url'])
+
+    try:
+        result = parse_nfce_html(job.pop('html'))
+    except Exception as e:
+        nfce_breaker.record_failure(host)
+        fail_nfce_job(url_record_id, job['attempts'], ERROR_EMPTY_EXTRACTION, f'Parse error: {str(e)[:180]}')
+        return False
+
+    market_info = result.get('market_info', {})
+    products = result.get('products', [])
+    purchase_date_str = result.get('purchase_date')
+
+    purchase_date = None
+    if purchase_date_str:
+        try:
+            purchase_date = datetime.strptime(purchase_date_str, "%d/%m/%Y %H:%M:%S%z")
+            print(f"[BACKGROUND #{url_record_id}] Emission date: {purchase_date.isoformat()}")
+        except Exception:
             try:
-                purchase_date = datetime.strptime(purchase_date_str, "%d/%m/%Y %H:%M:%S%z")
-                print(f"[BACKGROUND #{url_record_id}] Emission date: {purchase_date.isoformat()}")
-            except Exception:
-                try:
-                    purchase_date = datetime.strptime(purchase_date_str, "%d/%m/%Y %H:%M:%S")
-                    print(f"[BACKGROUND #{url_record_id}] Emission date (no tz): {purchase_date.isoformat()}")
-                except Exception as date_err:
-                    print(f"[BACKGROUND #{url_record_id}] Could not parse emission date '{purchase_date_str}': {date_err}")
-
-        if not products or not market_info.get('name') or not market_info.get('address'):
-            release_extraction_lock(url_record_id, 'error',
-                market_id='UNRESOLVED',
-                error_message='No products or market info extracted'
-            )
-            print(f"[FAIL] [BACKGROUND #{url_record_id}] No products or market info extracted")
-            return
+                purchase_date = datetime.strptime(purchase_date_str, "%d/%m/%Y %H:%M:%S")
+                print(f"[BACKGROUND #{url_record_id}] Emission date (no tz): {purchase_date.isoformat()}")
+            except Exception as date_err:
+                print(f"[BACKGROUND #{url_record_id}] Could not parse emission date '{purchase_date_str}': {date_err}")
+
+    if not products or not market_info.get('name') or not market_info.get('address'):
+        nfce_breaker.record_failure(host)  # SEFAZ error pages load fine but carry no receipt
+        fail_nfce_job(url_record_id, job['attempts'], ERROR_EMPTY_EXTRACTION,
+                       'No products or market info extracted')
+        print(f"[FAIL] [BACKGROUND #{url_record_id}] No products or market info extracted")
+        return False
+
+    nfce_breaker.record_success(host)
+    print(f"[BACKGROUND #{url_record_id}] Extracted {len(products)} products from {market_info.get('name')}")
+    job.update(market_info=market_info, products=products, purchase_date=purchase_date)
+    return True
 
-        print(f"[BACKGROUND #{url_record_id}] Extracted {len(products)} products from {market_info.get('name')}")
 
-        cnpj = extract_cnpj_from_url(resolved_url)
-        print(f"[BACKGROUND #{url_record_id}] Checking/creating market (CNPJ: {cnpj})...")
-        market_result = supabase.table('markets').select('*').eq('market_id', cnpj).execute()
+def _get_or_create_market(cnpj, market_info):
+    """Fetch the market by CNPJ, creating it on first sight.
+    Two receipts from a new market can race here now that saving runs outside
+    the extraction slot, so a UNIQUE violation on insert falls back to a re-select."""
+    market_result = supabase.table('markets').select('*').eq('market_id', cnpj).execute()
+    if market_result.data:
+        return market_result.data[0], False
 
-        if market_result.data:
-            market = market_result.data[0]
-            print(f"[BACKGROUND #{url_record_id}] Found existing market: {market['market_id']}")
-        else:
-            market_data = {
-                'market_id': cnpj,
-                'name': market_info['name'].title(),
-                'address': market_info['address']
-            }
-            market_insert = supabase.table('markets').insert(market_data).execute()
-            market = market_insert.data[0]
-            print(f"[BACKGROUND #{url_record_id}] Created new market: {market['market_id']}")
-
-        print(f"[BACKGROUND #{url_record_id}] Saving {len(products)} products...")
-        save_result = save_products_to_supabase(market['market_id'], products, resolved_url, purchase_date=purchase_date)
-
-        release_extraction_lock(url_record_id, 'success',
-            market_id=market['market_id'],
-            market_name=market['name'],
-            products_count=len(products)
-        )
-
-        total_time = time.time() - start_time
-        print(f"[OK] [BACKGROUND #{url_record_id}] Complete in {total_time:.1f}s: {save_result['saved_to_purchases']} products saved")
-
-        # Only trigger enrichment when the queue is empty (last item in a batch).
-        # This bunches up all products for one enrichment run, maximizing local
-        # cache hits and minimizing Cosmos API calls.
-        if task_queue.is_empty():
-            print(f"[BACKGROUND #{url_record_id}] Queue empty, triggering enrichment...")
-            trigger_enrichment(f"auto-{url_record_id}")
-        else:
-            print(f"[BACKGROUND #{url_record_id}] {task_queue.queue_size()} items still queued, deferring enrichment")
+    market_data = {
+        'market_id': cnpj,
+        'name': market_info['name'].title(),
+        'address': market_info['address']
+    }
+    try:
+        market_insert = supabase.table('markets').insert(market_data).execute()
+        return market_insert.data[0], True
+    except Exception as e:
+        err_str = str(e).lower()
+        if 'unique' in err_str or 'duplicate' in err_str or '23505' in err_str:
+            market_result = supabase.table('markets').select('*').eq('market_id', cnpj).execute()
+            if market_result.data:
+                return market_result.data[0], False
+        raise
+
+
+def _persist_receipt_fallback(job, cnpj):
+    """Multi-request equivalent of the nfce_persist_receipt RPC."""
+    url_record_id = job['record_id']
+    products = job['products']
+
+    market, created = _get_or_create_market(cnpj, job['market_info'])
+    print(f"[BACKGROUND #{url_record_id}] {'Created new' if created else 'Found existing'} market: {market['market_id']}")
+
+    save_result = save_products_to_supabase(market['market_id'], products, job['resolved_url'],
+                                            purchase_date=job['purchase_date'])
+
+    release_extraction_lock(url_record_id, 'success',
+        market_id=market['market_id'],
+        market_name=market['name'],
+        products_count=len(products)
+    )
+    return {
+        'outcome': 'saved',
+        'market_id': market['market_id'],
+        'market_name': market['name'],
+        'products_count': save_result['saved_to_purchases'],
+    }
+
+
+def nfce_stage_persist(job):
+    """Upsert the market, insert purchases and mark the row as success, in one
+    nfce_persist_receipt transaction."""
+    url_record_id = job['record_id']
+    products = job['products']
+    purchase_date = job['purchase_date'] or _utcnow()
 
+    try:
+        cnpj = extract_cnpj_from_url(job['resolved_url'])
+        print(f"[BACKGROUND #{url_record_id}] Saving market {cnpj} and {len(products)} products...")
+        result = _call_nfce_rpc('nfce_persist_receipt', {
+            'p_record_id': url_record_id,
+            'p_market_id': cnpj,
+            'p_market_name': job['market_info']['name'].title(),
+            'p_market_address': job['market_info']['address'],
+            'p_nfce_url': job['resolved_url'],
+            'p_purchase_date': purchase_date.isoformat(),
+            'p_products': products,
+        })
+        if result is None:
+            result = _persist_receipt_fallback(job, cnpj)
     except Exception as e:
-        release_extraction_lock(url_record_id, 'error',
-            market_id='UNRESOLVED',
-            error_message=str(e)[:200]
-        )
-        total_time = time.time() - start_time
+        fail_nfce_job(url_record_id, job['attempts'], classify_error(e), str(e)[:200])
+        total_time = time.time() - job['start_time']
         print(f"[FAIL] [BACKGROUND #{url_record_id}] Error after {total_time:.1f}s: {e}")
         import traceback
         traceback.print_exc()
+        return False
+
+    if result.get('outcome') == 'lost_claim':
+        print(f"[BACKGROUND #{url_record_id}] Row was handed off to another worker, nothing saved")
+        return False
+
+    total_time = time.time() - job['start_time']
+    print(f"[OK] [BACKGROUND #{url_record_id}] Complete in {total_time:.1f}s: "
+          f"{result.get('products_count')} products saved to {result.get('market_id')}")
+    return True
+
+
+def nfce_stage_enrich_handoff(job):
+    """Only trigger enrichment when no other receipt is pending in this process.
+    This bunches up all products for one enrichment run, maximizing local
+    cache hits and minimizing Cosmos API calls."""
+    import task_queue
+    import nfce_pipeline
+    url_record_id = job['record_id']
+
+    if task_queue.is_empty() and nfce_pipeline.in_flight_count() <= 1:
+        print(f"[BACKGROUND #{url_record_id}] Queue empty, triggering enrichment...")
+        trigger_enrichment(f"auto-{url_record_id}")
+    else:
+        print(f"[BACKGROUND #{url_record_id}] {task_queue.queue_size()} items still queued, deferring enrichment")
+    return True
+
+
+NFCE_STAGES = [
+    ('resolve', nfce_stage_resolve),
+    ('fetch', nfce_stage_fetch),
+    ('parse', nfce_stage_parse),
+    ('persist', nfce_stage_persist),
+    ('enrich_handoff', nfce_stage_enrich_handoff),
+]
+
+
+def process_nfce_in_background(url, url_record_id):
+    """Run every NFCe stage inline in the calling thread.
+    The task queue uses nfce_pipeline instead; this is kept for scripts and debugging."""
+    job = new_nfce_job(url, url_record_id)
+    nfce_lease.hold(url_record_id)
+    try:
+        for _name, stage in NFCE_STAGES:
+            if not stage(job):
+                break
+    finally:
+        nfce_lease.release(url_record_id)
 
 
 def save_products_to_supabase(market_id, products, nfce_url, purchase_date=None):
@@ -654,13 +908,34 @@ def get_product_price_history():
         return jsonify({'error': f'Falha ao buscar histórico: {e}'}), 500
 
 
+def new_queued_nfce_row(raw_url, user_id, lane=LANE_INTERACTIVE):
+    """processed_urls row for a fresh submission. The caller pushes it onto this
+    process's queue, so other pollers only see it after the pickup lease."""
+    now = _utcnow()
+    next_attempt_at = task_queue.first_attempt_at(now).isoformat()
+    now = now.isoformat()
+    return {
+        'lane': lane,
+        'nfce_url': raw_url,
+        'original_url': raw_url,
+        'market_id': MARKET_ID_QUEUED,
+        'market_name': '',
+        'products_count': 0,
+        'status': STATUS_QUEUED,
+        'processed_at': now,
+        'next_attempt_at': next_attempt_at,
+        'scanned_by': user_id,
+    }
+
+
 @app.route('/api/nfce/extract', methods=['POST'])
 def extract_nfce():
     """
     Extract data from NFCe URL and save to database
-    Request body: { "url": "...", "save": true/false, "async": true/false }
+    Request body: { "url": "...", "save": true/false, "async": true/false, "lane": "interactive"|"batch" }
     """
     import task_queue
+    import nfce_singleflight
 
     data = request.get_json()
 
@@ -668,6 +943,44 @@ def extract_nfce():
         return jsonify({'error': 'URL da NFCe é obrigatória'}), 400
 
     raw_url = data['url'].strip()
+    # Bulk submitters can opt into the batch lane; anything else is interactive
+    lane = LANE_BATCH if data.get('lane') == LANE_BATCH else LANE_INTERACTIVE
+
+    # Singleflight: identical submissions in this process attach to the record
+    # the first one created instead of repeating the checks and the insert
+    receipt_key = nfce_receipt_key(raw_url)
+    is_leader, flight = nfce_singleflight.begin(receipt_key)
+    if not is_leader:
+        existing_id = nfce_singleflight.wait(flight)
+        if existing_id is not None:
+            return jsonify({
+                'message': 'NFCe já está na fila de processamento',
+                'status': 'queued',
+                'record_id': existing_id,
+                'attached': True,
+            }), 202
+        # Leader didn't create a record: go through the normal checks
+        is_leader, flight = nfce_singleflight.begin(receipt_key)
+
+    record_created = False
+
+    # Spool mode: acknowledge from the local spool; the checks and the insert
+    # happen in the spool flusher (nfce_spool.py)
+    if nfce_spool.enabled() and lane == LANE_INTERACTIVE:
+        try:
+            provisional_id, attached = nfce_spool.append(raw_url, g.user_id, receipt_key)
+            if is_leader:
+                nfce_singleflight.complete(receipt_key, flight, provisional_id)
+                record_created = True
+            return jsonify({
+                'message': 'NFCe adicionada à fila de processamento',
+                'status': 'queued',
+                'record_id': provisional_id,
+                'provisional': True,
+                'attached': attached,
+            }), 202
+        except Exception as e:
+            print(f"[SPOOL] Append failed, falling back to direct insert: {e}")
 
     try:
         # 3-step duplicate check: original_url → nfce_url → resolve then nfce_url
@@ -695,20 +1008,14 @@ def extract_nfce():
 
         # Insert with status='queued' and return immediately.
         # URL resolution and extraction happen in the background worker.
-        temp_url_data = {
-            'nfce_url': raw_url,
-            'original_url': raw_url,
-            'market_id': MARKET_ID_QUEUED,
-            'market_name': '',
-            'products_count': 0,
-            'status': STATUS_QUEUED,
-            'processed_at': _utcnow().isoformat(),
-            'scanned_by': g.user_id,
-        }
-        url_insert = supabase.table('processed_urls').insert(temp_url_data).execute()
+        url_insert = supabase.table('processed_urls').insert(new_queued_nfce_row(raw_url, g.user_id, lane)).execute()
         url_record_id = url_insert.data[0]['id']
 
-        task_queue.enqueue_nfce(raw_url, url_record_id)
+        if is_leader:
+            nfce_singleflight.complete(receipt_key, flight, url_record_id)
+            record_created = True
+
+        task_queue.enqueue_nfce(raw_url, url_record_id, lane)
 
         return jsonify({
             'message': 'NFCe adicionada à fila de processamento',
@@ -720,14 +1027,23 @@ def extract_nfce():
         import traceback
         traceback.print_exc()
         return jsonify({'error': f'Falha ao iniciar processamento: {str(e)}'}), 500
+    finally:
+        if is_leader and not record_created:
+            nfce_singleflight.abandon(receipt_key, flight)
 
 
 def _format_status_record(record):
-    """Format a processed_urls DB row into the API response shape."""
+    """Format a processed_urls DB row into the API response shape.
+    Dead-lettered rows are reported as 'error' so clients stop polling them.
+    Rows that came through the spool keep the provisional id the client was given."""
+    status = record['status']
     return {
-        'record_id': record['id'],
+        'record_id': record.get('submission_id') or record['id'],
+        'canonical_record_id': record['id'],
         'nfce_url': record.get('nfce_url', ''),
-        'status': record['status'],
+        'status': STATUS_ERROR if status == STATUS_DEAD else status,
+        'dead_letter': status == STATUS_DEAD,
+        'attempts': record.get('attempts', 0),
         'market_id': record.get('market_id'),
         'market_name': record.get('market_name', ''),
         'products_count': record.get('products_count', 0),
@@ -762,10 +1078,70 @@ def check_nfce_exists():
         return jsonify({'exists': False, 'error': str(e)}), 200
 
 
+def _spooled_status(spool_row):
+    """Status response for a submission still in (or rejected by) the local spool."""
+    rejected = spool_row['state'] == nfce_spool.STATE_REJECTED
+    return {
+        'record_id': spool_row['provisional_id'],
+        'nfce_url': spool_row['url'],
+        'status': STATUS_ERROR if rejected else STATUS_QUEUED,
+        'provisional': True,
+        'dead_letter': False,
+        'attempts': 0,
+        'market_id': MARKET_ID_QUEUED,
+        'market_name': '',
+        'products_count': 0,
+        'error_message': spool_row['detail'] if rejected else None,
+        'processed_at': datetime.fromtimestamp(spool_row['created_at'], timezone.utc).isoformat(),
+    }
+
+
+def _provisional_statuses(provisional_ids):
+    """
+    Status responses for provisional ids (nfce_spool), keyed by provisional id.
+    Flushed submissions report their processed_urls row.
+    """
+    statuses = {}
+    flushed = {}  # record_id -> provisional_id
+    unknown = []
+    for provisional_id in provisional_ids:
+        spool_row = nfce_spool.lookup(provisional_id) if nfce_spool.enabled() else None
+        if spool_row is None:
+            unknown.append(provisional_id)
+        elif spool_row['state'] == nfce_spool.STATE_DUPLICATE:
+            statuses[provisional_id] = {
+                **_spooled_status(spool_row),
+                'status': 'duplicate',
+                'market_name': spool_row['detail'] or '',
+                'error_message': 'Esta NFCe já foi processada',
+            }
+        elif spool_row['state'] == nfce_spool.STATE_FLUSHED:
+            flushed[spool_row['record_id']] = provisional_id
+        else:
+            statuses[provisional_id] = _spooled_status(spool_row)
+
+    if flushed:
+        result = supabase.table('processed_urls').select('*').in_('id', list(flushed)).execute()
+        for record in result.data or []:
+            statuses[flushed[record['id']]] = _format_status_record(record)
+    if unknown:
+        # Spooled on another instance: processed_urls.submission_id has the mapping once flushed
+        result = supabase.table('processed_urls').select('*').in_('submission_id', unknown).execute()
+        for record in result.data or []:
+            statuses[record['submission_id']] = _format_status_record(record)
+    return statuses
+
+
 @app.route('/api/nfce/status/<int:record_id>', methods=['GET'])
 def get_nfce_status(record_id):
-    """Get processing status by record ID"""
+    """Get processing status by record ID (or provisional id from the spool)"""
     try:
+        if nfce_spool.is_provisional(record_id):
+            status = _provisional_statuses([record_id]).get(record_id)
+            if status is None:
+                return jsonify({'error': 'Registro não encontrado'}), 404
+            return jsonify(status)
+
         result = supabase.table('processed_urls').select('*').eq('id', record_id).execute()
 
         if not result.data:
@@ -786,8 +1162,15 @@ def get_nfce_status_batch():
         return jsonify([])
 
     try:
-        result = supabase.table('processed_urls').select('*').in_('id', ids).execute()
-        return jsonify([_format_status_record(r) for r in result.data])
+        provisional_ids = [i for i in ids if nfce_spool.is_provisional(i)]
+        record_ids = [i for i in ids if not nfce_spool.is_provisional(i)]
+        statuses = []
+        if record_ids:
+            result = supabase.table('processed_urls').select('*').in_('id', record_ids).execute()
+            statuses = [_format_status_record(r) for r in result.data]
+        if provisional_ids:
+            statuses.extend(_provisional_statuses(provisional_ids).values())
+        return jsonify(statuses)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -804,7 +1187,115 @@ def get_processing_nfces():
             .gt('processed_at', ten_minutes_ago)\
             .execute()
 
-        return jsonify([_format_status_record(r) for r in result.data])
+        spooled = nfce_spool.pending_rows() if nfce_spool.enabled() else []
+        return jsonify([_format_status_record(r) for r in result.data] +
+                       [_spooled_status(r) for r in spooled])
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def _queue_db_stats():
+    """Cluster-wide view of processed_urls: depth by status and queue age."""
+    now = _utcnow()
+    depth = {}
+    for status in (STATUS_QUEUED, STATUS_PROCESSING, STATUS_EXTRACTING, STATUS_ERROR, STATUS_DEAD):
+        result = supabase.table('processed_urls').select('id', count='exact') \
+            .eq('status', status).limit(1).execute()
+        depth[status] = result.count or 0
+
+    def _age_seconds(value):
+        if not value:
+            return 0
+        then = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if then.tzinfo is None:
+            then = then.replace(tzinfo=timezone.utc)  # processed_at is a naive TIMESTAMP (UTC)
+        return max(0, int((now - then).total_seconds()))
+
+    oldest = supabase.table('processed_urls').select('processed_at') \
+        .eq('status', STATUS_QUEUED).order('processed_at').limit(1).execute()
+    oldest_due = supabase.table('processed_urls').select('next_attempt_at') \
+        .eq('status', STATUS_QUEUED).lte('next_attempt_at', now.isoformat()) \
+        .order('next_attempt_at').limit(1).execute()
+    retrying = supabase.table('processed_urls').select('id', count='exact') \
+        .eq('status', STATUS_QUEUED).gt('attempts', 0).limit(1).execute()
+
+    lanes = {}
+    for lane in LANES:
+        queued = supabase.table('processed_urls').select('id', count='exact') \
+            .eq('status', STATUS_QUEUED).eq('lane', lane).limit(1).execute()
+        lane_due = supabase.table('processed_urls').select('next_attempt_at') \
+            .eq('status', STATUS_QUEUED).eq('lane', lane).lte('next_attempt_at', now.isoformat()) \
+            .order('next_attempt_at').limit(1).execute()
+        lanes[lane] = {
+            'queued': queued.count or 0,
+            'oldest_due_lag_s': _age_seconds(lane_due.data[0]['next_attempt_at'] if lane_due.data else None),
+        }
+
+    return {
+        'depth_by_status': depth,
+        'oldest_queued_age_s': _age_seconds(oldest.data[0]['processed_at'] if oldest.data else None),
+        'oldest_due_lag_s': _age_seconds(oldest_due.data[0]['next_attempt_at'] if oldest_due.data else None),
+        'queued_retries': retrying.count or 0,
+        'lanes': lanes,
+    }
+
+
+@app.route('/api/admin/queue', methods=['GET'])
+@require_admin
+def admin_queue():
+    """Queue introspection: cluster-wide depth from the DB plus this worker's
+    pipeline, timing histograms, retry counters and per-host failure rates."""
+    import cosmos_client
+    import discovered_index
+    import gtin_cache
+    import lookup_log_writer
+    import nfce_pipeline
+    import search_cache
+    try:
+        return jsonify({
+            'database': _queue_db_stats(),
+            'worker': {
+                'local_queue': task_queue.queue_size(),
+                'local_lanes': task_queue.lane_stats(),
+                'pipeline': nfce_pipeline.stats(),
+                'hosts': nfce_breaker.stats(),
+                'cosmos': cosmos_client.stats(),
+                'discovered_index': discovered_index.stats(),
+                'enrichment_trigger': enrichment_trigger.stats(),
+                'gtin_cache': gtin_cache.stats(),
+                'lookup_log': lookup_log_writer.stats(),
+                'search_cache': search_cache.stats(),
+                **nfce_metrics.snapshot(),
+            },
+            'timestamp': _utcnow().isoformat(),
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/admin/metrics', methods=['GET'])
+@require_admin
+def admin_metrics():
+    """The same figures in Prometheus text format (per worker, labelled by pid)."""
+    import nfce_pipeline
+    try:
+        db = _queue_db_stats()
+        hosts = nfce_breaker.stats()
+        gauges = {
+            'nfce_queue_depth': [({'status': k}, v) for k, v in db['depth_by_status'].items()],
+            'nfce_oldest_queued_age_seconds': db['oldest_queued_age_s'],
+            'nfce_oldest_due_lag_seconds': db['oldest_due_lag_s'],
+            'nfce_queued_retries': db['queued_retries'],
+            'nfce_lane_queued': [({'lane': k}, v['queued']) for k, v in db['lanes'].items()],
+            'nfce_lane_due_lag_seconds': [({'lane': k}, v['oldest_due_lag_s']) for k, v in db['lanes'].items()],
+            'nfce_local_queue_size': task_queue.queue_size(),
+            'nfce_pipeline_in_flight': nfce_pipeline.in_flight_count(),
+            'nfce_fetch_concurrency_limit': nfce_concurrency.limit(),
+            'nfce_host_failure_rate': [({'host': h}, v['failure_rate']) for h, v in hosts.items()],
+            'nfce_host_breaker_open': [({'host': h}, int(v['state'] != nfce_breaker.CLOSED))
+                                       for h, v in hosts.items()],
+        }
+        return nfce_metrics.prometheus_text(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4'}
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
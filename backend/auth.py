@@ -11,6 +11,7 @@ is invalidated automatically if verification fails with a known-good
 token (key rotation handling).
 """
 
+import os
 import time
 import requests as req_lib
 from functools import wraps
@@ -118,3 +119,15 @@ def get_user_id_from_token() -> str | None:
     if payload is None:
         return None
     return payload.get("sub")
+
+
+def require_admin(f):
+    """Decorator for /api/admin/*: the authenticated user (g.user_id, set by the
+    before_request guard) must be listed in ADMIN_USER_IDS. Returns 403 otherwise."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        admin_ids = {u.strip() for u in os.getenv("ADMIN_USER_IDS", "").split(",") if u.strip()}
+        if getattr(g, "user_id", None) not in admin_ids:
+            return jsonify({"error": "Acesso restrito a administradores"}), 403
+        return f(*args, **kwargs)
+    return decorated
@@ -0,0 +1,79 @@
+"""
+Benchmark the product matchers (product_matcher.py) on matcher_fixture.csv.
+
+For each matcher, prints accuracy / precision / recall at its threshold on the
+labeled receipt-name vs catalog-name pairs, the pairs it gets wrong, and the
+time per comparison.
+
+Usage:
+    python bench_matcher.py                 # all matchers
+    python bench_matcher.py token --errors  # one matcher, list misclassified pairs
+"""
+
+import csv
+import os
+import sys
+import time
+
+import product_matcher
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'matcher_fixture.csv')
+TIMING_ROUNDS = 200
+
+
+def load_pairs(path=FIXTURE):
+    with open(path, encoding='utf-8') as f:
+        return [(row['query'], row['candidate'], row['match'] == '1') for row in csv.DictReader(f)]
+
+
+def evaluate(matcher, pairs):
+    threshold = product_matcher.threshold(matcher)
+    tp = fp = fn = tn = 0
+    errors = []
+    for query, candidate, expected in pairs:
+        score = product_matcher.score(query, candidate, matcher)
+        predicted = score >= threshold
+        tp += predicted and expected
+        fp += predicted and not expected
+        fn += expected and not predicted
+        tn += not predicted and not expected
+        if predicted != expected:
+            errors.append((score, query, candidate, expected))
+    return {
+        'threshold': threshold,
+        'accuracy': (tp + tn) / len(pairs),
+        'precision': tp / (tp + fp) if tp + fp else 0.0,
+        'recall': tp / (tp + fn) if tp + fn else 0.0,
+        'errors': errors,
+    }
+
+
+def time_per_comparison(matcher, pairs):
+    product_matcher.normalize.cache_clear()
+    start = time.perf_counter()
+    for _ in range(TIMING_ROUNDS):
+        for query, candidate, _expected in pairs:
+            product_matcher.score(query, candidate, matcher)
+    return (time.perf_counter() - start) / (TIMING_ROUNDS * len(pairs))
+
+
+def main():
+    args = sys.argv[1:]
+    matchers = [a for a in args if not a.startswith('--')] or list(product_matcher.MATCHERS)
+    pairs = load_pairs()
+    accelerated = product_matcher._rapidfuzz_ratio is not None
+    print(f"{len(pairs)} labeled pairs, rapidfuzz {'available' if accelerated else 'not installed'}\n")
+
+    for matcher in matchers:
+        result = evaluate(matcher, pairs)
+        micros = time_per_comparison(matcher, pairs) * 1e6
+        print(f"{matcher:8s} threshold {result['threshold']:.2f}  accuracy {result['accuracy']:.1%}  "
+              f"precision {result['precision']:.1%}  recall {result['recall']:.1%}  {micros:.1f} µs/pair")
+        if '--errors' in args or len(matchers) == 1:
+            for score, query, candidate, expected in sorted(result['errors']):
+                label = 'missed' if expected else 'false match'
+                print(f"    {label:11s} {score:.2f}  {query!r} vs {candidate!r}")
+
+
+if __name__ == '__main__':
+    main()
@@ -9,10 +9,16 @@ STATUS_PROCESSING = 'processing'
 STATUS_EXTRACTING = 'extracting'
 STATUS_SUCCESS = 'success'
 STATUS_ERROR = 'error'
+STATUS_DEAD = 'dead'  # dead-letter: retries exhausted (see nfce_retry.py)
 
 # Active statuses used to detect in-flight or completed duplicates
 ACTIVE_NFCE_STATUSES = [STATUS_SUCCESS, STATUS_PROCESSING, STATUS_EXTRACTING, STATUS_QUEUED]
 
+# processed_urls.lane values (priority classes, see nfce_lanes.py)
+LANE_INTERACTIVE = 'interactive'  # receipts scanned in the apps: always served first
+LANE_BATCH = 'batch'              # bulk imports / re-processing: reserved share only
+LANES = (LANE_INTERACTIVE, LANE_BATCH)
+
 # Placeholder market_id values stored temporarily before the real CNPJ is known
 MARKET_ID_QUEUED = 'QUEUED'
 MARKET_ID_UNRESOLVED = 'UNRESOLVED'
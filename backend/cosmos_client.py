@@ -0,0 +1,308 @@
+"""
+Concurrent Bluesoft Cosmos client with a token bucket per API token.
+
+Every request takes one unit from the bucket of the token with the most
+headroom, so calls are spread across all tokens before any of them reaches
+its limit (instead of using one token until it answers 429). Buckets refill
+at COSMOS_TOKEN_RATE_PER_MINUTE (or the per-token COSMOS_TOKEN_RATES entry)
+and hold up to COSMOS_TOKEN_BURST units.
+
+Responses are read for quota hints: a 429 sets the token aside until its
+Retry-After (or X-RateLimit-Reset) time, COOLDOWN_SECONDS when Cosmos gives
+none, and a success reporting zero requests remaining does the same before
+the 429 happens. Cooldowns are stored in the cosmos_token_cooldowns table
+(migration_cosmos_token_cooldowns.sql, keyed by a hash of the token), so
+restarted processes and the other workers skip a cooling token too; they
+re-read it every COOLDOWN_SYNC_SECONDS. When every token is cooling down,
+callers wait if the first one comes back within COSMOS_MAX_COOLDOWN_WAIT_SECONDS
+(per-minute limits), and otherwise get TOKENS_EXHAUSTED.
+
+map_ordered() runs lookups on a pool of COSMOS_CONCURRENCY threads and
+returns the results in input order, so enrichment throughput grows with the
+number of tokens rather than being bound to one round-trip at a time.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from supabase_client import supabase
+
+BASE_URL = 'https://api.cosmos.bluesoft.com.br'
+TOKENS = [t.strip() for t in os.getenv('COSMOS_TOKENS', '').split(',') if t.strip()]
+USER_AGENT = os.getenv('COSMOS_USER_AGENT', 'Cosmos-API-Request')
+DEFAULT_RATE_PER_MINUTE = float(os.getenv('COSMOS_TOKEN_RATE_PER_MINUTE', '30'))
+BURST = max(1, int(os.getenv('COSMOS_TOKEN_BURST', '5')))
+CONCURRENCY = max(1, int(os.getenv('COSMOS_CONCURRENCY', '4')))
+REQUEST_TIMEOUT_SECONDS = 10
+COOLDOWN_SECONDS = 3600  # Cosmos quotas are daily; don't hammer a token that already said 429
+MAX_COOLDOWN_WAIT_SECONDS = float(os.getenv('COSMOS_MAX_COOLDOWN_WAIT_SECONDS', '60'))
+COOLDOWN_SYNC_SECONDS = 60
+
+TOKENS_EXHAUSTED = 'TOKENS_EXHAUSTED'
+
+
+def _parse_rates(spec: str) -> list:
+    """Per-token requests/minute, aligned with COSMOS_TOKENS; blanks use the default."""
+    rates = []
+    for index in range(len(TOKENS)):
+        parts = spec.split(',') if spec else []
+        value = parts[index].strip() if index < len(parts) else ''
+        try:
+            rates.append(float(value) if value else DEFAULT_RATE_PER_MINUTE)
+        except ValueError:
+            print(f"[COSMOS] Ignoring malformed COSMOS_TOKEN_RATES entry: {value!r}")
+            rates.append(DEFAULT_RATE_PER_MINUTE)
+    return rates
+
+
+def _parse_retry_at(response, now):
+    """
+    Epoch time the response says the token may be used again, or None. Reads
+    Retry-After (seconds or an HTTP date) and X-RateLimit-Reset / RateLimit-Reset
+    (seconds from now, or an epoch timestamp).
+    """
+    headers = response.headers
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        try:
+            return now + max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return parsedate_to_datetime(retry_after).timestamp()
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get('X-RateLimit-Reset') or headers.get('RateLimit-Reset')
+    if reset:
+        try:
+            value = float(reset)
+        except ValueError:
+            return None
+        return value if value > 1e9 else now + max(0.0, value)
+    return None
+
+
+def _parse_remaining(response):
+    """Requests left in the token's quota window, if the response says."""
+    value = response.headers.get('X-RateLimit-Remaining') or response.headers.get('RateLimit-Remaining')
+    try:
+        return int(float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+class _Bucket:
+    __slots__ = ('index', 'token', 'token_id', 'rate', 'level', 'updated', 'cooldown_until',
+                 'remaining', 'requests', 'rate_limited')
+
+    def __init__(self, index, token, rate_per_minute):
+        self.index = index
+        self.token = token
+        self.token_id = hashlib.sha256(token.encode()).hexdigest()[:16]  # stored instead of the token
+        self.rate = max(0.01, rate_per_minute) / 60.0  # units per second
+        self.level = float(BURST)
+        self.updated = time.monotonic()
+        self.cooldown_until = 0.0  # epoch seconds, comparable across processes
+        self.remaining = None  # last X-RateLimit-Remaining seen
+        self.requests = 0
+        self.rate_limited = 0
+
+    def refill(self, now):
+        self.level = min(BURST, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+_buckets = [_Bucket(i, token, rate) for i, (token, rate) in
+            enumerate(zip(TOKENS, _parse_rates(os.getenv('COSMOS_TOKEN_RATES', ''))))]
+_cond = threading.Condition()
+_local = threading.local()
+_executor = None
+_executor_lock = threading.Lock()
+_synced_at = 0.0  # monotonic time of the last cooldown read from the table
+_db_warned = False
+
+
+def _db_failed(action, error):
+    global _db_warned
+    if not _db_warned:
+        _db_warned = True
+        print(f"  [COSMOS] Could not {action} cosmos_token_cooldowns "
+              f"(is migration_cosmos_token_cooldowns.sql applied?): {error}")
+
+
+def _sync_cooldowns():
+    """Adopt cooldowns other processes stored, at most every COOLDOWN_SYNC_SECONDS."""
+    global _synced_at
+    with _cond:
+        if not _buckets or time.monotonic() - _synced_at < COOLDOWN_SYNC_SECONDS:
+            return
+        _synced_at = time.monotonic()
+    try:
+        rows = supabase.table('cosmos_token_cooldowns').select('token_id, cooldown_until') \
+            .in_('token_id', [b.token_id for b in _buckets]) \
+            .gt('cooldown_until', datetime.now(timezone.utc).isoformat()).execute().data or []
+    except Exception as e:
+        _db_failed('read', e)
+        return
+    by_id = {b.token_id: b for b in _buckets}
+    with _cond:
+        for row in rows:
+            bucket = by_id.get(row['token_id'])
+            until = datetime.fromisoformat(row['cooldown_until'].replace('Z', '+00:00')).timestamp()
+            if bucket and until > bucket.cooldown_until:
+                bucket.cooldown_until = until
+                bucket.level = 0.0
+
+
+def _store_cooldown(bucket, until):
+    try:
+        supabase.table('cosmos_token_cooldowns').upsert({
+            'token_id': bucket.token_id,
+            'cooldown_until': datetime.fromtimestamp(until, timezone.utc).isoformat(),
+            'updated_at': datetime.now(timezone.utc).isoformat(),
+        }, on_conflict='token_id').execute()
+    except Exception as e:
+        _db_failed('write', e)
+
+
+def _acquire():
+    """
+    Block until a token has a unit available and take it. None if every token
+    is cooling down for longer than MAX_COOLDOWN_WAIT_SECONDS.
+    """
+    with _cond:
+        while True:
+            wall = time.time()
+            usable = [b for b in _buckets if b.cooldown_until <= wall]
+            if not usable:
+                wait = min(b.cooldown_until for b in _buckets) - wall if _buckets else None
+                if wait is None or wait > MAX_COOLDOWN_WAIT_SECONDS:
+                    return None
+                _cond.wait(wait)
+                continue
+            now = time.monotonic()
+            for bucket in usable:
+                bucket.refill(now)
+            # Most headroom: bucket level first, then the quota Cosmos says is left
+            best = max(usable, key=lambda b: (b.level, float('inf') if b.remaining is None else b.remaining))
+            if best.level >= 1:
+                best.level -= 1
+                best.requests += 1
+                return best
+            _cond.wait(min((1 - b.level) / b.rate for b in usable))
+
+
+def _cool_down(bucket, until, rate_limited):
+    with _cond:
+        if rate_limited:
+            bucket.rate_limited += 1
+        bucket.level = 0.0
+        bucket.remaining = None  # a new quota window starts after the cooldown
+        bucket.cooldown_until = until = max(bucket.cooldown_until, until)
+        _cond.notify_all()
+    _store_cooldown(bucket, until)
+
+
+def _record_quota(bucket, response):
+    """Track the quota headers of a successful response; cool down a token that has none left."""
+    remaining = _parse_remaining(response)
+    if remaining is None:
+        return
+    with _cond:
+        bucket.remaining = remaining
+        bucket.level = min(bucket.level, float(remaining))
+    if remaining <= 0:
+        until = _parse_retry_at(response, time.time()) or time.time() + COOLDOWN_SECONDS
+        print(f"  [COSMOS] Quota do token de índice {bucket.index} esgotada; "
+              f"pausando por {until - time.time():.0f}s.")
+        _cool_down(bucket, until, rate_limited=False)
+
+
+def _session() -> requests.Session:
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()  # keep-alive per thread
+        _local.session = session
+    return session
+
+
+def get(path: str, params=None):
+    """
+    GET a Cosmos endpoint. Returns (response, None), or (None, TOKENS_EXHAUSTED)
+    when every token is rate limited. Network errors propagate.
+    """
+    _sync_cooldowns()
+    for _ in range(len(_buckets)):
+        bucket = _acquire()
+        if bucket is None:
+            break
+        response = _session().get(
+            f"{BASE_URL}{path}",
+            params=params,
+            headers={
+                'X-Cosmos-Token': bucket.token,
+                'User-Agent': USER_AGENT,
+                'Content-Type': 'application/json',
+            },
+            timeout=REQUEST_TIMEOUT_SECONDS,
+        )
+        if response.status_code == 429:
+            until = _parse_retry_at(response, time.time()) or time.time() + COOLDOWN_SECONDS
+            print(f"  [COSMOS] Limite excedido para o token de índice {bucket.index}. "
+                  f"Pausando por {until - time.time():.0f}s...")
+            _cool_down(bucket, until, rate_limited=True)
+            continue
+        _record_quota(bucket, response)
+        return response, None
+    return None, TOKENS_EXHAUSTED
+
+
+def enabled() -> bool:
+    return bool(_buckets)
+
+
+def map_ordered(fn, items) -> list:
+    """Run fn over items on the Cosmos thread pool; results come back in input order."""
+    global _executor
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix='cosmos')
+    return list(_executor.map(fn, items))
+
+
+def stats() -> list:
+    """Per-token bucket state (tokens themselves are never exposed)."""
+    now = time.monotonic()
+    wall = time.time()
+    with _cond:
+        result = []
+        for bucket in _buckets:
+            bucket.refill(now)
+            result.append({
+                'token_index': bucket.index,
+                'rate_per_minute': round(bucket.rate * 60, 2),
+                'available': round(bucket.level, 2),
+                'requests': bucket.requests,
+                'rate_limited': bucket.rate_limited,
+                'quota_remaining': bucket.remaining,
+                'cooldown_s': max(0, int(bucket.cooldown_until - wall)),
+            })
+        return result
+
+
+def reset_after_fork():
+    """Thread pools and pooled connections must not cross os.fork()."""
+    global _executor, _local, _synced_at
+    _executor = None
+    _local = threading.local()
+    _synced_at = 0.0  # re-read stored cooldowns in the new worker
@@ -0,0 +1,124 @@
+"""
+In-memory index of GTINs discovered for SEM GTIN receipt items.
+
+When a name search finds a product, product_lookup_log keeps the GTIN it found
+for that (original_name, ncm). Instead of querying the log for every SEM GTIN
+item, the enrichment worker keeps {(normalized name, ncm): (gtin, final_name)}
+per process: refresh() loads the whole log once, and only rows added since
+(by id) on later runs; record() adds new successes as they happen.
+
+Names are keyed by product_matcher.normalize(), so "REFRIG COCA COLA 2L" and
+"REFRIG. COCA-COLA 2 L" share an entry. With DISCOVERED_INDEX_FUZZY enabled, a
+miss falls back to names with the same NCM that differ only in abbreviation
+(product_matcher.same_tokens: "LEITE UHT INT 1L" vs "LEITE UHT INTEGRAL 1L",
+but not "REFRIG COCA COLA 2L" vs "REFRIG COCA COLA ZERO 2L"). The best of them
+by product_matcher score, taken both ways since either name may be the
+abbreviated one, is accepted at FUZZY_THRESHOLD or above - stricter than the
+search threshold, since nobody reviews these matches.
+
+Until the first refresh() succeeds, ready() is false and callers query the
+log directly.
+"""
+
+import os
+import threading
+
+import product_matcher
+from supabase_client import supabase
+
+PAGE_SIZE = 1000
+FUZZY_ENABLED = os.getenv('DISCOVERED_INDEX_FUZZY', 'true').lower() != 'false'
+FUZZY_THRESHOLD = 0.9
+
+_lock = threading.Lock()
+_entries = {}  # (normalized name, ncm) -> (gtin, final_name)
+_names_by_ncm = {}  # ncm -> {normalized name}, for the fuzzy fallback
+_last_id = 0  # highest product_lookup_log.id loaded
+_ready = False
+_stats = {'hits': 0, 'fuzzy_hits': 0, 'misses': 0, 'loaded_rows': 0, 'recorded': 0, 'refresh_errors': 0}
+
+
+def _store(name, ncm, gtin, final_name):
+    key = (product_matcher.normalize(name), ncm or '')
+    if not key[0]:
+        return
+    _entries[key] = (gtin, final_name)
+    _names_by_ncm.setdefault(key[1], set()).add(key[0])
+
+
+def _symmetric_score(a, b):
+    # Both sides are receipt names, so either may be the abbreviated one (INT / INTEGRAL);
+    # an extra word on either side (ZERO, a brand) is a different product
+    if not product_matcher.same_tokens(a, b):
+        return 0.0
+    return max(product_matcher.token_score(a, b), product_matcher.token_score(b, a))
+
+
+def refresh():
+    """Load log rows added since the last refresh (all of them the first time). Returns rows loaded."""
+    global _last_id, _ready
+    loaded = 0
+    try:
+        while True:
+            with _lock:
+                after = _last_id
+            rows = supabase.table('product_lookup_log').select('id, original_name, ncm, final_name, gtin') \
+                .gt('id', after).eq('success', True).not_.is_('gtin', 'null') \
+                .order('id').limit(PAGE_SIZE).execute().data or []
+            with _lock:
+                for row in rows:
+                    if row.get('original_name'):
+                        _store(row['original_name'], row.get('ncm'), row['gtin'], row.get('final_name'))
+                    _last_id = max(_last_id, row['id'])
+                _stats['loaded_rows'] += len(rows)
+            loaded += len(rows)
+            if len(rows) < PAGE_SIZE:
+                break
+    except Exception as e:
+        with _lock:
+            _stats['refresh_errors'] += 1
+        print(f"  [DISCOVERED-INDEX] Refresh failed after {loaded} rows: {e}")
+        return loaded
+    with _lock:
+        _ready = True
+    return loaded
+
+
+def ready() -> bool:
+    return _ready
+
+
+def get(name, ncm):
+    """(gtin, final_name) last discovered for this name + NCM, or None."""
+    key = (product_matcher.normalize(name or ''), ncm or '')
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _stats['hits'] += 1
+            return entry
+        candidates = list(_names_by_ncm.get(key[1], ())) if FUZZY_ENABLED and key[0] else []
+
+    if candidates:
+        best, best_score = max(((name, _symmetric_score(key[0], name)) for name in candidates),
+                               key=lambda pair: pair[1])
+        if best_score >= FUZZY_THRESHOLD:
+            with _lock:
+                _stats['fuzzy_hits'] += 1
+                return _entries[(best, key[1])]
+    with _lock:
+        _stats['misses'] += 1
+    return None
+
+
+def record(name, ncm, gtin, final_name):
+    """Add a lookup that just found a GTIN, so later items in this run reuse it."""
+    if not name or not gtin:
+        return
+    with _lock:
+        _store(name, ncm, gtin, final_name)
+        _stats['recorded'] += 1
+
+
+def stats() -> dict:
+    with _lock:
+        return {**_stats, 'entries': len(_entries), 'ready': _ready, 'last_id': _last_id}
@@ -0,0 +1,79 @@
+"""
+Queue NFCe URLs in the batch lane (bulk imports, re-processing lists).
+
+Rows are inserted into processed_urls with lane='batch' and picked up by the
+regular workers, which always serve interactive scans first and give batch
+jobs only their reserved share (NFCE_BATCH_SHARE, see nfce_lanes.py). URLs
+already present in processed_urls are skipped.
+
+Usage:
+    python enqueue_batch.py urls.txt                       # dry-run (no changes)
+    python enqueue_batch.py urls.txt --apply [--user UUID]  # insert rows
+"""
+
+import sys
+from datetime import datetime, timezone
+
+from supabase_client import supabase
+from constants import STATUS_QUEUED, MARKET_ID_QUEUED, LANE_BATCH
+
+CHUNK_SIZE = 100
+
+
+def read_urls(path):
+    with open(path, encoding='utf-8') as f:
+        urls = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return list(dict.fromkeys(urls))  # dedupe, keep order
+
+
+def existing_urls(urls):
+    """URLs already known to processed_urls, as original or final URL (two queries per chunk)."""
+    known = set()
+    for start in range(0, len(urls), CHUNK_SIZE):
+        chunk = urls[start:start + CHUNK_SIZE]
+        # in_() already quotes values with commas, colons or parentheses (every URL)
+        for column in ('original_url', 'nfce_url'):
+            result = supabase.table('processed_urls').select(column).in_(column, chunk).execute()
+            known.update(row[column] for row in result.data or [])
+    return known
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or args[0].startswith('--'):
+        print(__doc__)
+        return
+    dry_run = '--apply' not in args
+    user_id = args[args.index('--user') + 1] if '--user' in args else None
+
+    urls = read_urls(args[0])
+    known = existing_urls(urls)
+    new_urls = [u for u in urls if u not in known]
+    print(f"{len(urls)} URLs read, {len(known)} already in processed_urls, {len(new_urls)} to queue")
+
+    if dry_run:
+        print("Dry run - run with --apply to insert them in the batch lane")
+        return
+
+    now = datetime.now(timezone.utc).isoformat()
+    for start in range(0, len(new_urls), CHUNK_SIZE):
+        chunk = new_urls[start:start + CHUNK_SIZE]
+        supabase.table('processed_urls').insert([{
+            'nfce_url': url,
+            'original_url': url,
+            'market_id': MARKET_ID_QUEUED,
+            'market_name': '',
+            'products_count': 0,
+            'status': STATUS_QUEUED,
+            'processed_at': now,
+            'next_attempt_at': now,
+            'lane': LANE_BATCH,
+            'scanned_by': user_id,
+        } for url in chunk]).execute()
+        print(f"  queued {start + len(chunk)}/{len(new_urls)}")
+
+    print("Done. Workers pull batch rows as their reserved share allows.")
+
+
+if __name__ == '__main__':
+    main()
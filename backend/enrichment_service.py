@@ -1,180 +1,180 @@
-import os
 import time
-import requests
-import difflib
 from datetime import datetime, timezone
 
 from supabase_client import supabase  # shared singleton client
 
-# Bluesoft Cosmos API configuration
-COSMOS_TOKENS = os.getenv('COSMOS_TOKENS', '').split(',') if os.getenv('COSMOS_TOKENS') else []
-COSMOS_USER_AGENT = os.getenv('COSMOS_USER_AGENT', 'Cosmos-API-Request')
-_current_cosmos_token_idx = 0
+import cosmos_client
+import gtin_cache
+import lookup_log_writer
+import product_matcher
+import search_cache
 
-def get_product_from_cosmos(gtin):
+
+def lookup_gtin(gtin):
     """
-    Query Bluesoft Cosmos API to get product name from GTIN/EAN barcode.
-    Handles multiple tokens and 429 rate limits.
+    Look up a GTIN/EAN barcode: gtin_cache first, then the Bluesoft Cosmos API.
+    Token choice and 429 handling are done by cosmos_client; definitive answers
+    (found / 404) are written back to the cache.
     
     Returns:
-        tuple: (success, product_name, brand_name, image_url, execution_time_ms, error_msg)
+        dict: success, product_name, brand, image_url, ncm, time_ms, error, from_cache
     """
-    global _current_cosmos_token_idx
-    
+    result = {'success': False, 'product_name': None, 'brand': None, 'image_url': None,
+              'ncm': None, 'time_ms': 0, 'error': None, 'from_cache': False}
+
     if not gtin or gtin == 'SEM GTIN' or len(gtin) < 8:
-        return False, None, None, None, 0, "GTIN inválido"
-    
-    if not COSMOS_TOKENS:
-        return False, None, None, None, 0, "Nenhum token do Cosmos disponível"
+        return {**result, 'error': "GTIN inválido"}
 
     start_time = time.time()
+    cached = gtin_cache.get(gtin)
+    if cached is not None:
+        time_ms = int((time.time() - start_time) * 1000)
+        if cached['found']:
+            return {**result, **{k: cached[k] for k in ('product_name', 'brand', 'image_url', 'ncm')},
+                    'success': True, 'time_ms': time_ms, 'from_cache': True}
+        return {**result, 'time_ms': time_ms, 'error': "Produto não encontrado", 'from_cache': True}
     
-    # Try each available token if we hit 429
-    tokens_to_try = len(COSMOS_TOKENS)
+    if not cosmos_client.enabled():
+        return {**result, 'error': "Nenhum token do Cosmos disponível"}
     
-    for _ in range(tokens_to_try):
-        token = COSMOS_TOKENS[_current_cosmos_token_idx].strip()
-        url = f"https://api.cosmos.bluesoft.com.br/gtins/{gtin}.json"
-        headers = {
-            "X-Cosmos-Token": token,
-            "User-Agent": COSMOS_USER_AGENT,
-            "Content-Type": "application/json"
-        }
+    try:
+        response, error = cosmos_client.get(f"/gtins/{gtin}.json")
+        execution_time_ms = int((time.time() - start_time) * 1000)
         
-        try:
-            response = requests.get(url, headers=headers, timeout=10)
-            execution_time_ms = int((time.time() - start_time) * 1000)
+        if error:
+            return {**result, 'error': error}
+        
+        if response.status_code == 200:
+            data = response.json()
+            product_name = data.get('description')
+            brand_name = (data.get('brand') or {}).get('name')
+            image_url = data.get('thumbnail')
+            ncm = (data.get('ncm') or {}).get('code')
+            print(f"  [COSMOS] Encontrado: \"{product_name}\" [{brand_name}] para GTIN {gtin} ({execution_time_ms}ms)")
+            gtin_cache.put(gtin, True, product_name, brand_name, image_url, ncm)
+            return {**result, 'success': True, 'product_name': product_name, 'brand': brand_name,
+                    'image_url': image_url, 'ncm': ncm, 'time_ms': execution_time_ms}
             
-            if response.status_code == 200:
-                data = response.json()
-                product_name = data.get('description')
-                brand_name = data.get('brand', {}).get('name')
-                image_url = data.get('thumbnail')
-                print(f"  [COSMOS] Encontrado: \"{product_name}\" [{brand_name}] para GTIN {gtin} ({execution_time_ms}ms)")
-                return True, product_name, brand_name, image_url, execution_time_ms, None
-                
-            elif response.status_code == 429:
-                print(f"  [COSMOS] Limite excedido para o token de índice {_current_cosmos_token_idx}. Rotacionando...")
-                _current_cosmos_token_idx = (_current_cosmos_token_idx + 1) % len(COSMOS_TOKENS)
-                # After rotating, the next loop iteration will try the next token
-                continue
-                
-            elif response.status_code == 404:
-                print(f"  [COSMOS] Produto {gtin} não encontrado (404)")
-                return False, None, None, None, execution_time_ms, "Produto não encontrado"
-                
-            else:
-                error_msg = f"HTTP {response.status_code}"
-                print(f"  [COSMOS] Erro: {error_msg} para GTIN {gtin}")
-                return False, None, None, None, execution_time_ms, error_msg
-                
-        except Exception as e:
-            execution_time_ms = int((time.time() - start_time) * 1000)
-            print(f"  [COSMOS] Erro na Requisição: {e}")
-            return False, None, None, None, execution_time_ms, str(e)
+        elif response.status_code == 404:
+            print(f"  [COSMOS] Produto {gtin} não encontrado (404)")
+            gtin_cache.put(gtin, False)
+            return {**result, 'time_ms': execution_time_ms, 'error': "Produto não encontrado"}
             
-    return False, None, None, None, 0, "TOKENS_EXHAUSTED"
+        else:
+            error_msg = f"HTTP {response.status_code}"
+            print(f"  [COSMOS] Erro: {error_msg} para GTIN {gtin}")
+            return {**result, 'time_ms': execution_time_ms, 'error': error_msg}
+            
+    except Exception as e:
+        execution_time_ms = int((time.time() - start_time) * 1000)
+        print(f"  [COSMOS] Erro na Requisição: {e}")
+        return {**result, 'time_ms': execution_time_ms, 'error': str(e)}
+
+
+def get_product_from_cosmos(gtin):
+    """
+    Query Bluesoft Cosmos API (through gtin_cache) to get product name from GTIN/EAN barcode.
+    
+    Returns:
+        tuple: (success, product_name, brand_name, image_url, execution_time_ms, error_msg)
+    """
+    r = lookup_gtin(gtin)
+    return r['success'], r['product_name'], r['brand'], r['image_url'], r['time_ms'], r['error']
+
+
+# Search outcomes that are answers (not failures) and may be cached like a match
+SEARCH_NO_MATCH_ERRORS = {
+    "Nenhum produto encontrado",
+    "Nenhum match de NCM encontrado",
+    "No confident similarity match",
+}
 
 
 def search_product_on_cosmos(query, ncm_filter=None):
     """
-    Search for a product on Cosmos API by its description.
-    Prioritizes results that match the provided NCM.
+    Search for a product on Cosmos API by its description, through the
+    per-process search_cache (keyed by normalized query + NCM).
     
     Returns:
         tuple: (success, product_name, gtin, brand_name, image_url, execution_time_ms, error_msg)
     """
-    global _current_cosmos_token_idx
-    
+    result, from_cache = search_cache.get_or_load(
+        search_cache.key_for(query, ncm_filter),
+        lambda: _search_product_on_cosmos(query, ncm_filter),
+        lambda r: r[0] or r[6] in SEARCH_NO_MATCH_ERRORS,
+    )
+    if from_cache:
+        return result[:5] + (0,) + result[6:]
+    return result
+
+
+def _search_product_on_cosmos(query, ncm_filter=None):
+    """
+    Search for a product on Cosmos API by its description.
+    Prioritizes results that match the provided NCM.
+    """
     if not query or len(query.strip()) < 3:
         return False, None, None, None, None, 0, "Busca muito curta"
         
-    if not COSMOS_TOKENS:
+    if not cosmos_client.enabled():
         return False, None, None, None, None, 0, "Nenhum token do Cosmos disponível"
 
     start_time = time.time()
-    tokens_to_try = len(COSMOS_TOKENS)
     
-    for _ in range(tokens_to_try):
-        token = COSMOS_TOKENS[_current_cosmos_token_idx].strip()
-        url = "https://api.cosmos.bluesoft.com.br/products"
-        params = {"query": query}
-        headers = {
-            "X-Cosmos-Token": token,
-            "User-Agent": COSMOS_USER_AGENT,
-            "Content-Type": "application/json"
-        }
+    try:
+        response, error = cosmos_client.get("/products", params={"query": query})
+        execution_time_ms = int((time.time() - start_time) * 1000)
         
-        try:
-            response = requests.get(url, params=params, headers=headers, timeout=10)
-            execution_time_ms = int((time.time() - start_time) * 1000)
-            
-            if response.status_code == 200:
-                data = response.json()
-                products = data.get('products', [])
-                
-                if not products:
-                    return False, None, None, None, None, execution_time_ms, "Nenhum produto encontrado"
-                
-                # NCM-Aware Matching Logic with Fuzzy String Similarity
-                selected_product = None
-                
-                # Candidates for matching
-                candidates = []
-                if ncm_filter:
-                    # Filter by exact NCM match
-                    candidates = [p for p in products if p.get('ncm', {}).get('code') == ncm_filter]
-                    if not candidates:
-                        print(f"  [COSMOS-SEARCH] Nenhum match de NCM para '{query}'.")
-                        return False, None, None, None, None, execution_time_ms, "Nenhum match de NCM encontrado"
-                else:
-                    candidates = products
+        if error:
+            return False, None, None, None, None, 0, error
+        
+        if response.status_code != 200:
+            error_msg = f"HTTP {response.status_code}"
+            return False, None, None, None, None, execution_time_ms, error_msg
+        
+        data = response.json()
+        products = data.get('products', [])
+        
+        if not products:
+            return False, None, None, None, None, execution_time_ms, "Nenhum produto encontrado"
+        
+        # NCM-Aware Matching Logic with Fuzzy String Similarity
+        selected_product = None
+        
+        # Candidates for matching
+        candidates = []
+        if ncm_filter:
+            # Filter by exact NCM match
+            candidates = [p for p in products if (p.get('ncm') or {}).get('code') == ncm_filter]
+            if not candidates:
+                print(f"  [COSMOS-SEARCH] Nenhum match de NCM para '{query}'.")
+                return False, None, None, None, None, execution_time_ms, "Nenhum match de NCM encontrado"
+        else:
+            candidates = products
 
-                # Find the best match among candidates using string similarity
-                best_score = -1
-                
-                for candidate in candidates:
-                    candidate_name = candidate.get('description', '')
-                    # Calculate similarity ratio (0.0 to 1.0)
-                    score = difflib.SequenceMatcher(None, query.upper(), candidate_name.upper()).ratio()
-                    
-                    if score > best_score:
-                        best_score = score
-                        selected_product = candidate
-                
-                # Minimum threshold to avoid weak matches (e.g. 0.8 or 80%)
-                SIMILARITY_THRESHOLD = 0.8
-                
-                if selected_product and best_score >= SIMILARITY_THRESHOLD:
-                    print(f"  [COSMOS-SEARCH] Best match for '{query}' (score: {best_score:.2f}): {selected_product.get('description')}")
-                    return (
-                        True, 
-                        selected_product.get('description'), 
-                        selected_product.get('gtin'),
-                        selected_product.get('brand', {}).get('name'),
-                        selected_product.get('thumbnail'),
-                        execution_time_ms, 
-                        None
-                    )
-                else:
-                    print(f"  [COSMOS-SEARCH] No confident match for '{query}' (best score: {best_score:.2f}).")
-                    return False, None, None, None, None, execution_time_ms, "No confident similarity match"
-                
-            elif response.status_code == 429:
-                print(f"  [COSMOS-SEARCH] Limit exceeded for token index {_current_cosmos_token_idx}. Rotating...")
-                _current_cosmos_token_idx = (_current_cosmos_token_idx + 1) % len(COSMOS_TOKENS)
-                continue
-                
-            else:
-                error_msg = f"HTTP {response.status_code}"
-                return False, None, None, None, None, execution_time_ms, error_msg
-                
-        except Exception as e:
-            execution_time_ms = int((time.time() - start_time) * 1000)
-            print(f"  [COSMOS-SEARCH] Request Error: {e}")
-            return False, None, None, None, None, execution_time_ms, str(e)
+        # Find the best match among candidates (product_matcher: normalized token similarity)
+        selected_product, best_score = product_matcher.best_match(
+            query, candidates, key=lambda p: p.get('description', ''))
+        
+        if selected_product and best_score >= product_matcher.threshold():
+            print(f"  [COSMOS-SEARCH] Best match for '{query}' (score: {best_score:.2f}): {selected_product.get('description')}")
+            return (
+                True, 
+                selected_product.get('description'), 
+                selected_product.get('gtin'),
+                (selected_product.get('brand') or {}).get('name'),
+                selected_product.get('thumbnail'),
+                execution_time_ms, 
+                None
+            )
+        else:
+            print(f"  [COSMOS-SEARCH] No confident match for '{query}' (best score: {best_score:.2f}).")
+            return False, None, None, None, None, execution_time_ms, "No confident similarity match"
             
-    return False, None, None, None, None, 0, "TOKENS_EXHAUSTED"
+    except Exception as e:
+        execution_time_ms = int((time.time() - start_time) * 1000)
+        print(f"  [COSMOS-SEARCH] Request Error: {e}")
+        return False, None, None, None, None, execution_time_ms, str(e)
 
 
 # Enrichment Lock Configuration (uses dedicated system_locks table)
@@ -271,6 +271,7 @@ def log_product_lookup(nfce_url, market_id, gtin, ncm, original_name, final_name
                        cosmos_result=None, source_used=None, success=False):
     """
     Log detailed product lookup to Supabase product_lookup_log table.
+    The row is buffered and written in batches by lookup_log_writer.
     """
     try:
         log_data = {
@@ -282,27 +283,25 @@ def log_product_lookup(nfce_url, market_id, gtin, ncm, original_name, final_name
             'final_name': final_name[:500] if final_name else None,
             'source_used': source_used,
             'success': success,
+            # Set here, not by the column default, so buffering doesn't reorder rows
+            'created_at': datetime.now(timezone.utc).isoformat(),
         }
         
-        # Bluesoft Cosmos details (generic api columns)
-        if cosmos_result:
-            log_data.update({
-                'api_attempted': True,
-                'api_success': cosmos_result.get('success', False),
-                'api_product_name': cosmos_result.get('product_name'),
-                'api_brand': cosmos_result.get('brand'),
-                'api_image_url': cosmos_result.get('image_url'), # New field
-                'api_error': cosmos_result.get('error'),
-                'api_from_cache': False,
-                'api_time_ms': cosmos_result.get('time_ms'),
-            })
+        # Bluesoft Cosmos details (generic api columns). Every row carries the same
+        # columns so the writer can batch them into one insert.
+        cosmos_result = cosmos_result or {}
+        log_data.update({
+            'api_attempted': bool(cosmos_result),
+            'api_success': cosmos_result.get('success', False),
+            'api_product_name': cosmos_result.get('product_name'),
+            'api_brand': cosmos_result.get('brand'),
+            'api_image_url': cosmos_result.get('image_url'), # New field
+            'api_error': cosmos_result.get('error'),
+            'api_from_cache': cosmos_result.get('from_cache', False),
+            'api_time_ms': cosmos_result.get('time_ms'),
+        })
         
-        # Log the result to the database
-        try:
-            supabase.table('product_lookup_log').insert(log_data).execute()
-        except Exception as e:
-            print(f"  [WARN] Failed to log product lookup: {e}")
-            raise e
+        lookup_log_writer.enqueue(log_data)
         
     except Exception as e:
         # Don't fail the main process if logging fails
@@ -0,0 +1,76 @@
+"""
+Debounced, coalescing trigger for the enrichment worker.
+
+Every /api/scan/save, manual trigger and "NFCe extracted" event used to start
+its own thread running process_pending_purchases(), and each of those polled
+the system_locks enrichment lock for up to a minute or two. A burst of 50
+scans meant 50 threads polling the database.
+
+request() now only marks work as pending. A single runner thread per process
+starts ENRICHMENT_DEBOUNCE_MS after the first event (so a burst becomes one
+run), runs the worker until both queues are drained, and runs again if more
+events arrived meanwhile. However fast events arrive, a process has at most
+one enrichment thread and one lock poller.
+"""
+
+import os
+import threading
+import time
+
+DEBOUNCE_SECONDS = float(os.getenv('ENRICHMENT_DEBOUNCE_MS', '1000')) / 1000
+
+_lock = threading.Lock()
+_pending = False
+_worker_id = None  # worker_id of the latest event, used for the next run
+_runner = None
+_stats = {'events': 0, 'coalesced': 0, 'runs': 0, 'errors': 0}
+
+
+def request(worker_id='auto') -> bool:
+    """Note that there is enrichment work. Returns True if this started the runner thread."""
+    global _pending, _worker_id, _runner
+    with _lock:
+        _stats['events'] += 1
+        _worker_id = worker_id
+        if _runner is not None and _runner.is_alive():
+            _stats['coalesced'] += 1
+            _pending = True
+            return False
+        _pending = True
+        _runner = threading.Thread(target=_run, name='enrichment-trigger', daemon=True)
+        _runner.start()
+        return True
+
+
+def _run():
+    global _pending, _runner
+    from enrichment_worker import process_pending_purchases
+
+    while True:
+        time.sleep(DEBOUNCE_SECONDS)
+        with _lock:
+            if not _pending:
+                _runner = None
+                return
+            _pending = False
+            worker_id = _worker_id
+            _stats['runs'] += 1
+        try:
+            process_pending_purchases(worker_id)
+        except Exception as e:
+            with _lock:
+                _stats['errors'] += 1
+            print(f"[ENRICH-TRIGGER] Enrichment run failed: {e}")
+
+
+def stats() -> dict:
+    with _lock:
+        return {**_stats, 'pending': _pending, 'running': _runner is not None and _runner.is_alive()}
+
+
+def reset_after_fork():
+    """Threads don't survive fork(); a pending flag set in the parent has no runner here."""
+    global _lock, _pending, _runner
+    _lock = threading.Lock()
+    _pending = False
+    _runner = None
@@ -8,9 +8,12 @@ import time
 import logging
 from datetime import datetime, timezone
 
+import cosmos_client
+import discovered_index
+import lookup_log_writer
 from supabase_client import supabase
 from enrichment_service import (
-    get_product_from_cosmos,
+    lookup_gtin,
     search_product_on_cosmos,
     log_product_lookup,
     acquire_enrichment_lock,
@@ -49,6 +52,96 @@ def _parse_iso_date(s: str) -> datetime:
 # Configuration
 BATCH_SIZE = 10
 SLEEP_BETWEEN_BATCHES = 5
+LOOKUP_CHUNK_SIZE = 100  # values per in_() filter, keeps request URLs short
+MAX_COALESCED_ROWS = 200  # pending rows beyond a batch that may share its lookups
+
+
+def _is_gtin(ean) -> bool:
+    return bool(ean) and ean != 'SEM GTIN' and len(ean) >= 8
+
+
+def _chunks(values, size=LOOKUP_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _purchase_key(item):
+    """Rows with the same key resolve the same way: by EAN, else by name + NCM."""
+    if _is_gtin(item.get('ean')):
+        return ('ean', item['ean'])
+    return ('name', item.get('ean'), item.get('product_name'), item.get('ncm'))
+
+
+def _scan_key(item):
+    return item.get('ean')
+
+
+def _pending_siblings(table, items, key_fn):
+    """
+    Still-pending rows outside this batch that share a key with one of its items
+    (popular products show up in many receipts scanned close together), so one
+    lookup can enrich all of them. At most MAX_COALESCED_ROWS per batch.
+    """
+    keys = {key_fn(i) for i in items}
+    batch_ids = {i['id'] for i in items}
+    eans = sorted({i['ean'] for i in items if _is_gtin(i.get('ean'))})
+    names = sorted({i['product_name'] for i in items if i.get('ean') == 'SEM GTIN' and i.get('product_name')})
+    siblings = {}
+    try:
+        for column, values, extra in (('ean', eans, None), ('product_name', names, 'SEM GTIN')):
+            for chunk in _chunks(values):
+                if len(siblings) >= MAX_COALESCED_ROWS:
+                    break
+                query = supabase.table(table).select('*').eq('enriched', False).in_(column, chunk)
+                if extra:
+                    query = query.eq('ean', extra)
+                rows = query.limit(MAX_COALESCED_ROWS - len(siblings)).execute()
+                for row in rows.data or []:
+                    if row['id'] not in batch_ids and key_fn(row) in keys:
+                        siblings[row['id']] = row
+    except Exception as e:
+        logger.warning(f"Could not load pending rows sharing this batch's keys: {e}")
+    return list(siblings.values())
+
+
+def _group_by_key(items, key_fn):
+    """{key: [rows]} in first-seen order; the first row of each group is its representative."""
+    groups = {}
+    for item in items:
+        groups.setdefault(key_fn(item), []).append(item)
+    return groups
+
+
+def _prefetch_local_matches(items):
+    """
+    Local-registry rows by EAN, and GTINs previously discovered for SEM GTIN
+    names by (name, NCM), for a whole batch in a few in_() queries instead of
+    one query per item.
+    Returns {'registry': {ean: row}, 'discovered': {(name, ncm): row}}, or None
+    if the queries failed (items then fall back to their own queries).
+    """
+    eans = {i['ean'] for i in items if _is_gtin(i.get('ean'))}
+    names = set()
+    if not discovered_index.ready():  # otherwise _resolve_purchase uses the in-memory index
+        names = {i['product_name'] for i in items if i.get('ean') == 'SEM GTIN' and i.get('product_name')}
+    registry, discovered = {}, {}
+    try:
+        for chunk in _chunks(sorted(eans)):
+            rows = supabase.table('unique_products').select('ean, product_name, ncm, image_url') \
+                .in_('ean', chunk).execute()
+            for row in rows.data or []:
+                registry.setdefault(row['ean'], row)
+        for chunk in _chunks(sorted(names)):
+            rows = supabase.table('product_lookup_log').select('original_name, ncm, final_name, gtin') \
+                .in_('original_name', chunk).eq('success', True).not_.is_('gtin', 'null') \
+                .order('created_at', desc=True).execute()
+            for row in rows.data or []:
+                discovered.setdefault((row['original_name'], row['ncm']), row)  # newest first
+    except Exception as e:
+        logger.warning(f"Batched local lookup failed, falling back to per-item queries: {e}")
+        return None
+    return {'registry': registry, 'discovered': discovered}
 
 def process_pending_purchases(worker_id="manual"):
     """Main loop to process pending purchases AND scanned_prices until both queues are empty (One-Shot)"""
@@ -69,11 +162,17 @@ def process_pending_purchases(worker_id="manual"):
 
     finally:
         release_enrichment_lock()
+        remaining = lookup_log_writer.flush()
+        if remaining:
+            logger.warning(f"{remaining} product_lookup_log rows still buffered after the run")
 
 
 def _process_purchases_queue():
     """Process all pending purchases until the queue is empty."""
     logger.info("--- Phase 1: Processing purchases queue ---")
+    loaded = discovered_index.refresh()
+    if discovered_index.ready():
+        logger.info(f"Discovered-GTIN index: {loaded} new log rows, {discovered_index.stats()['entries']} names")
     while True:
         try:
             # Order by created_at so the oldest pending purchases always drain first.
@@ -100,38 +199,70 @@ def _process_purchases_queue():
             
             logger.info(f"Processing batch of {len(pending_items)} purchase items...")
             
-            for item in pending_items:
-                status = enrich_single_purchase(item)
+            # Rows sharing an EAN (or name + NCM) are resolved once and the answer is applied
+            # to every pending row with that key, in this batch or beyond it
+            groups = _group_by_key(pending_items + _pending_siblings('purchases', pending_items, _purchase_key),
+                                   _purchase_key)
+            representatives = [rows[0] for rows in groups.values()]
+            
+            # Local matches for all keys in one go, then the remaining lookups run
+            # concurrently (spread over the Cosmos tokens); writes stay sequential
+            local = _prefetch_local_matches(representatives)
+            resolutions = cosmos_client.map_ordered(lambda item: _resolve_purchase(item, local), representatives)
+            members = [(item, resolved) for rows, resolved in zip(groups.values(), resolutions) for item in rows]
+            if len(members) > len(representatives):
+                logger.info(f"Resolved {len(members)} purchase rows with {len(representatives)} lookups")
+            rate_limited = False
+            
+            # One unique_products write for every resolved item in the batch
+            resolved_rows = [_unique_row_for_purchase(item, resolved)
+                             for item, resolved in members
+                             if resolved['status'] == 'resolved']
+            failed_keys = _write_unique_products(resolved_rows, only_newer=True)
+            
+            updates = []
+            backlog_rows = []
+            for item, resolved in members:
+                status = resolved['status']
+                if status == 'resolved':
+                    failed = (item['market_id'], resolved['ean']) in failed_keys
+                    status = 'failed' if failed else 'completed'
                 
                 if status == 'completed':
-                    supabase.table('purchases').update({
+                    updates.append((item['id'], {
                         'enriched': True,
                         'enrichment_status': 'completed',
                         'enrichment_error': None
-                    }).eq('id', item['id']).execute()
-                    logger.info(f"Successfully enriched purchase {item['id']}")
+                    }))
                 elif status == 'rate_limited':
-                    logger.error("!!! RATE LIMIT REACHED !!! Stopping purchases enrichment.")
-                    return
+                    rate_limited = True  # left pending for the next run
                 elif status in ['backlog', 'failed']:
                     error_msg = item.get('enrichment_error') or ('No GTIN found' if status == 'backlog' else 'Unexpected processing error')
                     
-                    supabase.table('purchases').update({
+                    updates.append((item['id'], {
                         'enriched': True,
                         'enrichment_status': status,
                         'enrichment_error': error_msg
-                    }).eq('id', item['id']).execute()
+                    }))
                     
-                    backlog_data = {
+                    backlog_rows.append({
                         'purchase_id': item['id'],
                         'market_id': item['market_id'],
                         'original_product_name': item['product_name'],
                         'ncm': item['ncm'],
                         'ean': item['ean'],
                         'created_at': _utcnow_iso()
-                    }
-                    supabase.table('product_backlog').insert(backlog_data).execute()
-                    logger.info(f"Purchase {item['id']} moved to backlog (status: {status})")
+                    })
+            
+            # Status updates grouped by status, then one multi-row backlog insert
+            _bulk_update('purchases', updates)
+            if backlog_rows:
+                supabase.table('product_backlog').insert(backlog_rows).execute()
+                logger.info(f"Moved {len(backlog_rows)} purchases to backlog")
+            
+            if rate_limited:
+                logger.error("!!! RATE LIMIT REACHED !!! Stopping purchases enrichment.")
+                return
             
             logger.info(f"Purchases batch done. Sleeping {SLEEP_BETWEEN_BATCHES}s...")
             time.sleep(SLEEP_BETWEEN_BATCHES)
@@ -160,12 +291,20 @@ def _process_scanned_prices_queue():
 
             logger.info(f"Processing batch of {len(pending_items)} scanned price items...")
 
-            for item in pending_items:
-                status = _enrich_single_scan(item)
-
-                if status == 'rate_limited':
-                    logger.error("!!! RATE LIMIT REACHED !!! Stopping scanned_prices enrichment.")
-                    return
+            # One lookup per EAN, applied to every pending scan of it (in this batch or beyond it)
+            groups = _group_by_key(pending_items + _pending_siblings('scanned_prices', pending_items, _scan_key),
+                                   _scan_key)
+            representatives = [rows[0] for rows in groups.values()]
+            local = _prefetch_local_matches(representatives)
+            lookups = cosmos_client.map_ordered(lambda item: _lookup_scan(item, local), representatives)
+            items = [item for rows in groups.values() for item in rows]
+            outcomes = [_scan_outcome(item, lookup)
+                        for rows, lookup in zip(groups.values(), lookups) for item in rows]
+            _apply_scan_outcomes(items, outcomes)
+
+            if any(status == 'rate_limited' for status, _, _ in outcomes):
+                logger.error("!!! RATE LIMIT REACHED !!! Stopping scanned_prices enrichment.")
+                return
 
             logger.info(f"Scanned prices batch done. Sleeping {SLEEP_BETWEEN_BATCHES}s...")
             time.sleep(SLEEP_BETWEEN_BATCHES)
@@ -175,130 +314,158 @@ def _process_scanned_prices_queue():
             time.sleep(30)
 
 
-def _enrich_single_scan(item):
+def _lookup_scan(item, local=None):
     """
-    Enrich a single scanned_prices row via Cosmos API (GTIN lookup).
-    Updates scanned_prices row and upserts into unique_products.
-    Returns: 'completed', 'not_found', 'rate_limited', or 'failed'
+    Resolve a scan's EAN: local registry first, then Cosmos. Runs on the Cosmos
+    thread pool and does not write anything. `local` is the batch's
+    _prefetch_local_matches() result, if any.
+    Returns: dict with 'status' ('invalid', 'local', 'cosmos', 'not_found',
+    'rate_limited' or 'failed') and the product fields found.
     """
-    scan_id = item['id']
     ean = item['ean']
-    market_id = item['market_id']
-    varejo_price = item.get('varejo_price')
-    atacado_price = item.get('atacado_price')
-
     try:
         if not ean or len(ean) < 8:
-            supabase.table('scanned_prices').update({
-                'enriched': True,
-                'enrichment_status': 'not_found',
-                'enrichment_error': 'EAN inválido'
-            }).eq('id', scan_id).execute()
-            _upsert_unique_product_from_scan(item, None, None, None, None)
-            return 'not_found'
+            return {'status': 'invalid'}
 
         # Check local registry first
-        local_match = supabase.table('unique_products').select('product_name, ncm, image_url').eq('ean', ean).limit(1).execute()
-        if local_match.data:
-            row = local_match.data[0]
-            supabase.table('scanned_prices').update({
-                'enriched': True,
-                'enrichment_status': 'completed',
-                'product_name': row['product_name'],
-                'ncm': row.get('ncm'),
-                'image_url': row.get('image_url'),
-            }).eq('id', scan_id).execute()
-            _upsert_unique_product_from_scan(item, row['product_name'], None, row.get('image_url'), row.get('ncm'))
-            logger.info(f"Scan {scan_id}: enriched from local registry for EAN {ean}")
-            return 'completed'
-
-        # Call Cosmos API
-        success, product_name, brand, image_url, time_ms, error = get_product_from_cosmos(ean)
-
-        if error == "TOKENS_EXHAUSTED":
-            return 'rate_limited'
-
-        if success and product_name:
-            supabase.table('scanned_prices').update({
-                'enriched': True,
-                'enrichment_status': 'completed',
-                'product_name': product_name,
-                'brand': brand,
-                'image_url': image_url,
-            }).eq('id', scan_id).execute()
-            _upsert_unique_product_from_scan(item, product_name, brand, image_url, None)
-            logger.info(f"Scan {scan_id}: enriched via Cosmos for EAN {ean} -> {product_name}")
-            return 'completed'
+        if local is not None:
+            row = local['registry'].get(ean)
         else:
-            supabase.table('scanned_prices').update({
-                'enriched': True,
-                'enrichment_status': 'not_found',
-                'enrichment_error': error or 'Produto não encontrado no Cosmos'
-            }).eq('id', scan_id).execute()
-            _upsert_unique_product_from_scan(item, None, None, None, None)
-            logger.info(f"Scan {scan_id}: EAN {ean} not found in Cosmos")
-            return 'not_found'
+            local_match = supabase.table('unique_products').select('product_name, ncm, image_url').eq('ean', ean).limit(1).execute()
+            row = local_match.data[0] if local_match.data else None
+        if row:
+            return {'status': 'local', 'product_name': row['product_name'],
+                    'ncm': row.get('ncm'), 'image_url': row.get('image_url')}
+
+        # Cosmos (through gtin_cache)
+        found = lookup_gtin(ean)
+
+        if found['error'] == "TOKENS_EXHAUSTED":
+            return {'status': 'rate_limited'}
+        if found['success'] and found['product_name']:
+            return {'status': 'cosmos', 'product_name': found['product_name'], 'brand': found['brand'],
+                    'image_url': found['image_url'], 'ncm': found['ncm']}
+        return {'status': 'not_found', 'error': found['error']}
 
     except Exception as e:
-        logger.error(f"Error enriching scan {scan_id}: {e}")
-        try:
-            supabase.table('scanned_prices').update({
-                'enriched': True,
-                'enrichment_status': 'failed',
-                'enrichment_error': str(e)[:200]
-            }).eq('id', scan_id).execute()
-        except Exception:
-            pass
-        return 'failed'
+        return {'status': 'failed', 'error': str(e)}
 
 
-def _upsert_unique_product_from_scan(item, product_name, brand, image_url, ncm):
-    """Upsert a scanned product into unique_products using market_id + ean as the key."""
-    market_id = item['market_id']
+def _scan_outcome(item, lookup):
+    """
+    What enriching a scan writes, from its _lookup_scan() result.
+    Returns: (status, scanned_prices update or None, unique_products row or None);
+    status is 'completed', 'not_found', 'rate_limited', or 'failed'.
+    """
+    scan_id = item['id']
     ean = item['ean']
-    varejo_price = item.get('varejo_price')
-    atacado_price = item.get('atacado_price')
 
-    unique_data = {
-        'market_id': market_id,
-        'ean': ean,
-        'varejo_price': varejo_price,
+    if lookup['status'] == 'rate_limited':
+        return 'rate_limited', None, None
+
+    if lookup['status'] == 'failed':
+        logger.error(f"Error enriching scan {scan_id}: {lookup['error']}")
+        return 'failed', {
+            'enriched': True,
+            'enrichment_status': 'failed',
+            'enrichment_error': str(lookup['error'])[:200]
+        }, None
+
+    if lookup['status'] == 'invalid':
+        return 'not_found', {
+            'enriched': True,
+            'enrichment_status': 'not_found',
+            'enrichment_error': 'EAN inválido'
+        }, _unique_row_from_scan(item, None, None, None)
+
+    if lookup['status'] == 'local':
+        logger.info(f"Scan {scan_id}: enriched from local registry for EAN {ean}")
+        return 'completed', {
+            'enriched': True,
+            'enrichment_status': 'completed',
+            'product_name': lookup['product_name'],
+            'ncm': lookup['ncm'],
+            'image_url': lookup['image_url'],
+        }, _unique_row_from_scan(item, lookup['product_name'], lookup['image_url'], lookup['ncm'])
+
+    if lookup['status'] == 'cosmos':
+        product_name = lookup['product_name']
+        logger.info(f"Scan {scan_id}: enriched via Cosmos for EAN {ean} -> {product_name}")
+        return 'completed', {
+            'enriched': True,
+            'enrichment_status': 'completed',
+            'product_name': product_name,
+            'brand': lookup['brand'],
+            'ncm': lookup['ncm'],
+            'image_url': lookup['image_url'],
+        }, _unique_row_from_scan(item, product_name, lookup['image_url'], lookup['ncm'])
+
+    logger.info(f"Scan {scan_id}: EAN {ean} not found in Cosmos")
+    return 'not_found', {
+        'enriched': True,
+        'enrichment_status': 'not_found',
+        'enrichment_error': lookup.get('error') or 'Produto não encontrado no Cosmos'
+    }, _unique_row_from_scan(item, None, None, None)
+
+
+def _apply_scan_outcomes(items, outcomes):
+    """Write a batch of scan outcomes: one unique_products upsert, grouped status updates."""
+    _write_unique_products([row for _, _, row in outcomes if row], only_newer=False)
+    _bulk_update('scanned_prices', [(item['id'], update) for item, (_, update, _) in zip(items, outcomes) if update])
+
+
+def _enrich_single_scan(item, lookup=None):
+    """
+    Enrich a single scanned_prices row via Cosmos API (GTIN lookup).
+    Updates scanned_prices row and upserts into unique_products.
+    `lookup` is the item's _lookup_scan() result when it was already computed.
+    Returns: 'completed', 'not_found', 'rate_limited', or 'failed'
+    """
+    outcome = _scan_outcome(item, lookup or _lookup_scan(item))
+    _apply_scan_outcomes([item], [outcome])
+    return outcome[0]
+
+
+def _bulk_update(table, updates):
+    """
+    Apply (id, payload) updates with one in_('id', ...) call per distinct
+    payload - usually one per status - instead of one call per row.
+    """
+    groups = {}
+    for row_id, payload in updates:
+        key = tuple(sorted(payload.items(), key=lambda kv: kv[0]))
+        groups.setdefault(key, []).append(row_id)
+    for key, ids in groups.items():
+        for chunk in _chunks(ids):
+            supabase.table(table).update(dict(key)).in_('id', chunk).execute()
+    if updates:
+        logger.info(f"Updated {len(updates)} {table} rows in {len(groups)} call(s)")
+
+
+def _unique_row_from_scan(item, product_name, image_url, ncm):
+    """unique_products row for a scan; unknown fields are None (kept / placeholder on insert)."""
+    return {
+        'market_id': item['market_id'],
+        'ean': item['ean'],
+        'varejo_price': item.get('varejo_price'),
+        'atacado_price': item.get('atacado_price') or None,
         'purchase_date': item.get('scanned_at', _utcnow_iso()),
+        'product_name': product_name or None,
+        'image_url': image_url or None,
+        'ncm': ncm or None,
     }
-    if atacado_price:
-        unique_data['atacado_price'] = atacado_price
-    if product_name:
-        unique_data['product_name'] = product_name
-    if image_url:
-        unique_data['image_url'] = image_url
-    if ncm:
-        unique_data['ncm'] = ncm
 
-    try:
-        existing = supabase.table('unique_products').select('id, price').match({
-            'market_id': market_id,
-            'ean': ean
-        }).execute()
-
-        if existing.data:
-            update_data = {k: v for k, v in unique_data.items() if k != 'market_id' and v is not None}
-            supabase.table('unique_products').update(update_data).eq('id', existing.data[0]['id']).execute()
-            logger.info(f"Updated unique_product {existing.data[0]['id']} with scan data")
-        else:
-            unique_data.setdefault('product_name', f'EAN {ean}')
-            unique_data.setdefault('ncm', '00000000')
-            unique_data.setdefault('unidade_comercial', 'UN')
-            unique_data['price'] = varejo_price
-            unique_data['nfce_url'] = ''
-            supabase.table('unique_products').insert(unique_data).execute()
-            logger.info(f"Inserted new unique_product for EAN {ean} in market {market_id}")
-    except Exception as e:
-        logger.error(f"Failed to upsert unique_product for scan: {e}")
 
-def enrich_single_purchase(item):
+def _resolve_purchase(item, local=None):
     """
-    Perform enrichment for a single purchase item and upsert to unique_products
-    Returns: status string ('completed', 'backlog', 'failed', 'rate_limited')
+    Find the canonical name/GTIN for a purchase item (local registry, lookup log,
+    then Cosmos) and log the lookup. Runs on the Cosmos thread pool, so it does
+    not touch unique_products. `local` is the batch's _prefetch_local_matches()
+    result, if any.
+    Returns: dict with 'status' ('resolved', 'backlog', 'failed', 'rate_limited')
+    and, when resolved, 'canonical_name', 'ean', 'registry_ncm' (the registry's
+    NCM when it has one) and 'cosmos_result'. The result holds for every row
+    with the same _purchase_key().
     """
     market_id = item['market_id']
     original_product_name = item['product_name']
@@ -309,53 +476,59 @@ def enrich_single_purchase(item):
     canonical_name = None
     source_used = None
     cosmos_result = None
+    registry_ncm = None
     is_rate_limited = False
     
     try:
         # --- OPTIMIZATION: LOCAL DATABASE LOOKUP ---
         
         # 1. If we have a GTIN, check if we already enriched it in ANY market before
-        if ean and ean != 'SEM GTIN' and len(ean) >= 8:
+        if _is_gtin(ean):
             # We look for the most recent enrichment for this GTIN
-            local_match = supabase.table('unique_products').select('product_name, ncm').eq('ean', ean).limit(1).execute()
-            if local_match.data:
-                canonical_name = local_match.data[0]['product_name']
-                if local_match.data[0].get('ncm'):
-                    ncm = local_match.data[0]['ncm']
+            if local is not None:
+                registry_row = local['registry'].get(ean)
+            else:
+                local_match = supabase.table('unique_products').select('product_name, ncm').eq('ean', ean).limit(1).execute()
+                registry_row = local_match.data[0] if local_match.data else None
+            if registry_row:
+                canonical_name = registry_row['product_name']
+                if registry_row.get('ncm'):
+                    ncm = registry_ncm = registry_row['ncm']
                 source_used = "LOCAL_REGISTRY"
                 logger.info(f"Reusing local registry data for GTIN {ean}: {canonical_name}")
 
         # 2. If it's a "SEM GTIN", check if we previously found a GTIN for this specific name/NCM
         if not canonical_name and ean == 'SEM GTIN':
-            local_log = supabase.table('product_lookup_log').select('final_name, gtin').match({
-                'original_name': original_product_name,
-                'ncm': ncm,
-                'success': True
-            }).order('created_at', desc=True).limit(1).execute()
+            if discovered_index.ready():
+                discovered = discovered_index.get(original_product_name, ncm)
+                log_row = {'gtin': discovered[0], 'final_name': discovered[1]} if discovered else None
+            elif local is not None:
+                log_row = local['discovered'].get((original_product_name, ncm))
+            else:
+                local_log = supabase.table('product_lookup_log').select('final_name, gtin').match({
+                    'original_name': original_product_name,
+                    'ncm': ncm,
+                    'success': True
+                }).order('created_at', desc=True).limit(1).execute()
+                log_row = local_log.data[0] if local_log.data else None
             
-            if local_log.data and local_log.data[0].get('gtin'):
-                canonical_name = local_log.data[0]['final_name']
-                ean = local_log.data[0]['gtin']
+            if log_row and log_row.get('gtin'):
+                canonical_name = log_row['final_name']
+                ean = log_row['gtin']
                 source_used = "LOCAL_LOG"
                 logger.info(f"Reusing discovered GTIN {ean} from logs for '{original_product_name}'")
 
         # --- EXTERNAL API LOOKUP (Only if local lookup failed) ---
         
         # STEP 1: Bluesoft Cosmos (Direct GTIN lookup)
-        if not canonical_name and ean and ean != 'SEM GTIN' and len(ean) >= 8:
-            cosmos_success, cosmos_product_name, cosmos_brand, cosmos_image, cosmos_time, cosmos_error = get_product_from_cosmos(ean)
-            
-            cosmos_result = {
-                'success': cosmos_success, 'product_name': cosmos_product_name,
-                'brand': cosmos_brand, 'image_url': cosmos_image, 
-                'time_ms': cosmos_time, 'error': cosmos_error
-            }
+        if not canonical_name and _is_gtin(ean):
+            cosmos_result = lookup_gtin(ean)  # gtin_cache first, then the API
             
-            if cosmos_error == "TOKENS_EXHAUSTED":
+            if cosmos_result['error'] == "TOKENS_EXHAUSTED":
                 is_rate_limited = True
             
-            if cosmos_success and cosmos_product_name:
-                canonical_name = cosmos_product_name
+            if cosmos_result['success'] and cosmos_result['product_name']:
+                canonical_name = cosmos_result['product_name']
                 source_used = "COSMOS_BLUE"
         
         # STEP 2: Bluesoft Cosmos (Search by Name + NCM filter)
@@ -391,7 +564,7 @@ def enrich_single_purchase(item):
                     }
 
         if is_rate_limited:
-            return 'rate_limited'
+            return {'status': 'rate_limited'}
         
         # Log lookup
         log_product_lookup(
@@ -400,75 +573,182 @@ def enrich_single_purchase(item):
             cosmos_result=cosmos_result,
             source_used=source_used, success=canonical_name is not None
         )
+        if canonical_name and _is_gtin(ean):
+            discovered_index.record(original_product_name, ncm, ean, canonical_name)
         
         # STEP 3: Handle Fallback to Backlog
         if not canonical_name:
             logger.info(f"No GTIN found for '{original_product_name}'. Moving to backlog.")
-            return 'backlog'
-            
-        # STEP 4: Deterministic Upsert to unique_products (Market + GTIN)
-        # Use the real purchase_date from the receipt instead of server processing time
-        item_purchase_date = item.get('purchase_date')
-        if isinstance(item_purchase_date, str):
-            item_purchase_date_iso = item_purchase_date
-        elif item_purchase_date:
-            item_purchase_date_iso = item_purchase_date.isoformat()
-        else:
-            item_purchase_date_iso = _utcnow_iso()
-
-        unique_data = {
-            'market_id': market_id,
-            'ncm': ncm,
-            'ean': ean,
-            'product_name': canonical_name,
-            'unidade_comercial': item.get('unidade_comercial', 'UN'),
-            'price': item.get('unit_price', 0),
-            'nfce_url': nfce_url,
-            'purchase_date': item_purchase_date_iso,
+            return {'status': 'backlog'}
+
+        return {
+            'status': 'resolved', 'canonical_name': canonical_name,
+            'ean': ean, 'registry_ncm': registry_ncm, 'cosmos_result': cosmos_result,
         }
         
-        if cosmos_result and cosmos_result.get('image_url'):
-            unique_data['image_url'] = cosmos_result['image_url']
-        
-        existing = supabase.table('unique_products').select('id, purchase_date').match({
-            'market_id': market_id,
-            'ean': ean
-        }).execute()
-        
-        if existing.data:
-            existing_purchase_date = existing.data[0].get('purchase_date')
-            should_update = True
-
-            if existing_purchase_date and item_purchase_date_iso:
-                try:
-                    existing_dt = _parse_iso_date(existing_purchase_date)
-                    new_dt = _parse_iso_date(item_purchase_date_iso)
-                    should_update = new_dt >= existing_dt
-                except Exception as cmp_err:
-                    logger.warning(f"Could not compare dates, updating anyway: {cmp_err}")
-
-            if should_update:
-                try:
-                    supabase.table('unique_products').update(unique_data).eq('id', existing.data[0]['id']).execute()
-                except Exception as e:
-                    logger.error(f"Failed to update product {existing.data[0]['id']}: {e}")
-                    raise e
-                logger.info(f"Updated product {existing.data[0]['id']} in market {market_id} (purchase_date: {item_purchase_date_iso})")
-            else:
-                logger.info(f"Skipped product {existing.data[0]['id']} — existing record has a newer purchase_date ({existing_purchase_date})")
-        else:
-            try:
-                supabase.table('unique_products').insert(unique_data).execute()
-            except Exception as e:
-                logger.error(f"Failed to insert product with EAN {ean}: {e}")
-                raise e
-            logger.info(f"Inserted new product with GTIN {ean} in market {market_id}")
-            
+    except Exception as e:
+        logger.error(f"Error enriching item {item['id']}: {e}")
+        return {'status': 'failed'}
+
+
+def _unique_row_for_purchase(item, resolved):
+    """unique_products row (Market + GTIN) for a resolved purchase item."""
+    # Use the real purchase_date from the receipt instead of server processing time
+    item_purchase_date = item.get('purchase_date')
+    if isinstance(item_purchase_date, str):
+        item_purchase_date_iso = item_purchase_date
+    elif item_purchase_date:
+        item_purchase_date_iso = item_purchase_date.isoformat()
+    else:
+        item_purchase_date_iso = _utcnow_iso()
+
+    cosmos_result = resolved['cosmos_result']
+    return {
+        'market_id': item['market_id'],
+        'ncm': resolved['registry_ncm'] or item['ncm'],
+        'ean': resolved['ean'],
+        'product_name': resolved['canonical_name'],
+        'unidade_comercial': item.get('unidade_comercial', 'UN'),
+        'price': item.get('unit_price', 0),
+        'nfce_url': item['nfce_url'],
+        'purchase_date': item_purchase_date_iso,
+        'image_url': (cosmos_result or {}).get('image_url'),
+    }
+
+
+def enrich_single_purchase(item, resolved=None):
+    """
+    Perform enrichment for a single purchase item and upsert to unique_products.
+    `resolved` is the item's _resolve_purchase() result when it was already computed.
+    Returns: status string ('completed', 'backlog', 'failed', 'rate_limited')
+    """
+    if resolved is None:
+        resolved = _resolve_purchase(item)
+    if resolved['status'] != 'resolved':
+        return resolved['status']
+
+    try:
+        _upsert_unique_products([_unique_row_for_purchase(item, resolved)], only_newer=True)
         return 'completed'
-        
     except Exception as e:
         logger.error(f"Error enriching item {item['id']}: {e}")
         return 'failed'
 
+
+# Batched unique_products writes (migration_unique_products_upsert.sql)
+_upsert_rpc_available = True
+
+
+def _merge_by_key(rows, only_newer):
+    """
+    One row per (market_id, ean), as applying the rows one by one would leave it:
+    with only_newer the row with the newest purchase_date wins (later rows win
+    ties), otherwise later non-null fields override earlier ones.
+    """
+    merged = {}
+    for row in rows:
+        key = (row['market_id'], row['ean'])
+        current = merged.get(key)
+        if current is None:
+            merged[key] = dict(row)
+        elif only_newer:
+            try:
+                newer = _parse_iso_date(row['purchase_date']) >= _parse_iso_date(current['purchase_date'])
+            except Exception:
+                newer = True
+            if newer:
+                merged[key] = {**current, **{k: v for k, v in row.items() if v is not None}}
+        else:
+            current.update({k: v for k, v in row.items() if v is not None})
+    return list(merged.values())
+
+
+def _upsert_unique_products(rows, only_newer):
+    """
+    Insert or update unique_products rows keyed by (market_id, ean) in one call.
+    Null fields keep the stored value; with only_newer an existing row is only
+    overwritten by a purchase_date that is not older (receipts), scans always
+    overwrite. Raises if the write fails.
+    """
+    global _upsert_rpc_available
+    rows = _merge_by_key(rows, only_newer)
+    if not rows:
+        return
+    if _upsert_rpc_available:
+        try:
+            written = supabase.rpc('upsert_unique_products', {
+                'p_rows': rows, 'p_only_newer': only_newer,
+            }).execute().data
+            logger.info(f"Upserted {written} of {len(rows)} unique_products rows")
+            return
+        except Exception as e:
+            text = str(e)
+            if 'PGRST202' not in text and 'Could not find the function' not in text:
+                raise
+            _upsert_rpc_available = False
+            logger.warning("upsert_unique_products not deployed - using per-row fallback "
+                           "(run migration_unique_products_upsert.sql)")
+    for row in rows:
+        _upsert_unique_product_fallback(row, only_newer)
+
+
+def _write_unique_products(rows, only_newer):
+    """
+    _upsert_unique_products() for a batch. If the batched write fails, each
+    (market_id, ean) is written on its own, so one bad row or a transient error
+    doesn't fail the whole batch. Returns the keys that still failed.
+    """
+    try:
+        _upsert_unique_products(rows, only_newer)
+        return set()
+    except Exception as e:
+        if len(rows) <= 1:
+            logger.error(f"Failed to upsert unique_products row: {e}")
+            return {(row['market_id'], row['ean']) for row in rows}
+        logger.warning(f"Batched upsert of {len(rows)} unique_products rows failed, retrying per product: {e}")
+
+    by_key = {}
+    for row in rows:
+        by_key.setdefault((row['market_id'], row['ean']), []).append(row)
+    failed = set()
+    for key, key_rows in by_key.items():
+        try:
+            _upsert_unique_products(key_rows, only_newer)
+        except Exception as e:
+            logger.error(f"Failed to upsert unique_products {key}: {e}")
+            failed.add(key)
+    return failed
+
+
+def _upsert_unique_product_fallback(row, only_newer):
+    """Per-row select + update/insert equivalent of the upsert_unique_products RPC."""
+    market_id, ean = row['market_id'], row['ean']
+    existing = supabase.table('unique_products').select('id, purchase_date').match({
+        'market_id': market_id,
+        'ean': ean
+    }).execute()
+
+    if existing.data:
+        existing_purchase_date = existing.data[0].get('purchase_date')
+        if only_newer and existing_purchase_date and row.get('purchase_date'):
+            try:
+                if _parse_iso_date(row['purchase_date']) < _parse_iso_date(existing_purchase_date):
+                    logger.info(f"Skipped product {existing.data[0]['id']} — existing record has a newer purchase_date ({existing_purchase_date})")
+                    return
+            except Exception as cmp_err:
+                logger.warning(f"Could not compare dates, updating anyway: {cmp_err}")
+        update_data = {k: v for k, v in row.items() if k != 'market_id' and v is not None}
+        supabase.table('unique_products').update(update_data).eq('id', existing.data[0]['id']).execute()
+        logger.info(f"Updated product {existing.data[0]['id']} in market {market_id}")
+    else:
+        insert_data = {k: v for k, v in row.items() if v is not None}
+        insert_data.setdefault('product_name', f'EAN {ean}')
+        insert_data.setdefault('ncm', '00000000')
+        insert_data.setdefault('unidade_comercial', 'UN')
+        insert_data.setdefault('price', row.get('varejo_price') or 0)
+        insert_data.setdefault('nfce_url', '')
+        supabase.table('unique_products').insert(insert_data).execute()
+        logger.info(f"Inserted new product with GTIN {ean} in market {market_id}")
+
 if __name__ == "__main__":
     process_pending_purchases("manual")
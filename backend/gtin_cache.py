@@ -0,0 +1,121 @@
+"""
+Two-level cache for Cosmos GTIN lookups.
+
+An in-process LRU (MEMORY_MAX_ENTRIES) sits in front of the gtin_cache table
+(migration_gtin_cache.sql), which every worker and instance shares. Products
+Cosmos knows are kept for COSMOS_CACHE_TTL_DAYS; 404s are kept too (negative
+caching), for the shorter COSMOS_CACHE_NOT_FOUND_TTL_HOURS, since Cosmos does
+add products over time. Only definitive answers are cached; rate limits and
+network or server errors never are.
+
+Until the migration is applied, the table calls fail and the memory layer
+alone is used.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from supabase_client import supabase
+
+FOUND_TTL_SECONDS = float(os.getenv('COSMOS_CACHE_TTL_DAYS', '30')) * 86400
+NOT_FOUND_TTL_SECONDS = float(os.getenv('COSMOS_CACHE_NOT_FOUND_TTL_HOURS', '24')) * 3600
+MEMORY_MAX_ENTRIES = 10000
+
+_lock = threading.Lock()
+_memory = OrderedDict()  # gtin -> (entry, expires_at epoch seconds)
+_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0, 'db_errors': 0}
+_db_warned = False
+
+
+def _remember(gtin, entry, expires_at):
+    with _lock:
+        _memory[gtin] = (entry, expires_at)
+        _memory.move_to_end(gtin)
+        while len(_memory) > MEMORY_MAX_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def _db_failed(action, error):
+    global _db_warned
+    with _lock:
+        _stats['db_errors'] += 1
+        warn = not _db_warned
+        _db_warned = True
+    if warn:
+        print(f"  [GTIN-CACHE] Could not {action} gtin_cache (is migration_gtin_cache.sql applied?): {error}")
+
+
+def get(gtin: str):
+    """
+    Cached lookup result for a GTIN, or None on a miss. Entries are dicts with
+    'found' and, when found, 'product_name', 'brand', 'image_url' and 'ncm'.
+    """
+    now = time.time()
+    with _lock:
+        cached = _memory.get(gtin)
+        if cached and cached[1] > now:
+            _memory.move_to_end(gtin)
+            _stats['memory_hits'] += 1
+            return cached[0]
+        if cached:
+            del _memory[gtin]
+
+    try:
+        result = supabase.table('gtin_cache') \
+            .select('found, product_name, brand, image_url, ncm, expires_at') \
+            .eq('gtin', gtin) \
+            .gt('expires_at', datetime.now(timezone.utc).isoformat()) \
+            .limit(1).execute()
+    except Exception as e:
+        _db_failed('read', e)
+        result = None
+
+    if result and result.data:
+        row = result.data[0]
+        expires_at = row.pop('expires_at')
+        try:
+            expires_epoch = datetime.fromisoformat(expires_at.replace('Z', '+00:00')).timestamp()
+        except (AttributeError, ValueError):
+            expires_epoch = now + NOT_FOUND_TTL_SECONDS
+        _remember(gtin, row, expires_epoch)
+        with _lock:
+            _stats['db_hits'] += 1
+        return row
+
+    with _lock:
+        _stats['misses'] += 1
+    return None
+
+
+def put(gtin: str, found: bool, product_name=None, brand=None, image_url=None, ncm=None):
+    """Store a definitive Cosmos answer (200 or 404) in both layers."""
+    ttl = FOUND_TTL_SECONDS if found else NOT_FOUND_TTL_SECONDS
+    entry = {'found': found, 'product_name': product_name, 'brand': brand,
+             'image_url': image_url, 'ncm': ncm}
+    now = datetime.now(timezone.utc)
+    _remember(gtin, entry, time.time() + ttl)
+    with _lock:
+        _stats['stores'] += 1
+    try:
+        supabase.table('gtin_cache').upsert({
+            'gtin': gtin,
+            **entry,
+            'fetched_at': now.isoformat(),
+            'expires_at': (now + timedelta(seconds=ttl)).isoformat(),
+        }, on_conflict='gtin').execute()
+    except Exception as e:
+        _db_failed('write', e)
+
+
+def stats() -> dict:
+    with _lock:
+        lookups = _stats['memory_hits'] + _stats['db_hits'] + _stats['misses']
+        hits = _stats['memory_hits'] + _stats['db_hits']
+        return {
+            **_stats,
+            'memory_entries': len(_memory),
+            'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+        }
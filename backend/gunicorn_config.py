@@ -16,6 +16,9 @@ worker_connections = 1000
 max_requests = 1000
 max_requests_jitter = 100
 timeout = 120  # Increased for Playwright scraping operations
+# Time a worker gets to exit after SIGTERM. Must exceed NFCE_SHUTDOWN_DRAIN_SECONDS
+# so worker_exit can hand off the in-flight extraction before the SIGKILL.
+graceful_timeout = 30
 keepalive = 5
 
 # Logging
@@ -48,10 +51,34 @@ def post_fork(server, worker):
     """
     Reset task queue after Gunicorn fork.
     With preload_app=True, module-level code runs in the master process.
-    Threads don't survive fork(), so the consumer thread must be re-created
-    and orphaned tasks re-enqueued in each worker.
+    Threads don't survive fork(), so the consumer thread must be re-created in
+    each worker. Every worker asks for the orphan sweep, but a lease in
+    system_locks lets only one of them run it; the recovered jobs are then
+    pulled from processed_urls by whichever consumer is idle.
     """
+    import cosmos_client
+    import enrichment_trigger
+    import lookup_log_writer
+    import nfce_spool
     import task_queue
     task_queue.reset_after_fork()
     task_queue.recover_orphaned_tasks()
+    nfce_spool.reset_after_fork()
+    nfce_spool.start()  # no-op unless NFCE_SPOOL_PATH is set; drains leftovers from earlier workers
+    cosmos_client.reset_after_fork()
+    lookup_log_writer.reset_after_fork()
+    enrichment_trigger.reset_after_fork()
 
+
+
+def worker_exit(server, worker):
+    """
+    Drain the NFCe task queue when a worker exits (max_requests recycle, deploy).
+    Lets the in-flight extraction finish within NFCE_SHUTDOWN_DRAIN_SECONDS and
+    hands jobs that never started to the next worker (still-running ones are
+    reclaimed by the orphan sweep), then writes any buffered product_lookup_log rows.
+    """
+    import lookup_log_writer
+    import task_queue
+    task_queue.shutdown()
+    lookup_log_writer.flush(timeout=5)
@@ -0,0 +1,167 @@
+"""
+Buffered, asynchronous writer for product_lookup_log.
+
+log_product_lookup() used to insert one audit row per enriched item, inside
+the enrichment critical path. Rows now go into an in-memory buffer and a
+background thread writes them with multi-row inserts, as soon as
+LOOKUP_LOG_BATCH_SIZE rows are waiting or LOOKUP_LOG_FLUSH_MS after the oldest
+one arrived.
+
+The buffer holds at most LOOKUP_LOG_BUFFER_SIZE rows. When it is full,
+LOOKUP_LOG_FULL_POLICY decides: "drop" (default) discards the new row, "block"
+makes the caller wait up to BLOCK_TIMEOUT_SECONDS for room before dropping it.
+A failed insert goes back to the front of the buffer and is retried with
+backoff, up to MAX_ATTEMPTS times.
+
+flush() writes everything still buffered from the calling thread; the
+enrichment worker calls it at the end of a run and Gunicorn's worker_exit on
+shutdown. Rows still buffered when a process dies without either are lost,
+which is acceptable for an audit log.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+BATCH_SIZE = max(1, int(os.getenv('LOOKUP_LOG_BATCH_SIZE', '50')))
+FLUSH_INTERVAL_SECONDS = float(os.getenv('LOOKUP_LOG_FLUSH_MS', '1000')) / 1000
+BUFFER_SIZE = max(BATCH_SIZE, int(os.getenv('LOOKUP_LOG_BUFFER_SIZE', '5000')))
+FULL_POLICY = os.getenv('LOOKUP_LOG_FULL_POLICY', 'drop').lower()
+BLOCK_TIMEOUT_SECONDS = 5
+MAX_ATTEMPTS = 5
+MAX_BACKOFF_SECONDS = 30
+
+_cond = threading.Condition()
+_buffer = deque()  # (row, attempts)
+_oldest_at = None  # monotonic time the oldest buffered row arrived
+_write_lock = threading.Lock()  # one insert at a time (flusher thread or flush())
+_flusher_started = False
+_stats = {'queued': 0, 'written': 0, 'dropped': 0, 'blocked': 0, 'failed_inserts': 0}
+
+
+def enqueue(row: dict) -> bool:
+    """Buffer a log row for the background writer. Returns False if it was dropped."""
+    global _oldest_at
+    _start()
+    with _cond:
+        if len(_buffer) >= BUFFER_SIZE and FULL_POLICY == 'block':
+            _stats['blocked'] += 1
+            _cond.wait_for(lambda: len(_buffer) < BUFFER_SIZE, BLOCK_TIMEOUT_SECONDS)
+        if len(_buffer) >= BUFFER_SIZE:
+            _stats['dropped'] += 1
+            if _stats['dropped'] == 1 or _stats['dropped'] % 1000 == 0:
+                print(f"  [LOOKUP-LOG] Buffer full ({BUFFER_SIZE} rows), dropped {_stats['dropped']} rows so far")
+            return False
+        if not _buffer:
+            _oldest_at = time.monotonic()
+        _buffer.append((row, 0))
+        _stats['queued'] += 1
+        if len(_buffer) == 1 or len(_buffer) >= BATCH_SIZE:
+            _cond.notify_all()  # start the flush timer / flush now
+    return True
+
+
+def _take(limit):
+    """Pop up to `limit` buffered rows (caller holds _cond)."""
+    global _oldest_at
+    batch = [_buffer.popleft() for _ in range(min(limit, len(_buffer)))]
+    _oldest_at = time.monotonic() if _buffer else None
+    _cond.notify_all()  # room for blocked producers
+    return batch
+
+
+def _write(batch) -> bool:
+    """Insert a batch; on failure put it back (minus rows out of attempts). Returns success."""
+    global _oldest_at
+    from supabase_client import supabase
+
+    # A multi-row insert needs the same columns in every row
+    by_columns = {}
+    for row, attempts in batch:
+        by_columns.setdefault(tuple(sorted(row)), []).append((row, attempts))
+    failed = []
+    error = None
+    with _write_lock:
+        for group in by_columns.values():
+            try:
+                supabase.table('product_lookup_log').insert([row for row, _ in group]).execute()
+                with _cond:
+                    _stats['written'] += len(group)
+            except Exception as e:
+                error = e
+                failed.extend(group)
+    if not failed:
+        return True
+
+    retry = [(row, attempts + 1) for row, attempts in failed if attempts + 1 < MAX_ATTEMPTS]
+    with _cond:
+        _stats['failed_inserts'] += 1
+        _stats['dropped'] += len(failed) - len(retry)
+        room = max(0, BUFFER_SIZE - len(_buffer))
+        _stats['dropped'] += max(0, len(retry) - room)
+        _buffer.extendleft(reversed(retry[:room]))
+        if _buffer and _oldest_at is None:
+            _oldest_at = time.monotonic()
+    print(f"  [WARN] Failed to log {len(failed)} product lookups ({len(retry)} will be retried): {error}")
+    return False
+
+
+def _due(now) -> bool:
+    return len(_buffer) >= BATCH_SIZE or (_oldest_at is not None and now - _oldest_at >= FLUSH_INTERVAL_SECONDS)
+
+
+def _flusher_loop():
+    backoff = 0.0
+    while True:
+        with _cond:
+            while not _due(time.monotonic()):
+                timeout = FLUSH_INTERVAL_SECONDS
+                if _oldest_at is not None:
+                    timeout = max(0.0, _oldest_at + FLUSH_INTERVAL_SECONDS - time.monotonic())
+                _cond.wait(timeout if _buffer else None)
+            batch = _take(BATCH_SIZE)
+        if _write(batch):
+            backoff = 0.0
+        else:
+            backoff = min(MAX_BACKOFF_SECONDS, max(FLUSH_INTERVAL_SECONDS, backoff * 2))
+            time.sleep(backoff)
+
+
+def _start():
+    global _flusher_started
+    if _flusher_started:
+        return
+    with _cond:
+        if _flusher_started:
+            return
+        threading.Thread(target=_flusher_loop, name='lookup-log', daemon=True).start()
+        _flusher_started = True
+
+
+def flush(timeout: float = 10.0) -> int:
+    """Write every buffered row from the calling thread, giving up after `timeout`
+    seconds or when an insert fails. Returns the number of rows still buffered."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with _cond:
+            batch = _take(BATCH_SIZE)
+        if not batch or not _write(batch):
+            break
+    with _cond:
+        return len(_buffer)
+
+
+def stats() -> dict:
+    with _cond:
+        return {**_stats, 'buffered': len(_buffer), 'buffer_size': BUFFER_SIZE, 'policy': FULL_POLICY}
+
+
+def reset_after_fork():
+    """Threads don't survive fork(); rows buffered in the parent belong to the parent."""
+    global _cond, _buffer, _oldest_at, _write_lock, _flusher_started
+    _cond = threading.Condition()
+    _buffer = deque()
+    _oldest_at = None
+    _write_lock = threading.Lock()
+    _flusher_started = False
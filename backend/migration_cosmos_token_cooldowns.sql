@@ -0,0 +1,13 @@
+-- Migration: Cosmos token cooldowns shared across workers and restarts
+-- Run this in the Supabase SQL Editor
+--
+-- One row per Cosmos token, keyed by the first 16 hex digits of its SHA-256
+-- (the token itself is never stored). cosmos_client.py writes cooldown_until
+-- when a token answers 429 (from Retry-After / X-RateLimit-Reset, or one hour)
+-- or reports no quota left, and every process skips the token until then.
+
+CREATE TABLE IF NOT EXISTS cosmos_token_cooldowns (
+    token_id VARCHAR(16) PRIMARY KEY,
+    cooldown_until TIMESTAMPTZ NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
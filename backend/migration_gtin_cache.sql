@@ -0,0 +1,21 @@
+-- Migration: Shared cache of Bluesoft Cosmos GTIN lookups
+-- Run this in the Supabase SQL Editor
+--
+-- One row per GTIN. found = false records a Cosmos 404 (negative cache).
+-- expires_at is set by gtin_cache.py: COSMOS_CACHE_TTL_DAYS for products,
+-- COSMOS_CACHE_NOT_FOUND_TTL_HOURS for 404s. Expired rows are simply
+-- overwritten on the next lookup.
+
+CREATE TABLE IF NOT EXISTS gtin_cache (
+    gtin VARCHAR(50) PRIMARY KEY,
+    found BOOLEAN NOT NULL,
+    product_name VARCHAR(500),
+    brand VARCHAR(200),
+    image_url TEXT,
+    ncm VARCHAR(8),
+    fetched_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+-- Optional housekeeping
+CREATE INDEX IF NOT EXISTS idx_gtin_cache_expires_at ON gtin_cache(expires_at);
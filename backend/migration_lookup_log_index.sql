@@ -0,0 +1,14 @@
+-- Migration: Index for GTINs discovered by name search
+-- Run this in the Supabase SQL Editor
+--
+-- The enrichment worker reads successful product_lookup_log rows with a GTIN,
+-- either paged by id (discovered_index.py) or by original_name + ncm, newest
+-- first (per-item fallback). Only those rows are indexed.
+
+CREATE INDEX IF NOT EXISTS idx_product_lookup_log_discovered
+    ON product_lookup_log (original_name, ncm, created_at DESC)
+    WHERE success AND gtin IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_product_lookup_log_discovered_id
+    ON product_lookup_log (id)
+    WHERE success AND gtin IS NOT NULL;
@@ -0,0 +1,14 @@
+-- Migration: Priority lanes for NFCe jobs
+-- Run this in the Supabase SQL Editor (after migration_nfce_retry.sql)
+--
+-- lane  'interactive' (scanned in the apps, served first) or 'batch'
+--       (bulk imports / re-processing, reserved share only; see nfce_lanes.py)
+
+ALTER TABLE processed_urls
+    ADD COLUMN IF NOT EXISTS lane VARCHAR(20) NOT NULL DEFAULT 'interactive'
+    CHECK (lane IN ('interactive', 'batch'));
+
+-- The queue pull reads due rows per lane
+DROP INDEX IF EXISTS idx_processed_urls_next_attempt;
+CREATE INDEX IF NOT EXISTS idx_processed_urls_lane_next_attempt
+    ON processed_urls(lane, next_attempt_at) WHERE status = 'queued';
@@ -0,0 +1,12 @@
+-- Migration: Heartbeat leases for claimed NFCe jobs
+-- Run this in the Supabase SQL Editor (after migration_nfce_retry.sql)
+--
+-- lease_expires_at  renewed every few seconds by the process working on a
+--                   'processing'/'extracting' row (nfce_lease.py); once it is
+--                   in the past the job is treated as orphaned
+
+ALTER TABLE processed_urls
+    ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_processed_urls_lease
+    ON processed_urls(lease_expires_at) WHERE status IN ('processing', 'extracting');
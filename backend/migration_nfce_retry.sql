@@ -0,0 +1,15 @@
+-- Migration: Retry scheduling for NFCe extraction jobs
+-- Run this in the Supabase SQL Editor
+--
+-- attempts          number of extraction attempts made so far
+-- next_attempt_at   when a rescheduled ('queued') job becomes runnable again
+-- last_error_class  classification of the last failure (see nfce_retry.py)
+-- status 'dead'     dead-letter: retries exhausted, kept for inspection
+
+ALTER TABLE processed_urls
+    ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS last_error_class VARCHAR(50);
+
+CREATE INDEX IF NOT EXISTS idx_processed_urls_next_attempt
+    ON processed_urls(next_attempt_at) WHERE status = 'queued';
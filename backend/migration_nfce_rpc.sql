@@ -0,0 +1,140 @@
+-- Migration: Server-side functions for the NFCe job hot path
+-- Run this in the Supabase SQL Editor (after migration_nfce_retry.sql)
+--
+-- nfce_claim_and_resolve  claim + resolved URL update + original_url backfill
+--                         + post-resolve duplicate check, in one call
+-- nfce_persist_receipt    market upsert + purchases insert + success release,
+--                         in one transaction (no partial writes)
+--
+-- app.py falls back to the equivalent multi-request path while these
+-- functions are not deployed.
+
+CREATE OR REPLACE FUNCTION public.nfce_claim_and_resolve(
+    p_record_id BIGINT,
+    p_original_url TEXT,
+    p_resolved_url TEXT
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SET search_path = public
+AS $$
+DECLARE
+    v_attempts INTEGER;
+BEGIN
+    -- Atomic claim: only proceed if still 'queued'
+    UPDATE processed_urls
+       SET status = 'processing',
+           next_attempt_at = NULL,
+           processed_at = NOW(),
+           original_url = COALESCE(original_url, p_original_url)
+     WHERE id = p_record_id
+       AND status = 'queued'
+    RETURNING attempts INTO v_attempts;
+
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('outcome', 'already_claimed');
+    END IF;
+
+    -- Another record already owns the resolved URL (nfce_url is UNIQUE)
+    IF p_resolved_url IS DISTINCT FROM p_original_url THEN
+        BEGIN
+            UPDATE processed_urls SET nfce_url = p_resolved_url WHERE id = p_record_id;
+        EXCEPTION WHEN unique_violation THEN
+            UPDATE processed_urls
+               SET status = 'error',
+                   market_id = 'UNRESOLVED',
+                   error_message = 'Duplicado (URL resolvida já existe no banco)'
+             WHERE id = p_record_id;
+            RETURN jsonb_build_object('outcome', 'duplicate', 'attempts', v_attempts);
+        END;
+    END IF;
+
+    -- Post-resolve duplicate check (two different QR URLs can resolve to the same page)
+    IF EXISTS (
+        SELECT 1 FROM processed_urls
+         WHERE id <> p_record_id
+           AND status IN ('success', 'processing', 'extracting', 'queued')
+           AND (original_url = p_resolved_url OR nfce_url = p_resolved_url)
+    ) THEN
+        UPDATE processed_urls
+           SET status = 'error',
+               market_id = 'UNRESOLVED',
+               error_message = 'Duplicado (URL já em processamento ou processada)'
+         WHERE id = p_record_id;
+        RETURN jsonb_build_object('outcome', 'duplicate', 'attempts', v_attempts);
+    END IF;
+
+    RETURN jsonb_build_object('outcome', 'claimed', 'attempts', v_attempts);
+END;
+$$;
+
+
+-- p_purchase_date is TIMESTAMP (no TZ) on purpose: purchases.purchase_date is
+-- TIMESTAMP and the receipt's local emission time is stored as-is.
+CREATE OR REPLACE FUNCTION public.nfce_persist_receipt(
+    p_record_id BIGINT,
+    p_market_id TEXT,
+    p_market_name TEXT,
+    p_market_address TEXT,
+    p_nfce_url TEXT,
+    p_purchase_date TIMESTAMP,
+    p_products JSONB
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SET search_path = public
+AS $$
+DECLARE
+    v_market markets%ROWTYPE;
+    v_count INTEGER;
+BEGIN
+    INSERT INTO markets (market_id, name, address)
+    VALUES (p_market_id, p_market_name, p_market_address)
+    ON CONFLICT (market_id) DO NOTHING;
+
+    SELECT * INTO v_market FROM markets WHERE market_id = p_market_id;
+
+    -- Release first: if the row is no longer ours (handed off on shutdown and
+    -- reclaimed elsewhere) nothing is written, so purchases are never duplicated
+    UPDATE processed_urls
+       SET status = 'success',
+           market_id = v_market.market_id,
+           market_name = v_market.name,
+           products_count = jsonb_array_length(p_products)
+     WHERE id = p_record_id
+       AND status IN ('processing', 'extracting');
+
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('outcome', 'lost_claim');
+    END IF;
+
+    INSERT INTO purchases (
+        market_id, ncm, ean, product_name, quantity, unidade_comercial,
+        total_price, unit_price, nfce_url, purchase_date, enriched, enrichment_status
+    )
+    SELECT v_market.market_id,
+           p.ncm,
+           COALESCE(p.ean, 'SEM GTIN'),
+           COALESCE(p.product, ''),
+           COALESCE(p.quantity, 0),
+           COALESCE(p.unidade_comercial, 'UN'),
+           COALESCE(p.total_price, 0),
+           COALESCE(p.unit_price, 0),
+           p_nfce_url,
+           COALESCE(p_purchase_date, NOW()),
+           false,
+           'pending'
+      FROM jsonb_to_recordset(p_products) AS p(
+           ncm TEXT, ean TEXT, product TEXT, quantity FLOAT,
+           unidade_comercial TEXT, total_price FLOAT, unit_price FLOAT
+      );
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+
+    RETURN jsonb_build_object(
+        'outcome', 'saved',
+        'market_id', v_market.market_id,
+        'market_name', v_market.name,
+        'products_count', v_count
+    );
+END;
+$$;
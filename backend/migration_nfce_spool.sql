@@ -0,0 +1,12 @@
+-- Migration: Idempotent flushes from the local submission spool
+-- Run this in the Supabase SQL Editor (only needed when NFCE_SPOOL_PATH is set)
+--
+-- submission_id  provisional id handed to the client by nfce_spool.py; the
+--                flusher upserts on it, so a retried flush never creates a
+--                second row, and status lookups map provisional ids through it
+
+ALTER TABLE processed_urls
+    ADD COLUMN IF NOT EXISTS submission_id BIGINT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_processed_urls_submission_id
+    ON processed_urls(submission_id);
@@ -0,0 +1,105 @@
+-- Migration: One unique_products row per (market_id, ean) + batched upsert
+-- Run this in the Supabase SQL Editor (after migration_scanned_prices.sql)
+--
+-- upsert_unique_products(p_rows, p_only_newer)
+--   Inserts or updates a batch of rows in one statement. A field a row leaves
+--   null keeps its stored value (new rows get the usual placeholders). With
+--   p_only_newer an existing row is only overwritten when the incoming
+--   purchase_date is not older than the stored one, or none is stored (receipt enrichment);
+--   scans pass false and always overwrite. Returns the number of rows written.
+--   p_rows must not contain the same (market_id, ean) twice.
+--
+-- enrichment_worker.py falls back to per-row select + update/insert while the
+-- function is not deployed.
+
+-- 1. Remove duplicates, keeping the newest purchase_date (then the highest id) per key
+DELETE FROM unique_products u
+ USING (
+    SELECT id, ROW_NUMBER() OVER (
+               PARTITION BY market_id, ean
+               ORDER BY purchase_date DESC NULLS LAST, id DESC
+           ) AS rn
+      FROM unique_products
+ ) ranked
+ WHERE u.id = ranked.id
+   AND ranked.rn > 1;
+
+-- 2. Unique key (replaces the plain index on the same columns)
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint WHERE conname = 'unique_products_market_ean_key'
+    ) THEN
+        ALTER TABLE unique_products
+            ADD CONSTRAINT unique_products_market_ean_key UNIQUE (market_id, ean);
+    END IF;
+END $$;
+
+DROP INDEX IF EXISTS idx_unique_products_market_ean;
+
+-- 3. Batched upsert
+CREATE OR REPLACE FUNCTION public.upsert_unique_products(
+    p_rows JSONB,
+    p_only_newer BOOLEAN DEFAULT TRUE
+)
+RETURNS INTEGER
+LANGUAGE sql
+SET search_path = public
+AS $$
+    WITH incoming AS (
+        SELECT *
+          FROM jsonb_to_recordset(p_rows) AS r(
+              market_id TEXT,
+              ean TEXT,
+              ncm TEXT,
+              product_name TEXT,
+              unidade_comercial TEXT,
+              price FLOAT,
+              nfce_url TEXT,
+              image_url TEXT,
+              purchase_date TIMESTAMP,
+              varejo_price DECIMAL(10,2),
+              atacado_price DECIMAL(10,2)
+          )
+    ),
+    written AS (
+        INSERT INTO unique_products AS u (
+            market_id, ean, ncm, product_name, unidade_comercial, price,
+            nfce_url, image_url, purchase_date, varejo_price, atacado_price
+        )
+        SELECT market_id,
+               ean,
+               COALESCE(ncm, '00000000'),
+               COALESCE(product_name, 'EAN ' || ean),
+               COALESCE(unidade_comercial, 'UN'),
+               COALESCE(price, varejo_price, 0),
+               COALESCE(nfce_url, ''),
+               image_url,
+               COALESCE(purchase_date, NOW()),
+               varejo_price,
+               atacado_price
+          FROM incoming
+        ON CONFLICT (market_id, ean) DO UPDATE
+           SET (ncm, product_name, unidade_comercial, price, nfce_url,
+                image_url, purchase_date, varejo_price, atacado_price) = (
+                   -- the raw incoming row, so placeholders never overwrite stored values
+                   SELECT COALESCE(i.ncm, u.ncm),
+                          COALESCE(i.product_name, u.product_name),
+                          COALESCE(i.unidade_comercial, u.unidade_comercial),
+                          COALESCE(i.price, u.price),
+                          COALESCE(i.nfce_url, u.nfce_url),
+                          COALESCE(i.image_url, u.image_url),
+                          COALESCE(i.purchase_date, u.purchase_date),
+                          COALESCE(i.varejo_price, u.varejo_price),
+                          COALESCE(i.atacado_price, u.atacado_price)
+                     FROM incoming i
+                    WHERE i.market_id = EXCLUDED.market_id
+                      AND i.ean = EXCLUDED.ean
+               )
+         WHERE NOT p_only_newer
+            OR u.purchase_date IS NULL
+            OR EXCLUDED.purchase_date >= u.purchase_date
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM written;
+$$;
@@ -0,0 +1,146 @@
+"""
+Per-host circuit breaker for SEFAZ portals.
+
+When a state's NFCe portal is down every receipt for it would still take the
+extraction slot, launch Chromium and wait out the page timeout. The breaker
+counts consecutive host failures (timeouts, network errors, empty pages) per
+SEFAZ host; after NFCE_BREAKER_FAILURES it opens and the fetch stage parks
+that host's jobs back in the DB queue (next_attempt_at) without touching the
+browser, leaving the slot to receipts from healthy states.
+
+After NFCE_BREAKER_OPEN_SECONDS one job is let through as a probe (half-open):
+success closes the breaker, failure re-opens it for another period. A probe
+that ends without a verdict (an error that says nothing about the host, a
+slot timeout, a requeue) calls release_probe() so the next job probes right
+away instead of waiting PROBE_TIMEOUT_SECONDS.
+
+State is process-local; every worker learns about an outage on its own.
+"""
+
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+FAILURE_THRESHOLD = int(os.getenv('NFCE_BREAKER_FAILURES', '3'))
+OPEN_SECONDS = int(os.getenv('NFCE_BREAKER_OPEN_SECONDS', '120'))
+PROBE_TIMEOUT_SECONDS = 300  # a probe that never reported back frees the half-open slot
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+class _Breaker:
+    __slots__ = ('state', 'failures', 'opened_at', 'probe_started_at', 'probe_active', 'probe_owner',
+                 'trips', 'rejected', 'total_successes', 'total_failures')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+        self.probe_active = False
+        self.probe_owner = None
+        self.trips = 0
+        self.rejected = 0
+        self.total_successes = 0
+        self.total_failures = 0
+
+
+def host_for(url: str) -> str:
+    return urlparse(url).netloc.lower()
+
+
+def _get(host):
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = _breakers[host] = _Breaker()
+    return breaker
+
+
+def allow(host: str, owner=None):
+    """
+    Decide whether a job for `host` may use the browser now. `owner` (the job's
+    record id) identifies the probe for release_probe().
+    Returns (allowed, retry_after_seconds); retry_after is 0 when allowed.
+    """
+    now = time.monotonic()
+    with _lock:
+        breaker = _get(host)
+        if breaker.state == CLOSED:
+            return True, 0
+        if breaker.state == OPEN:
+            remaining = breaker.opened_at + OPEN_SECONDS - now
+            if remaining > 0:
+                breaker.rejected += 1
+                return False, remaining
+            breaker.state = HALF_OPEN
+            breaker.probe_started_at = now
+            breaker.probe_active = True
+            breaker.probe_owner = owner
+            print(f"[BREAKER] {host} half-open, letting one probe through")
+            return True, 0
+        # HALF_OPEN: one probe at a time
+        if not breaker.probe_active or now - breaker.probe_started_at > PROBE_TIMEOUT_SECONDS:
+            breaker.probe_started_at = now
+            breaker.probe_active = True
+            breaker.probe_owner = owner
+            return True, 0
+        breaker.rejected += 1
+        return False, OPEN_SECONDS
+
+
+def record_success(host: str):
+    with _lock:
+        breaker = _get(host)
+        if breaker.state != CLOSED:
+            print(f"[BREAKER] {host} closed (probe succeeded)")
+        breaker.state = CLOSED
+        breaker.failures = 0
+        breaker.probe_active = False
+        breaker.total_successes += 1
+
+
+def record_failure(host: str):
+    with _lock:
+        breaker = _get(host)
+        breaker.failures += 1
+        breaker.total_failures += 1
+        if breaker.state == HALF_OPEN or (
+                breaker.state == CLOSED and breaker.failures >= FAILURE_THRESHOLD):
+            breaker.state = OPEN
+            breaker.probe_active = False
+            breaker.opened_at = time.monotonic()
+            breaker.trips += 1
+            print(f"[BREAKER] {host} open for {OPEN_SECONDS}s after {breaker.failures} consecutive failures")
+
+
+def release_probe(host: str, owner):
+    """The job `owner` is leaving the fetch stage without a verdict: if it was the
+    half-open probe, free the slot for the next job. No-op otherwise."""
+    with _lock:
+        breaker = _get(host)
+        if breaker.state == HALF_OPEN and breaker.probe_active and breaker.probe_owner == owner:
+            breaker.probe_active = False
+
+
+def stats() -> dict:
+    """Per-host breaker state plus lifetime success/failure counts."""
+    result = {}
+    with _lock:
+        for host, b in _breakers.items():
+            outcomes = b.total_successes + b.total_failures
+            result[host] = {
+                'state': b.state,
+                'consecutive_failures': b.failures,
+                'trips': b.trips,
+                'parked_jobs': b.rejected,
+                'successes': b.total_successes,
+                'failures': b.total_failures,
+                'failure_rate': round(b.total_failures / outcomes, 3) if outcomes else 0.0,
+            }
+    return result
@@ -0,0 +1,135 @@
+"""
+Adaptive (AIMD) concurrency limit for page loads in this worker.
+
+The fetch stage's HostScheduler only starts a load while fewer than limit()
+are running. Every finished load reports its latency and outcome here:
+
+  - additive increase: after WINDOW consecutive healthy loads (no failures,
+    p95 latency under NFCE_TARGET_P95_SECONDS, memory under the pressure
+    threshold) the limit goes up by one, up to NFCE_FETCH_MAX_CONCURRENCY;
+  - multiplicative decrease: a timeout, a SEFAZ 5xx or memory pressure
+    halves it (at most once per COOLDOWN_SECONDS), down to 1.
+
+Memory is the container's cgroup usage when available (Chromium runs in
+child processes, so the worker's own RSS undercounts it), else VmRSS.
+Decisions are printed and kept for /api/admin/queue and /api/admin/metrics.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+MIN_LIMIT = 1
+# The ceiling also sizes the fetch stage's thread pool (nfce_pipeline), so the limit
+# is what gates loads. NFCE_FETCH_WORKERS, the old name, still works as its default.
+MAX_LIMIT = max(1, int(os.getenv('NFCE_FETCH_MAX_CONCURRENCY', os.getenv('NFCE_FETCH_WORKERS', '3'))))
+TARGET_P95_SECONDS = float(os.getenv('NFCE_TARGET_P95_SECONDS', '30'))
+MEMORY_LIMIT_MB = int(os.getenv('NFCE_MEMORY_LIMIT_MB', '512'))
+MEMORY_PRESSURE_RATIO = 0.85
+WINDOW = 5
+COOLDOWN_SECONDS = 30
+
+_lock = threading.Lock()
+_limit = MIN_LIMIT
+_latencies = deque(maxlen=50)
+_healthy_streak = 0
+_last_decrease = 0.0
+_decisions = deque(maxlen=20)
+
+
+def memory_mb() -> float | None:
+    """Current memory use in MB: cgroup v2/v1 usage, falling back to this process's RSS."""
+    for path in ('/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory/memory.usage_in_bytes'):
+        try:
+            with open(path) as f:
+                return int(f.read().strip()) / (1024 * 1024)
+        except (OSError, ValueError):
+            continue
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _p95():
+    if not _latencies:
+        return 0.0
+    ordered = sorted(_latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+def _decide(new_limit, reason):
+    global _limit
+    old = _limit
+    _limit = new_limit
+    _decisions.append({'at': time.time(), 'from': old, 'to': new_limit, 'reason': reason})
+    action = 'increase' if new_limit > old else 'decrease'
+    print(f"[CONCURRENCY] Fetch limit {old} -> {new_limit} ({reason})")
+    import nfce_metrics
+    nfce_metrics.incr('nfce_concurrency_decisions_total', action=action, reason=reason)
+
+
+def limit() -> int:
+    return _limit
+
+
+def record(latency_seconds: float, error_class: str | None = None):
+    """
+    Report one finished page load. `error_class` is None on success, else an
+    nfce_retry error class.
+    """
+    from nfce_retry import ERROR_TIMEOUT, ERROR_SERVER
+    global _healthy_streak, _last_decrease
+
+    memory = memory_mb()
+    pressure = memory is not None and memory >= MEMORY_LIMIT_MB * MEMORY_PRESSURE_RATIO
+
+    with _lock:
+        _latencies.append(latency_seconds)
+        overload = error_class in (ERROR_TIMEOUT, ERROR_SERVER)
+        if overload or pressure:
+            _healthy_streak = 0
+            now = time.monotonic()
+            if _limit > MIN_LIMIT and now - _last_decrease >= COOLDOWN_SECONDS:
+                _last_decrease = now
+                reason = 'memory_pressure' if pressure else error_class
+                _decide(max(MIN_LIMIT, _limit // 2), reason)
+            return
+
+        if error_class is not None:
+            _healthy_streak = 0  # other failures say nothing about load, but aren't healthy either
+            return
+
+        _healthy_streak += 1
+        if _healthy_streak >= WINDOW and _limit < MAX_LIMIT and _p95() <= TARGET_P95_SECONDS:
+            _healthy_streak = 0
+            _decide(_limit + 1, 'healthy')
+
+
+def reset_after_fork():
+    global _limit, _healthy_streak, _last_decrease
+    _limit = MIN_LIMIT
+    _healthy_streak = 0
+    _last_decrease = 0.0
+    _latencies.clear()
+    _decisions.clear()
+
+
+def stats() -> dict:
+    memory = memory_mb()
+    with _lock:
+        return {
+            'limit': _limit,
+            'min': MIN_LIMIT,
+            'max': MAX_LIMIT,
+            'p95_s': round(_p95(), 1),
+            'target_p95_s': TARGET_P95_SECONDS,
+            'memory_mb': round(memory) if memory is not None else None,
+            'memory_limit_mb': MEMORY_LIMIT_MB,
+            'recent_decisions': list(_decisions),
+        }
@@ -66,115 +66,139 @@ def extract_market_info(html):
     return market_info
 
 
-def extract_full_nfce_data(url, headless=True):
+def fetch_nfce_html(url, headless=True):
     """
-    Extract complete NFCe data including market info and products
-    
+    Load an NFCe page in Chromium, open the detail tabs and return the HTML.
+    This is the only part of the extraction that needs a browser; raises on
+    navigation errors (e.g. Playwright TimeoutError when SEFAZ is slow).
+    """
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=headless)
+        page = browser.new_page()
+
+        try:
+            # Load and navigate
+            response = page.goto(url, wait_until="load", timeout=60000)
+            if response is not None and response.status >= 500:
+                raise RuntimeError(f"SEFAZ server error: HTTP {response.status}")
+            time.sleep(4)
+
+            # Scroll to make button visible
+            page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+            time.sleep(2)
+
+            # Wait for button and click
+            page.wait_for_selector('#btnVisualizarAbas', state='attached', timeout=20000)
+            page.evaluate("document.getElementById('btnVisualizarAbas').click()")
+            time.sleep(6)
+            page.wait_for_load_state("load", timeout=60000)
+            time.sleep(3)
+
+            return page.content()
+
+        finally:
+            browser.close()
+
+
+def parse_nfce_html(html):
+    """
+    Parse market info, emission date and products out of NFCe detail HTML.
+
     Returns:
         Dictionary with:
         {
             'market_info': {'name': '...', 'address': '...', 'cep': '...'},
-            'products': [{'ncm': '...', 'quantity': ..., ...}, ...]
+            'products': [{'ncm': '...', 'quantity': ..., ...}, ...],
+            'purchase_date': 'DD/MM/YYYY HH:MM:SS-03:00' or None
         }
     """
-    
     result = {
         'market_info': {},
         'products': [],
         'purchase_date': None
     }
+
+    # Extract market information
+    result['market_info'] = extract_market_info(html)
+
+    # Extract emission date (the real purchase date from the receipt)
+    date_pattern = r'<label>Data de Emiss[aã]o</label>\s*<span>([^<]+)</span>'
+    date_match = re.search(date_pattern, html)
+    if date_match:
+        result['purchase_date'] = date_match.group(1).strip()
+        print(f"[NFCe] Found emission date: {result['purchase_date']}")
+    else:
+        result['purchase_date'] = None
+        print("[NFCe] WARNING: Emission date not found in HTML")
+
+    # Extract all product data using regex patterns
+    ncm_pattern = r'Código NCM</label>\s*<span>(\d{8})</span>'
+    ncm_codes = re.findall(ncm_pattern, html)
+
+    ean_pattern = r'<label>Código EAN Comercial</label>\s*<span>([^<]+)</span>'
+    ean_codes = re.findall(ean_pattern, html)
+
+    product_pattern = r'class="fixo-prod-serv-descricao">\s*<span>([^<]+)</span>'
+    product_names = re.findall(product_pattern, html)
+
+    quantity_pattern = r'class="fixo-prod-serv-qtd">\s*<span>([^<]+)</span>'
+    quantities = re.findall(quantity_pattern, html)
+
+    unit_pattern = r'class="fixo-prod-serv-uc">\s*<span>([^<]+)</span>'
+    units = re.findall(unit_pattern, html)
+
+    total_price_pattern = r'class="fixo-prod-serv-vb">\s*<span>([^<]+)</span>'
+    total_prices = re.findall(total_price_pattern, html)
+
+    unit_price_pattern = r'<label>Valor unitário de comercialização</label>\s*<span>([^<]+)</span>'
+    unit_prices = re.findall(unit_price_pattern, html)
+
+    # Combine all data
+    for i in range(len(ncm_codes)):
+        try:
+            quantity = float(quantities[i].replace(',', '.')) if i < len(quantities) else 0
+            total_price = float(total_prices[i].replace(',', '.')) if i < len(total_prices) else 0
+            unit_price = float(unit_prices[i].replace(',', '.')) if i < len(unit_prices) else 0
+            unit = units[i].strip() if i < len(units) else 'UN'
+            ean = ean_codes[i].strip() if i < len(ean_codes) else 'SEM GTIN'
+
+            result['products'].append({
+                'number': i + 1,
+                'product': product_names[i].strip() if i < len(product_names) else '',
+                'ncm': ncm_codes[i],
+                'ean': ean,
+                'quantity': quantity,
+                'unidade_comercial': unit,
+                'total_price': total_price,
+                'unit_price': unit_price,
+                'price': unit_price
+            })
+        except Exception as e:
+            print(f"Error processing product {i+1}: {e}")
+            continue
+
+    return result
+
+
+def extract_full_nfce_data(url, headless=True):
+    """
+    Extract complete NFCe data including market info and products
+    (fetch_nfce_html + parse_nfce_html in one call).
     
+    Returns:
+        Dictionary with:
+        {
+            'market_info': {'name': '...', 'address': '...', 'cep': '...'},
+            'products': [{'ncm': '...', 'quantity': ..., ...}, ...]
+        }
+        On failure the dict also carries 'error' with the exception message,
+        so callers can tell a SEFAZ timeout from a page without products.
+    """
     try:
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=headless)
-            page = browser.new_page()
-            
-            try:
-                # Load and navigate
-                page.goto(url, wait_until="load", timeout=60000)
-                time.sleep(4)
-                
-                # Scroll to make button visible
-                page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
-                time.sleep(2)
-                
-                # Wait for button and click
-                page.wait_for_selector('#btnVisualizarAbas', state='attached', timeout=20000)
-                page.evaluate("document.getElementById('btnVisualizarAbas').click()")
-                time.sleep(6)
-                page.wait_for_load_state("load", timeout=60000)
-                time.sleep(3)
-                
-                # Get HTML
-                html = page.content()
-                
-                # Extract market information
-                result['market_info'] = extract_market_info(html)
-                
-                # Extract emission date (the real purchase date from the receipt)
-                date_pattern = r'<label>Data de Emiss[aã]o</label>\s*<span>([^<]+)</span>'
-                date_match = re.search(date_pattern, html)
-                if date_match:
-                    result['purchase_date'] = date_match.group(1).strip()
-                    print(f"[NFCe] Found emission date: {result['purchase_date']}")
-                else:
-                    result['purchase_date'] = None
-                    print("[NFCe] WARNING: Emission date not found in HTML")
-                
-                # Extract all product data using regex patterns
-                ncm_pattern = r'Código NCM</label>\s*<span>(\d{8})</span>'
-                ncm_codes = re.findall(ncm_pattern, html)
-                
-                ean_pattern = r'<label>Código EAN Comercial</label>\s*<span>([^<]+)</span>'
-                ean_codes = re.findall(ean_pattern, html)
-                
-                product_pattern = r'class="fixo-prod-serv-descricao">\s*<span>([^<]+)</span>'
-                product_names = re.findall(product_pattern, html)
-                
-                quantity_pattern = r'class="fixo-prod-serv-qtd">\s*<span>([^<]+)</span>'
-                quantities = re.findall(quantity_pattern, html)
-                
-                unit_pattern = r'class="fixo-prod-serv-uc">\s*<span>([^<]+)</span>'
-                units = re.findall(unit_pattern, html)
-                
-                total_price_pattern = r'class="fixo-prod-serv-vb">\s*<span>([^<]+)</span>'
-                total_prices = re.findall(total_price_pattern, html)
-                
-                unit_price_pattern = r'<label>Valor unitário de comercialização</label>\s*<span>([^<]+)</span>'
-                unit_prices = re.findall(unit_price_pattern, html)
-                
-                # Combine all data
-                for i in range(len(ncm_codes)):
-                    try:
-                        quantity = float(quantities[i].replace(',', '.')) if i < len(quantities) else 0
-                        total_price = float(total_prices[i].replace(',', '.')) if i < len(total_prices) else 0
-                        unit_price = float(unit_prices[i].replace(',', '.')) if i < len(unit_prices) else 0
-                        unit = units[i].strip() if i < len(units) else 'UN'
-                        ean = ean_codes[i].strip() if i < len(ean_codes) else 'SEM GTIN'
-                        
-                        result['products'].append({
-                            'number': i + 1,
-                            'product': product_names[i].strip() if i < len(product_names) else '',
-                            'ncm': ncm_codes[i],
-                            'ean': ean,
-                            'quantity': quantity,
-                            'unidade_comercial': unit,
-                            'total_price': total_price,
-                            'unit_price': unit_price,
-                            'price': unit_price
-                        })
-                    except Exception as e:
-                        print(f"Error processing product {i+1}: {e}")
-                        continue
-                
-            finally:
-                browser.close()
-        
-        return result
-        
+        return parse_nfce_html(fetch_nfce_html(url, headless=headless))
     except Exception as e:
         print(f"Error extracting NFCe data: {e}")
-        return {'market_info': {}, 'products': [], 'purchase_date': None}
+        return {'market_info': {}, 'products': [], 'purchase_date': None, 'error': str(e)}
 
 
 # For testing
@@ -0,0 +1,240 @@
+"""
+Per-host politeness scheduling for SEFAZ page loads.
+
+The limits cover the page load itself. A host is ready when it has fewer than
+its max concurrent loads in flight and its minimum interval has passed since
+the last load started. The fetch stage waits for that (wait_ready), takes the
+extraction slot (database lock), then takes a host load slot for the page load
+(try_start_load / end_load). If another job got the host in between, it gives
+the extraction slot back before waiting again, so neither wait holds the
+other's capacity.
+
+HostScheduler is the input queue of the pipeline's fetch stage. It keeps one
+FIFO per SEFAZ host and hands a worker the next job whose host is ready by
+the same rules. Hosts are served round-robin, so a host that must wait never
+blocks receipts for other states behind it. Within a host, interactive jobs
+go before batch ones (nfce_lanes).
+
+Limits default to NFCE_HOST_MAX_CONCURRENCY / NFCE_HOST_MIN_INTERVAL_SECONDS
+and can be overridden per host with NFCE_HOST_LIMITS, e.g.
+"www.nfce.fazenda.sp.gov.br=2/1.5,nfce.sefaz.pe.gov.br=1/5". They apply per
+worker process: with N Gunicorn workers (or instances) a host sees up to N
+times the configured rate.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+
+from constants import LANE_INTERACTIVE, LANE_BATCH
+from nfce_lanes import LaneSelector
+
+DEFAULT_MAX_CONCURRENCY = int(os.getenv('NFCE_HOST_MAX_CONCURRENCY', '1'))
+DEFAULT_MIN_INTERVAL_SECONDS = float(os.getenv('NFCE_HOST_MIN_INTERVAL_SECONDS', '2'))
+LATENCY_WINDOW = 200
+BUSY_RECHECK_SECONDS = 0.5  # a busy host frees up when a load ends, outside the scheduler
+
+
+def _parse_limits(spec: str) -> dict:
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            host, values = entry.split('=', 1)
+            concurrency, interval = values.split('/', 1)
+            limits[host.strip().lower()] = (max(1, int(concurrency)), max(0.0, float(interval)))
+        except ValueError:
+            print(f"[HOSTS] Ignoring malformed NFCE_HOST_LIMITS entry: {entry!r}")
+    return limits
+
+
+HOST_LIMITS = _parse_limits(os.getenv('NFCE_HOST_LIMITS', ''))
+
+
+def limits_for(host: str):
+    """(max_concurrency, min_interval_seconds) for a host."""
+    return HOST_LIMITS.get(host, (DEFAULT_MAX_CONCURRENCY, DEFAULT_MIN_INTERVAL_SECONDS))
+
+
+def job_host(job: dict) -> str:
+    return urlparse(job.get('resolved_url') or job['url']).netloc.lower()
+
+
+class _HostLoads:
+    __slots__ = ('in_flight', 'last_start', 'loads', 'load_waits')
+
+    def __init__(self):
+        self.in_flight = 0
+        self.last_start = 0.0
+        self.loads = 0
+        self.load_waits = deque(maxlen=LATENCY_WINDOW)
+
+
+_loads = {}
+_loads_cond = threading.Condition()
+
+
+def _ready_in(host, now):
+    """Seconds until `host` may start a load, 0 if now, None while it is at max concurrency.
+    Caller holds _loads_cond."""
+    state = _loads.get(host)
+    if state is None:
+        return 0.0
+    max_concurrency, min_interval = limits_for(host)
+    if state.in_flight >= max_concurrency:
+        return None
+    return max(0.0, state.last_start + min_interval - now)
+
+
+def wait_ready(host: str):
+    """Block until `host` could start a load right now (no capacity is taken)."""
+    with _loads_cond:
+        while True:
+            ready_in = _ready_in(host, time.monotonic())
+            if ready_in == 0:
+                return
+            _loads_cond.wait(ready_in)
+
+
+def try_start_load(host: str, requested_at: float) -> bool:
+    """Take one of `host`'s load slots if it is ready now; pair with end_load().
+    `requested_at` (time.monotonic()) is when the job started waiting, for stats."""
+    with _loads_cond:
+        now = time.monotonic()
+        if _ready_in(host, now) != 0:
+            return False
+        state = _loads.setdefault(host, _HostLoads())
+        state.in_flight += 1
+        state.last_start = now
+        state.loads += 1
+        state.load_waits.append(now - requested_at)
+        return True
+
+
+def end_load(host: str):
+    with _loads_cond:
+        _loads[host].in_flight -= 1
+        _loads_cond.notify_all()
+
+
+class _Host:
+    __slots__ = ('pending', 'started', 'waits')
+
+    def __init__(self):
+        self.pending = deque()
+        self.started = 0
+        self.waits = deque(maxlen=LATENCY_WINDOW)
+
+
+class HostScheduler:
+    """
+    Drop-in for the queue.Queue of a pipeline stage whose items are (job, enqueued_at).
+
+    get() only hands out jobs whose host is ready; the host's load slot itself is
+    taken by try_start_load() around the page load. `capacity`, if given, is called for
+    the current limit on jobs in the stage across all hosts (see nfce_concurrency);
+    the worker's task_done() call frees that one.
+    """
+
+    def __init__(self, maxsize: int = 0, capacity=None):
+        self.maxsize = maxsize
+        self.capacity = capacity
+        self._in_flight = 0
+        self._hosts = OrderedDict()  # round-robin order: served hosts move to the back
+        self._size = 0
+        self._cond = threading.Condition()
+        self._current = threading.local()
+        self._lane_selector = LaneSelector()
+
+    def put(self, item):
+        job, _enqueued_at = item
+        host = job_host(job)
+        with self._cond:
+            while self.maxsize > 0 and self._size >= self.maxsize:
+                self._cond.wait()
+            self._hosts.setdefault(host, _Host()).pending.append(item)
+            self._size += 1
+            self._cond.notify_all()
+
+    def _next_ready(self, now):
+        """Pop the next servable item. Returns (host, item, None) or (None, None, wait_seconds)."""
+        if self.capacity is not None and self._in_flight >= self.capacity():
+            return None, None, 1.0  # re-check: the limit can rise without a task_done
+        soonest = None
+        for host, state in self._hosts.items():
+            if not state.pending:
+                continue
+            with _loads_cond:
+                ready_in = _ready_in(host, now)
+            if ready_in is None:
+                ready_in = BUSY_RECHECK_SECONDS
+            if ready_in > 0:
+                soonest = ready_in if soonest is None else min(soonest, ready_in)
+                continue
+            self._hosts.move_to_end(host)
+            return host, self._pop_by_lane(state.pending), None
+        return None, None, soonest
+
+    def _pop_by_lane(self, pending):
+        """Oldest interactive job for the host, unless batch is due its reserved share."""
+        lanes = {item[0].get('lane', LANE_INTERACTIVE) for item in pending}
+        lane = self._lane_selector.choose(LANE_INTERACTIVE in lanes, LANE_BATCH in lanes)
+        for index, item in enumerate(pending):
+            if item[0].get('lane', LANE_INTERACTIVE) == lane:
+                del pending[index]
+                return item
+        return pending.popleft()
+
+    def get(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                host, item, wait = self._next_ready(now)
+                if item is not None:
+                    break
+                self._cond.wait(wait)
+            state = self._hosts[host]
+            self._in_flight += 1
+            state.started += 1
+            state.waits.append(time.time() - item[1])
+            self._size -= 1
+            self._current.host = host
+            self._cond.notify_all()
+            return item
+
+    def task_done(self):
+        host = getattr(self._current, 'host', None)
+        if host is None:
+            return
+        self._current.host = None
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def qsize(self) -> int:
+        with self._cond:
+            return self._size
+
+    def stats(self) -> list:
+        with self._cond:
+            result = []
+            for host, state in self._hosts.items():
+                max_concurrency, min_interval = limits_for(host)
+                waits = list(state.waits)
+                with _loads_cond:
+                    loads = _loads.get(host) or _HostLoads()
+                    load_waits = list(loads.load_waits)
+                result.append({
+                    'host': host,
+                    'in_flight': loads.in_flight,
+                    'queued': len(state.pending),
+                    'started': state.started,
+                    'page_loads': loads.loads,
+                    'avg_load_wait_ms': int(sum(load_waits) / len(load_waits) * 1000) if load_waits else 0,
+                    'max_concurrency': max_concurrency,
+                    'min_interval_s': min_interval,
+                    'avg_wait_ms': int(sum(waits) / len(waits) * 1000) if waits else 0,
+                    'max_wait_ms': int(max(waits) * 1000) if waits else 0,
+                })
+            return result
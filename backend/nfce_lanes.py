@@ -0,0 +1,109 @@
+"""
+Priority lanes for NFCe jobs.
+
+Every processed_urls row carries a lane (processed_urls.lane): 'interactive'
+for receipts scanned in the apps, 'batch' for bulk imports and re-processing
+(see enqueue_batch.py). Wherever jobs wait - the DB queue pull, the local
+task queue and the fetch stage - the interactive lane is served first, but
+while both lanes have work every Nth pick goes to batch (NFCE_BATCH_SHARE,
+default 20%), so a long backfill keeps moving during the day without users
+ever waiting behind it.
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import nfce_metrics
+from constants import LANE_INTERACTIVE, LANE_BATCH, LANES
+
+BATCH_SHARE = min(0.5, max(0.01, float(os.getenv('NFCE_BATCH_SHARE', '0.2'))))
+_BATCH_EVERY = max(2, round(1 / BATCH_SHARE))
+
+
+def normalize(lane) -> str:
+    return lane if lane in LANES else LANE_INTERACTIVE
+
+
+class LaneSelector:
+    """Strict priority for interactive, with a reserved share for batch under contention."""
+
+    def __init__(self):
+        self._since_batch = 0
+        self._lock = threading.Lock()
+
+    def choose(self, interactive_ready: bool, batch_ready: bool):
+        """Pick the lane to serve next, or None if neither has work."""
+        with self._lock:
+            if interactive_ready and batch_ready:
+                if self._since_batch >= _BATCH_EVERY - 1:
+                    self._since_batch = 0
+                    return LANE_BATCH
+                self._since_batch += 1
+                return LANE_INTERACTIVE
+            if interactive_ready:
+                return LANE_INTERACTIVE
+            if batch_ready:
+                self._since_batch = 0
+                return LANE_BATCH
+            return None
+
+
+class LaneQueue:
+    """
+    queue.Queue-like FIFO per lane; get() picks the lane with a LaneSelector.
+    Items are tuples whose last element is the lane.
+    """
+
+    def __init__(self):
+        self._lanes = {lane: deque() for lane in LANES}
+        self._selector = LaneSelector()
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            self._lanes[normalize(item[-1])].append((item, time.time()))
+            self._cond.notify()
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                lane = self._selector.choose(bool(self._lanes[LANE_INTERACTIVE]),
+                                             bool(self._lanes[LANE_BATCH]))
+                if lane is not None:
+                    item, queued_at = self._lanes[lane].popleft()
+                    nfce_metrics.observe(f'nfce_{lane}_lane_wait_seconds', time.time() - queued_at)
+                    return item
+                if not block:
+                    raise queue.Empty
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._cond.wait(remaining)
+
+    def task_done(self):
+        pass  # kept for queue.Queue compatibility; nothing joins on this queue
+
+    def qsize(self, lane=None) -> int:
+        with self._cond:
+            if lane is not None:
+                return len(self._lanes[lane])
+            return sum(len(items) for items in self._lanes.values())
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def stats(self) -> dict:
+        """Per-lane depth and how long the oldest item has been waiting (lag)."""
+        now = time.time()
+        with self._cond:
+            return {
+                lane: {
+                    'queued': len(items),
+                    'oldest_wait_s': round(now - items[0][1], 1) if items else 0,
+                }
+                for lane, items in self._lanes.items()
+            }
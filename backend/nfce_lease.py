@@ -0,0 +1,106 @@
+"""
+Heartbeat leases for claimed NFCe jobs.
+
+While a process works on a job ('processing' or 'extracting') a background
+thread renews processed_urls.lease_expires_at every RENEW_INTERVAL_SECONDS.
+Stale detection (the orphan sweep in task_queue and cleanup_stale_locks in
+app.py) only looks at that expiry, so a crashed job is reclaimed within
+seconds of its last renewal while a slow-but-alive one (a 60s+ SEFAZ page
+load, a long wait for the extraction slot) keeps its lease.
+
+A freshly claimed row has no lease yet (or an expired one from an earlier
+attempt); until its first renewal, processed_at, set by the claim, plus
+LEASE_SECONDS covers it.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+LEASE_SECONDS = int(os.getenv('NFCE_LEASE_SECONDS', '15'))
+RENEW_INTERVAL_SECONDS = max(1, LEASE_SECONDS // 3)  # tolerate two missed renewals
+
+_held = set()
+_held_lock = threading.Lock()
+_started = False
+_start_lock = threading.Lock()
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def lease_expiry() -> str:
+    return (_utcnow() + timedelta(seconds=LEASE_SECONDS)).isoformat()
+
+
+def filter_expired(query):
+    """Narrow a processed_urls query to rows whose lease has run out.
+
+    The claim sets processed_at, so requiring it to be older than one lease
+    also protects a re-claimed row from the expiry left over by an earlier attempt.
+    """
+    from supabase_client import or_filter
+
+    now = _utcnow()
+    return or_filter(
+        query.lt('processed_at', (now - timedelta(seconds=LEASE_SECONDS)).isoformat()),
+        f'lease_expires_at.is.null,lease_expires_at.lt."{now.isoformat()}"'
+    )
+
+
+def _renew_loop():
+    from constants import STATUS_PROCESSING, STATUS_EXTRACTING
+    from supabase_client import supabase
+
+    while True:
+        time.sleep(RENEW_INTERVAL_SECONDS)
+        ids = held_ids()
+        if not ids:
+            continue
+        try:
+            # Rows not claimed yet (still 'queued') or already released are skipped
+            supabase.table('processed_urls') \
+                .update({'lease_expires_at': lease_expiry()}) \
+                .in_('id', ids) \
+                .in_('status', [STATUS_PROCESSING, STATUS_EXTRACTING]) \
+                .execute()
+        except Exception as e:
+            print(f"[LEASE] Renewal error: {e}")
+
+
+def _ensure_started():
+    global _started
+    if _started:
+        return
+    with _start_lock:
+        if _started:
+            return
+        threading.Thread(target=_renew_loop, name='nfce-lease', daemon=True).start()
+        _started = True
+
+
+def hold(record_id: int):
+    """Start renewing the lease for `record_id` from this process."""
+    _ensure_started()
+    with _held_lock:
+        _held.add(record_id)
+
+
+def release(record_id: int):
+    with _held_lock:
+        _held.discard(record_id)
+
+
+def held_ids() -> list:
+    with _held_lock:
+        return list(_held)
+
+
+def reset_after_fork():
+    """The renewal thread doesn't survive os.fork(); start fresh in the child."""
+    global _started
+    _started = False
+    with _held_lock:
+        _held.clear()
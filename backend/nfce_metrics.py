@@ -0,0 +1,122 @@
+"""
+Process-local metrics for the NFCe pipeline.
+
+Histograms (fixed buckets, in seconds) are fed from each finished job's
+timings; counters track failed attempts by outcome and error class and parked
+jobs. snapshot() backs /api/admin/queue and prometheus_text() backs
+/api/admin/metrics. Each Gunicorn worker keeps its own numbers, so every
+export is labelled with the worker's pid.
+"""
+
+import os
+import threading
+
+BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600)
+
+# Job timing keys (see app.new_nfce_job / the stages) exported as histograms
+JOB_HISTOGRAMS = {
+    'slot_wait': 'nfce_slot_wait_seconds',
+    'extraction': 'nfce_extraction_seconds',
+    'persist': 'nfce_persist_seconds',
+    'total': 'nfce_job_seconds',
+}
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+def observe(name: str, seconds: float):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = _Histogram()
+        histogram.observe(seconds)
+
+
+def incr(name: str, amount: int = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe_job(job: dict, total_seconds: float):
+    """Record a finished job's timings."""
+    timings = dict(job['timings'], total=total_seconds)
+    for key, name in JOB_HISTOGRAMS.items():
+        if key in timings:
+            observe(name, timings[key])
+
+
+def snapshot() -> dict:
+    with _lock:
+        histograms = {
+            name: {
+                'count': h.count,
+                'avg_s': round(h.sum / h.count, 2) if h.count else 0,
+                'buckets': {
+                    **{f'le_{bound}': n for bound, n in zip(BUCKETS, h.counts)},
+                    'le_inf': h.counts[-1],
+                },
+            }
+            for name, h in _histograms.items()
+        }
+        counters = [
+            {'name': name, **dict(labels), 'value': value}
+            for (name, labels), value in sorted(_counters.items())
+        ]
+    return {'pid': os.getpid(), 'histograms': histograms, 'counters': counters}
+
+
+def _labels(pairs) -> str:
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def prometheus_text(gauges: dict | None = None) -> str:
+    """
+    Render everything in the Prometheus text exposition format.
+    `gauges` maps metric name -> value, or -> list of (labels dict, value).
+    """
+    pid = ('pid', os.getpid())
+    lines = []
+    with _lock:
+        for name, h in sorted(_histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, n in zip(BUCKETS, h.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{_labels([pid, ("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{_labels([pid, ("le", "+Inf")])} {h.count}')
+            lines.append(f'{name}_sum{_labels([pid])} {h.sum:.3f}')
+            lines.append(f'{name}_count{_labels([pid])} {h.count}')
+        typed = set()
+        for (name, labels), value in sorted(_counters.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{_labels([pid, *labels])} {value}')
+    for name, value in (gauges or {}).items():
+        lines.append(f'# TYPE {name} gauge')
+        samples = value if isinstance(value, list) else [({}, value)]
+        for labels, sample in samples:
+            lines.append(f'{name}{_labels([pid, *labels.items()])} {sample}')
+    return '\n'.join(lines) + '\n'
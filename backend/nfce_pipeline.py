@@ -0,0 +1,244 @@
+"""
+Staged NFCe pipeline.
+
+An NFCe job runs through the stages in app.NFCE_STAGES:
+
+    resolve -> fetch -> parse -> persist -> enrich_handoff
+
+Each stage has its own worker threads and a bounded input queue, so a slow
+URL resolution or database write never holds the scarce browser slot, which
+only the fetch stage takes. Every stage can be sized on its own through env
+vars, and the whole pipeline is capped at NFCE_PIPELINE_MAX_IN_FLIGHT jobs so
+submit() applies backpressure to the task queue consumer.
+
+Per-stage latencies (and time spent waiting in each stage's queue) are kept in
+a rolling window and exposed through stats(). Jobs in flight hold a heartbeat
+lease (nfce_lease) so the orphan sweep never takes them for crashed ones.
+
+The fetch stage's queue is a per-host politeness scheduler (nfce_hosts), so
+page loads respect each SEFAZ host's concurrency and interval limits while
+receipts for other hosts keep moving. How many loads run at once in this
+worker is adapted by nfce_concurrency, up to NFCE_FETCH_MAX_CONCURRENCY; the
+fetch stage has that many threads.
+"""
+
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+
+import nfce_concurrency
+import nfce_lease
+import nfce_metrics
+from constants import LANE_INTERACTIVE
+from nfce_hosts import HostScheduler
+
+STAGE_WORKERS = {
+    'resolve': int(os.getenv('NFCE_RESOLVE_WORKERS', '2')),
+    'fetch': nfce_concurrency.MAX_LIMIT,
+    'parse': int(os.getenv('NFCE_PARSE_WORKERS', '1')),
+    'persist': int(os.getenv('NFCE_PERSIST_WORKERS', '2')),
+    'enrich_handoff': 1,
+}
+STAGE_QUEUE_SIZE = int(os.getenv('NFCE_STAGE_QUEUE_SIZE', '4'))
+MAX_IN_FLIGHT = int(os.getenv('NFCE_PIPELINE_MAX_IN_FLIGHT', '6'))
+LATENCY_WINDOW = 200
+
+_stages = []
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_capacity = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+_idle_event = threading.Event()
+_idle_event.set()
+_started = False
+_start_lock = threading.Lock()
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+class _Stage:
+    """One pipeline stage: a bounded input queue drained by `workers` threads."""
+
+    def __init__(self, name, fn, workers, input_queue=None):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.queue = input_queue or queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+        self.next = None
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.processed = 0
+        self.ended = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.queue_waits = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f'nfce-{self.name}-{i}', daemon=True).start()
+
+    def put(self, job):
+        self.queue.put((job, time.time()))
+
+    def _run(self):
+        while True:
+            job, enqueued_at = self.queue.get()
+            started = time.time()
+            with self.lock:
+                self.busy += 1
+                self.queue_waits.append(started - enqueued_at)
+
+            proceed = False
+            try:
+                proceed = self.fn(job)
+            except Exception as e:
+                print(f"[PIPELINE #{job['record_id']}] Unexpected error in {self.name} stage: {e}")
+                traceback.print_exc()
+                _fail_crashed_job(job, e)
+            finally:
+                elapsed = time.time() - started
+                job['timings'][self.name] = elapsed
+                with self.lock:
+                    self.busy -= 1
+                    self.processed += 1
+                    self.latencies.append(elapsed)
+                    if not proceed or self.next is None:
+                        self.ended += 1
+                self.queue.task_done()
+
+            if proceed and self.next is not None:
+                self.next.put(job)
+            else:
+                _finish(job)
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            waits = list(self.queue_waits)
+            return {
+                'stage': self.name,
+                'workers': self.workers,
+                'busy': self.busy,
+                'queued': self.queue.qsize(),
+                'processed': self.processed,
+                'ended_here': self.ended,
+                'avg_ms': int(sum(latencies) / len(latencies) * 1000) if latencies else 0,
+                'p95_ms': int(_percentile(latencies, 0.95) * 1000),
+                'avg_queue_wait_ms': int(sum(waits) / len(waits) * 1000) if waits else 0,
+                **({'hosts': self.queue.stats()} if hasattr(self.queue, 'stats') else {}),
+            }
+
+
+def _fail_crashed_job(job, err):
+    """A stage raised instead of recording its own outcome; don't leave the row stuck."""
+    from app import fail_nfce_job
+    from nfce_retry import classify_error
+    try:
+        fail_nfce_job(job['record_id'], job['attempts'], classify_error(err), str(err)[:200])
+    except Exception as e:
+        print(f"[PIPELINE #{job['record_id']}] Could not record failure: {e}")
+
+
+def _finish(job):
+    nfce_lease.release(job['record_id'])
+    with _in_flight_lock:
+        _in_flight.pop(job['record_id'], None)
+        if not _in_flight:
+            _idle_event.set()
+    _capacity.release()
+    total = time.time() - job['start_time']
+    nfce_metrics.observe_job(job, total)
+    nfce_metrics.observe(f"nfce_{job['lane']}_lane_job_seconds", total)
+    summary = ' | '.join(f"{name} {secs:.1f}s" for name, secs in job['timings'].items())
+    print(f"[PIPELINE #{job['record_id']}] Done in {total:.1f}s ({summary})")
+
+
+def _ensure_started():
+    global _started
+    if _started:
+        return
+    with _start_lock:
+        if _started:
+            return
+        from app import NFCE_STAGES
+
+        stages = [
+            _Stage(name, fn, STAGE_WORKERS.get(name, 1),
+                   HostScheduler(STAGE_QUEUE_SIZE, nfce_concurrency.limit) if name == 'fetch' else None)
+            for name, fn in NFCE_STAGES
+        ]
+        for current, following in zip(stages, stages[1:]):
+            current.next = following
+        for stage in stages:
+            stage.start()
+        _stages[:] = stages
+        _started = True
+        print("[PIPELINE] Started: " + ', '.join(f"{s.name}x{s.workers}" for s in stages))
+
+
+def reset_after_fork():
+    """Thread state doesn't survive os.fork(); start fresh in the child."""
+    global _started, _capacity
+    _started = False
+    _stages.clear()
+    _in_flight.clear()
+    _capacity = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+    _idle_event.set()
+    nfce_lease.reset_after_fork()
+    nfce_concurrency.reset_after_fork()
+
+
+def submit(url: str, record_id: int, block: bool = True, lane: str = LANE_INTERACTIVE) -> bool:
+    """
+    Hand a job to the first stage. Blocks while MAX_IN_FLIGHT jobs are already in
+    the pipeline (unless block=False, which then returns False).
+    """
+    _ensure_started()
+    with _in_flight_lock:
+        if record_id in _in_flight:
+            return True
+    if not _capacity.acquire(blocking=block):
+        return False
+
+    from app import new_nfce_job
+    job = new_nfce_job(url, record_id, lane)
+    with _in_flight_lock:
+        _in_flight[record_id] = job
+        _idle_event.clear()
+    nfce_lease.hold(record_id)
+    _stages[0].put(job)
+    return True
+
+
+def in_flight_ids() -> list:
+    with _in_flight_lock:
+        return list(_in_flight)
+
+
+def in_flight_count() -> int:
+    with _in_flight_lock:
+        return len(_in_flight)
+
+
+def has_capacity() -> bool:
+    return in_flight_count() < MAX_IN_FLIGHT
+
+
+def wait_idle(timeout: float | None = None) -> bool:
+    """Wait until no job is in flight. Returns False on timeout."""
+    return _idle_event.wait(timeout)
+
+
+def stats() -> dict:
+    return {
+        'in_flight': in_flight_count(),
+        'max_in_flight': MAX_IN_FLIGHT,
+        'fetch_concurrency': nfce_concurrency.stats(),
+        'stages': [stage.stats() for stage in _stages],
+    }
@@ -0,0 +1,111 @@
+"""
+Retry policy for NFCe extraction jobs.
+
+Every failed attempt is classified into an error class. Transient classes
+(SEFAZ timeouts, network errors, empty pages, slot timeouts) are rescheduled
+with exponential backoff by putting the row back in 'queued' with a
+next_attempt_at timestamp. After NFCE_MAX_ATTEMPTS the row is moved to the
+dead-letter status so a permanently broken URL stops burning extraction slots.
+Permanent classes (invalid access key) go straight to 'error'.
+
+Jobs that were never attempted (e.g. their SEFAZ host's circuit breaker is
+open) are parked with park_update(), which does not count as an attempt.
+"""
+
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+from constants import (
+    STATUS_QUEUED, STATUS_ERROR, STATUS_DEAD,
+    MARKET_ID_QUEUED, MARKET_ID_UNRESOLVED,
+)
+
+MAX_ATTEMPTS = int(os.getenv('NFCE_MAX_ATTEMPTS', '5'))
+RETRY_BASE_SECONDS = int(os.getenv('NFCE_RETRY_BASE_SECONDS', '30'))
+RETRY_MAX_SECONDS = 30 * 60
+
+# processed_urls.last_error_class values
+ERROR_TIMEOUT = 'timeout'
+ERROR_NETWORK = 'network'
+ERROR_SERVER = 'server_error'  # SEFAZ answered 5xx
+ERROR_EMPTY_EXTRACTION = 'empty_extraction'
+ERROR_SLOT_TIMEOUT = 'slot_timeout'
+ERROR_STALE_LOCK = 'stale_lock'
+ERROR_INVALID_NFCE = 'invalid_nfce'
+ERROR_CIRCUIT_OPEN = 'circuit_open'  # parked, not a failed attempt (nfce_breaker.py)
+ERROR_UNKNOWN = 'unknown'
+
+RETRYABLE_ERROR_CLASSES = {
+    ERROR_TIMEOUT, ERROR_NETWORK, ERROR_SERVER, ERROR_EMPTY_EXTRACTION,
+    ERROR_SLOT_TIMEOUT, ERROR_STALE_LOCK, ERROR_UNKNOWN,
+}
+
+_NETWORK_MARKERS = (
+    'net::err', 'connection', 'name resolution', 'reset by peer',
+    'temporarily unavailable', 'remote end closed',
+)
+
+
+def classify_error(err, default: str = ERROR_UNKNOWN) -> str:
+    """Map an exception (or error message) to a last_error_class value."""
+    if err is None:
+        return default
+    text = str(err).lower()
+    if 'access key' in text:
+        return ERROR_INVALID_NFCE
+    if 'timeout' in text or 'timed out' in text:
+        return ERROR_TIMEOUT
+    if 'server error' in text:
+        return ERROR_SERVER
+    if any(marker in text for marker in _NETWORK_MARKERS):
+        return ERROR_NETWORK
+    return default
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Exponential backoff (base * 2^(n-1)) capped at RETRY_MAX_SECONDS, with 20% jitter."""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0)))
+    return delay * (1 + random.random() * 0.2)
+
+
+def failure_update(attempts: int, error_class: str, error_message: str) -> dict:
+    """
+    Build the processed_urls update for a failed attempt.
+
+    `attempts` is the number of attempts made so far, including the one that
+    just failed. Returns a dict that always contains 'status'.
+    """
+    update = {
+        'attempts': attempts,
+        'last_error_class': error_class,
+        'error_message': error_message,
+    }
+
+    if error_class not in RETRYABLE_ERROR_CLASSES:
+        update.update({'status': STATUS_ERROR, 'market_id': MARKET_ID_UNRESOLVED, 'next_attempt_at': None})
+    elif attempts >= MAX_ATTEMPTS:
+        update.update({'status': STATUS_DEAD, 'market_id': MARKET_ID_UNRESOLVED, 'next_attempt_at': None})
+    else:
+        now = datetime.now(timezone.utc)
+        update.update({
+            'status': STATUS_QUEUED,
+            'market_id': MARKET_ID_QUEUED,
+            'next_attempt_at': (now + timedelta(seconds=backoff_seconds(attempts))).isoformat(),
+            'processed_at': now.isoformat(),
+        })
+    return update
+
+
+def park_update(delay_seconds: float, error_class: str, error_message: str) -> dict:
+    """Build the processed_urls update that puts a claimed job back in the queue
+    for later without counting an attempt. Returns a dict that contains 'status'."""
+    now = datetime.now(timezone.utc)
+    return {
+        'status': STATUS_QUEUED,
+        'market_id': MARKET_ID_QUEUED,
+        'last_error_class': error_class,
+        'error_message': error_message,
+        'next_attempt_at': (now + timedelta(seconds=delay_seconds)).isoformat(),
+        'processed_at': now.isoformat(),
+    }
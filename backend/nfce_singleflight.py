@@ -0,0 +1,73 @@
+"""
+Process-local singleflight for /api/nfce/extract.
+
+Concurrent or back-to-back submissions of the same receipt (double taps, two
+family members scanning the same NFCe) are keyed by the receipt identity. The
+first request ("leader") does the duplicate check and insert; the others wait
+for it and attach to the record it created instead of repeating the resolve
+and duplicate-check queries.
+
+Requests can only attach while the leader is in flight. Once it finishes,
+the key is dropped, and a later repeat takes the normal path: the 409
+duplicate answer for a receipt already processed, or a fresh insert after a
+failure. Across processes the DB checks still apply.
+"""
+
+import threading
+import time
+
+LEADER_TIMEOUT_SECONDS = 30  # forget a leader that never completed
+
+_flights = {}
+_lock = threading.Lock()
+
+
+class _Flight:
+    __slots__ = ('done', 'record_id', 'expires_at')
+
+    def __init__(self, expires_at):
+        self.done = threading.Event()
+        self.record_id = None
+        self.expires_at = expires_at
+
+
+def _purge(now):
+    for key in [k for k, f in _flights.items() if f.expires_at < now]:
+        del _flights[key]
+
+
+def begin(key):
+    """Join the flight for `key`. Returns (is_leader, flight)."""
+    now = time.monotonic()
+    with _lock:
+        _purge(now)
+        flight = _flights.get(key)
+        if flight is not None:
+            return False, flight
+        flight = _Flight(now + LEADER_TIMEOUT_SECONDS)
+        _flights[key] = flight
+        return True, flight
+
+
+def complete(key, flight, record_id):
+    """Leader succeeded: publish the record id to the requests waiting on it."""
+    with _lock:
+        flight.record_id = record_id
+        if _flights.get(key) is flight:
+            del _flights[key]
+    flight.done.set()
+
+
+def abandon(key, flight):
+    """Leader did not create a record (duplicate, rate limit, error): let the
+    next request for this key take the normal path."""
+    with _lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
+    flight.done.set()
+
+
+def wait(flight, timeout=10):
+    """Wait for the leader. Returns its record id, or None if it didn't create one."""
+    flight.done.wait(timeout)
+    return flight.record_id
@@ -0,0 +1,341 @@
+"""
+Optional local write-ahead spool for /api/nfce/extract.
+
+With NFCE_SPOOL_PATH set, a submission is appended to a local SQLite file
+(WAL mode, shared by the Gunicorn workers on the instance) and acknowledged
+right away with a provisional record id. A background flusher moves pending
+submissions into processed_urls in batches:
+
+  1. rows whose submission_id already exists in processed_urls (a previous
+     flush inserted them but died before recording it) are reconciled;
+  2. receipts already active in processed_urls are marked duplicate, and URLs
+     held by a failed (error/dead) row are rejected, since nfce_url is unique;
+  3. submissions over MAX_ACTIVE_NFCE_PER_USER are rejected;
+  4. the rest are upserted on submission_id, so a retried flush can never
+     create a second row, and handed to the task queue. If a row still hits
+     the nfce_url constraint (a race with another writer), the batch is
+     inserted row by row and only the conflicting rows are rejected.
+
+Provisional ids are numeric (so the scanner apps can poll them like any
+record id) and start at PROVISIONAL_ID_FLOOR, far above real ids. The status
+endpoints map them to the flushed record; processed_urls.submission_id keeps
+that mapping for instances that don't have the spool file.
+
+Acknowledgement latency no longer depends on Supabase; the checks still run,
+just after the 202 instead of before it.
+"""
+
+import os
+import random
+import sqlite3
+import threading
+import time
+
+SPOOL_PATH = os.getenv('NFCE_SPOOL_PATH', '')  # empty = disabled, submissions go straight to the DB
+FLUSH_INTERVAL_SECONDS = float(os.getenv('NFCE_SPOOL_FLUSH_INTERVAL', '1'))
+BATCH_SIZE = 50
+CLAIM_TIMEOUT_SECONDS = 60  # a 'flushing' row whose flusher died goes back to 'pending'
+URL_TAKEN_DETAIL = 'Esta NFCe já foi enviada antes e terminou com erro.'
+RETENTION_SECONDS = 24 * 3600
+MAX_BACKOFF_SECONDS = 30
+PROVISIONAL_ID_FLOOR = 1 << 40
+
+STATE_PENDING = 'pending'
+STATE_FLUSHING = 'flushing'
+STATE_FLUSHED = 'flushed'
+STATE_DUPLICATE = 'duplicate'
+STATE_REJECTED = 'rejected'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    provisional_id INTEGER PRIMARY KEY,
+    receipt_key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    state TEXT NOT NULL,
+    claimed_at REAL,
+    record_id INTEGER,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_submissions_state ON submissions(state, created_at);
+CREATE INDEX IF NOT EXISTS idx_submissions_key ON submissions(receipt_key, state);
+"""
+
+_local = threading.local()
+_flusher_started = False
+_flusher_lock = threading.Lock()
+_last_purge = 0.0
+
+
+def enabled() -> bool:
+    return bool(SPOOL_PATH)
+
+
+def is_provisional(record_id: int) -> bool:
+    return record_id >= PROVISIONAL_ID_FLOOR
+
+
+def _conn() -> sqlite3.Connection:
+    """Per-thread connection in autocommit mode; transactions are explicit."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(SPOOL_PATH, timeout=5, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # durable across process crashes, cheap fsyncs
+        conn.executescript(_SCHEMA)
+        _local.conn = conn
+    return conn
+
+
+def _new_provisional_id() -> int:
+    # ms timestamp + 10 random bits: unique across workers and instances in practice,
+    # and below 2**53 so JavaScript clients keep it exact
+    return (int(time.time() * 1000) << 10) | random.getrandbits(10)
+
+
+def append(url: str, user_id: str, receipt_key: str):
+    """
+    Spool a submission. Returns (provisional_id, attached); attached is True when
+    the same receipt was already waiting in the spool and its id is returned instead.
+    """
+    conn = _conn()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute(
+            'SELECT provisional_id FROM submissions WHERE receipt_key = ? AND state IN (?, ?) LIMIT 1',
+            (receipt_key, STATE_PENDING, STATE_FLUSHING)
+        ).fetchone()
+        if row:
+            conn.execute('COMMIT')
+            return row['provisional_id'], True
+        provisional_id = _new_provisional_id()
+        conn.execute(
+            'INSERT INTO submissions (provisional_id, receipt_key, url, user_id, created_at, state) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (provisional_id, receipt_key, url, user_id, time.time(), STATE_PENDING)
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    start()
+    return provisional_id, False
+
+
+def lookup(provisional_id: int):
+    """The spool row for a provisional id as a dict, or None if this instance never saw it."""
+    row = _conn().execute('SELECT * FROM submissions WHERE provisional_id = ?', (provisional_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def pending_rows() -> list:
+    """Submissions not yet in processed_urls (for the processing list)."""
+    rows = _conn().execute(
+        'SELECT * FROM submissions WHERE state IN (?, ?) ORDER BY created_at',
+        (STATE_PENDING, STATE_FLUSHING)
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def _claim_batch(conn) -> list:
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            'UPDATE submissions SET state = ? WHERE state = ? AND claimed_at < ?',
+            (STATE_PENDING, STATE_FLUSHING, now - CLAIM_TIMEOUT_SECONDS)
+        )
+        rows = [dict(r) for r in conn.execute(
+            'SELECT * FROM submissions WHERE state = ? ORDER BY created_at LIMIT ?',
+            (STATE_PENDING, BATCH_SIZE)
+        ).fetchall()]
+        if rows:
+            conn.executemany(
+                'UPDATE submissions SET state = ?, claimed_at = ? WHERE provisional_id = ?',
+                [(STATE_FLUSHING, now, r['provisional_id']) for r in rows]
+            )
+        conn.execute('COMMIT')
+        return rows
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def _quoted(values):
+    """Items for an in.() list inside a hand-built or=() filter (in_() quotes on its own)."""
+    return ['"{}"'.format(v.replace('"', '\\"')) for v in values]
+
+
+def _is_unique_violation(error) -> bool:
+    err_str = str(error).lower()
+    return 'unique' in err_str or 'duplicate' in err_str or '23505' in err_str
+
+
+def _flush_batch(rows) -> dict:
+    """Move claimed rows into processed_urls. Returns {provisional_id: (state, record_id, detail)}."""
+    from app import new_queued_nfce_row
+    from constants import ACTIVE_NFCE_STATUSES
+    from supabase_client import supabase, or_filter
+
+    outcomes = {}
+    by_id = {r['provisional_id']: r for r in rows}
+
+    # 1. Reconcile rows a previous (crashed) flush already inserted
+    existing = supabase.table('processed_urls').select('id, submission_id') \
+        .in_('submission_id', list(by_id)).execute()
+    for rec in existing.data or []:
+        outcomes[rec['submission_id']] = (STATE_FLUSHED, rec['id'], None)
+    remaining = [r for pid, r in by_id.items() if pid not in outcomes]
+
+    # 2. Receipts already active in processed_urls (same checks as the direct path, minus URL resolution;
+    #    the claim RPC still catches QR variants that resolve to the same page)
+    if remaining:
+        urls = list({r['url'] for r in remaining})
+        quoted = ','.join(_quoted(urls))  # or_filter() takes the string as is; in_() quotes by itself
+        active = or_filter(
+            supabase.table('processed_urls')
+            .select('id, status, original_url, nfce_url, market_name')
+            .in_('status', list(ACTIVE_NFCE_STATUSES)),
+            f"original_url.in.({quoted}),nfce_url.in.({quoted})"
+        ).execute()
+        known = {}
+        for rec in active.data or []:
+            known.setdefault(rec.get('original_url'), rec)
+            known.setdefault(rec.get('nfce_url'), rec)
+        # nfce_url is UNIQUE in every status, so a failed row for the same URL blocks the insert
+        taken = supabase.table('processed_urls').select('id, nfce_url') \
+            .in_('nfce_url', urls).execute()
+        taken_urls = {rec['nfce_url'] for rec in taken.data or []}
+        still = []
+        for r in remaining:
+            dup = known.get(r['url'])
+            if dup:
+                outcomes[r['provisional_id']] = (STATE_DUPLICATE, dup['id'], dup.get('market_name') or '')
+            elif r['url'] in taken_urls:
+                outcomes[r['provisional_id']] = (STATE_REJECTED, None, URL_TAKEN_DETAIL)
+            else:
+                still.append(r)
+        remaining = still
+
+    # 3. Per-user fairness guard
+    if remaining:
+        max_active = int(os.getenv('MAX_ACTIVE_NFCE_PER_USER', '5'))
+        users = list({r['user_id'] for r in remaining})
+        active_by_user = supabase.table('processed_urls').select('scanned_by') \
+            .in_('scanned_by', users).in_('status', list(ACTIVE_NFCE_STATUSES)).execute()
+        counts = {}
+        for rec in active_by_user.data or []:
+            counts[rec['scanned_by']] = counts.get(rec['scanned_by'], 0) + 1
+        still = []
+        for r in remaining:
+            if counts.get(r['user_id'], 0) >= max_active:
+                outcomes[r['provisional_id']] = (
+                    STATE_REJECTED, None,
+                    f'Você já tem {max_active} NFCes em processamento. Aguarde antes de enviar mais.')
+            else:
+                counts[r['user_id']] = counts.get(r['user_id'], 0) + 1
+                still.append(r)
+        remaining = still
+
+    # 4. Idempotent insert keyed by submission_id, then map back to record ids
+    if remaining:
+        payload = [
+            {**new_queued_nfce_row(r['url'], r['user_id']), 'submission_id': r['provisional_id']}
+            for r in remaining
+        ]
+        try:
+            supabase.table('processed_urls').upsert(
+                payload, on_conflict='submission_id', ignore_duplicates=True
+            ).execute()
+        except Exception as e:
+            if not _is_unique_violation(e):
+                raise
+            # One conflicting URL must not hold back (and endlessly retry) the whole batch
+            for row in payload:
+                try:
+                    supabase.table('processed_urls').upsert(
+                        row, on_conflict='submission_id', ignore_duplicates=True
+                    ).execute()
+                except Exception as row_err:
+                    if not _is_unique_violation(row_err):
+                        raise
+                    outcomes[row['submission_id']] = (STATE_REJECTED, None, URL_TAKEN_DETAIL)
+        inserted = supabase.table('processed_urls').select('id, submission_id') \
+            .in_('submission_id', [r['provisional_id'] for r in remaining]).execute()
+        for rec in inserted.data or []:
+            outcomes[rec['submission_id']] = (STATE_FLUSHED, rec['id'], None)
+
+    return outcomes
+
+
+def flush_once() -> int:
+    """Flush one batch. Returns the number of submissions that left the spool."""
+    import task_queue
+    global _last_purge
+
+    conn = _conn()
+    rows = _claim_batch(conn)
+    if not rows:
+        if time.time() - _last_purge > 3600:
+            _last_purge = time.time()
+            conn.execute('DELETE FROM submissions WHERE state NOT IN (?, ?) AND created_at < ?',
+                         (STATE_PENDING, STATE_FLUSHING, time.time() - RETENTION_SECONDS))
+        return 0
+
+    try:
+        outcomes = _flush_batch(rows)
+    except Exception:
+        conn.execute('UPDATE submissions SET state = ?, claimed_at = NULL WHERE state = ? AND provisional_id IN ({})'
+                     .format(','.join('?' * len(rows))),
+                     [STATE_PENDING, STATE_FLUSHING, *[r['provisional_id'] for r in rows]])
+        raise
+
+    conn.executemany(
+        'UPDATE submissions SET state = ?, record_id = ?, detail = ? WHERE provisional_id = ?',
+        [(state, record_id, detail, pid) for pid, (state, record_id, detail) in outcomes.items()]
+    )
+    by_id = {r['provisional_id']: r for r in rows}
+    for pid, (state, record_id, _detail) in outcomes.items():
+        if state == STATE_FLUSHED:
+            task_queue.enqueue_nfce(by_id[pid]['url'], record_id)
+
+    counts = {}
+    for state, _record_id, _detail in outcomes.values():
+        counts[state] = counts.get(state, 0) + 1
+    print(f"[SPOOL] Flushed batch of {len(rows)}: {counts}")
+    return len(outcomes)
+
+
+def _flusher_loop():
+    delay = FLUSH_INTERVAL_SECONDS
+    while True:
+        time.sleep(delay)
+        try:
+            while flush_once() >= BATCH_SIZE:
+                pass  # keep going while there is a backlog
+            delay = FLUSH_INTERVAL_SECONDS
+        except Exception as e:
+            delay = min(MAX_BACKOFF_SECONDS, delay * 2)
+            print(f"[SPOOL] Flush failed, retrying in {delay:.0f}s: {e}")
+
+
+def start():
+    """Start the background flusher (idempotent). Every worker runs one; batches
+    are claimed under a SQLite write lock, so they never flush the same rows."""
+    global _flusher_started
+    if not enabled() or _flusher_started:
+        return
+    with _flusher_lock:
+        if _flusher_started:
+            return
+        threading.Thread(target=_flusher_loop, name='nfce-spool', daemon=True).start()
+        _flusher_started = True
+
+
+def reset_after_fork():
+    """SQLite connections and threads must not cross os.fork()."""
+    global _flusher_started, _local
+    _flusher_started = False
+    _local = threading.local()
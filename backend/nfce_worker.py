@@ -6,55 +6,72 @@ Usage:
 
 When deployed as a separate service, set RUN_INPROCESS_WORKER=false on the
 web service so the API only enqueues to processed_urls and this worker drains it.
+
+On SIGTERM (Render deploy/restart) the worker stops picking up new records, lets
+the current one finish within NFCE_SHUTDOWN_DRAIN_SECONDS and otherwise releases
+it back to 'queued' before exiting.
 """
 
 import os
+import signal
 import sys
+import threading
 import time
-from datetime import datetime, timedelta, timezone
 
 # Ensure backend/ is in path when run directly
 sys.path.insert(0, os.path.dirname(__file__))
 
-from supabase_client import supabase
-from constants import ACTIVE_NFCE_STATUSES
+import task_queue
 
 POLL_INTERVAL_SECONDS = int(os.getenv('WORKER_POLL_INTERVAL', '5'))
-STALE_AGE_SECONDS = 120
 
 
-def _utcnow():
-    return datetime.now(timezone.utc)
+def drain_queue():
+    """Sweep orphans (if this instance holds the sweep lease), then pull runnable
+    rows from processed_urls into the staged pipeline until none are due.
+    Pulling blocks while the pipeline is full, so rows are only leased when
+    there is room to start them."""
+    task_queue.coordinated_sweep()
 
+    processed = 0
+    while not task_queue.is_shutting_down():
+        record = task_queue.pull_due_job()
+        if not record:
+            break
+        try:
+            task_queue.run_task(record['nfce_url'], record['id'], record['lane'])
+        except Exception as e:
+            print(f"[WORKER] Error processing record #{record['id']}: {e}")
+        processed += 1
 
-def drain_queue():
-    """Pick up queued/stale tasks from processed_urls and process them."""
-    from app import process_nfce_in_background
-
-    cutoff = (_utcnow() - timedelta(seconds=STALE_AGE_SECONDS)).isoformat()
-    result = supabase.table('processed_urls') \
-        .select('id, nfce_url') \
-        .in_('status', ['queued', 'processing']) \
-        .lt('processed_at', cutoff) \
-        .execute()
-
-    if result.data:
-        print(f"[WORKER] Processing {len(result.data)} queued tasks")
-        for record in result.data:
-            try:
-                process_nfce_in_background(record['nfce_url'], record['id'])
-            except Exception as e:
-                print(f"[WORKER] Error processing record #{record['id']}: {e}")
+    if processed:
+        print(f"[WORKER] Submitted {processed} queued tasks")
     else:
         print("[WORKER] No tasks pending")
 
 
+def _drain_and_exit():
+    task_queue.shutdown()
+    print("[WORKER] Drained, exiting")
+    os._exit(0)
+
+
+def _handle_sigterm(signum, frame):
+    # The main thread may be mid-extraction, so drain from a helper thread
+    print("[WORKER] SIGTERM received, draining...")
+    threading.Thread(target=_drain_and_exit, daemon=True).start()
+
+
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     print("[WORKER] economiX NFCe worker started")
     print(f"[WORKER] Polling every {POLL_INTERVAL_SECONDS}s")
-    while True:
+    while not task_queue.is_shutting_down():
         try:
             drain_queue()
         except Exception as e:
             print(f"[WORKER] Unexpected error: {e}")
         time.sleep(POLL_INTERVAL_SECONDS)
+    # Shutdown requested between jobs; let the drain thread finish the handoff
+    while True:
+        time.sleep(1)
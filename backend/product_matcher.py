@@ -0,0 +1,192 @@
+"""
+Fuzzy matching of product descriptions (NFCe receipt names vs catalog names).
+
+Receipt names are upper-case, abbreviated and unaccented ("REFRIG COCA COLA
+LT 350ML"), while Cosmos and our own catalog spell things out ("REFRIGERANTE
+COCA-COLA LATA 350ML"). Both sides are normalized first:
+
+  - accents folded, punctuation dropped, upper-cased;
+  - common NFCe abbreviations expanded (QJO -> QUEIJO, C/ -> COM, ...);
+  - sizes canonicalized (1L, 1000 ML, 1,0LT -> 1000ML; 1KG -> 1000G; 12 UN -> 12UN);
+  - filler words (DE, DA, EM, ...) removed.
+
+The "token" matcher then scores 0..1 from the similarity of the token-sorted
+strings (40%) and the squared share of query tokens the candidate covers (60%;
+a query token also counts when it is a prefix of a candidate token, since most
+NFCe abbreviations are truncations: DESN, REFRIG, BISC). A query word the
+candidate lacks costs a lot. Extra words on the catalog side are normal
+(CAFE PILAO TRAD vs CAFE TORRADO E MOIDO PILAO TRADICIONAL), but the score is
+cut by 30% when the query accounts for less than 60% of the candidate's words
+(a generic "SABONETE" vs a specific "SABONETE DOVE 90G"), again when the
+candidate has a variant word the query lacks (ZERO, DIET, LIGHT, ...), and
+again for a different package size (a different GTIN).
+
+Character similarity is the Indel ratio (2 * LCS / total length), computed with
+rapidfuzz's C implementation when it is installed and with a bit-parallel LCS
+otherwise; both give the same scores. The old difflib scorer stays available as
+PRODUCT_MATCHER=difflib. See bench_matcher.py for timings and accuracy on
+matcher_fixture.csv.
+"""
+
+import difflib
+import os
+import re
+import unicodedata
+from functools import lru_cache
+
+try:
+    from rapidfuzz.fuzz import ratio as _rapidfuzz_ratio
+except ImportError:  # optional accelerator
+    _rapidfuzz_ratio = None
+
+ABBREVIATIONS = {
+    'QJO': 'QUEIJO', 'FGO': 'FRANGO', 'PCT': 'PACOTE', 'CX': 'CAIXA', 'GF': 'GARRAFA',
+    'LT': 'LATA', 'LN': 'LONG NECK', 'T1': 'TIPO 1', 'T2': 'TIPO 2', 'TRAD': 'TRADICIONAL',
+    'ORIG': 'ORIGINAL', 'CONG': 'CONGELADO', 'RECH': 'RECHEADO', 'MIN': 'MINERAL',
+    'C/': 'COM', 'S/': 'SEM',
+}
+STOPWORDS = {'DE', 'DA', 'DO', 'DAS', 'DOS', 'E', 'EM', 'PARA', 'P/'}
+UNIT_WORDS = {'KG', 'UN', 'UND', 'UNID'}  # "sold by the kilo/unit" markers without a quantity
+
+_VOLUME = {'ML': 1, 'L': 1000, 'LT': 1000, 'LTS': 1000, 'LITRO': 1000, 'LITROS': 1000}
+_WEIGHT = {'G': 1, 'GR': 1, 'GRS': 1, 'KG': 1000, 'KGS': 1000}
+_COUNT = {'UN': 1, 'UND': 1, 'UNID': 1, 'UNIDADE': 1, 'UNIDADES': 1, 'ROLOS': 1}
+_SIZE_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(' + '|'.join(
+    sorted({*_VOLUME, *_WEIGHT, *_COUNT}, key=len, reverse=True)) + r')\b')
+
+DEFAULT_MATCHER = os.getenv('PRODUCT_MATCHER', 'token')
+THRESHOLDS = {'token': 0.8, 'difflib': 0.8}
+SORT_WEIGHT = 0.4
+SIZE_MISMATCH_FACTOR = 0.7
+UNCOVERED_FACTOR = 0.7
+MIN_CANDIDATE_COVERAGE = 0.6
+VARIANT_WORDS = {'ZERO', 'DIET', 'LIGHT', 'LACTOSE', 'INTEGRAL', 'DESNATADO', 'SEMIDESNATADO'}
+
+
+def _size_token(match) -> str:
+    amount = float(match.group(1).replace(',', '.'))
+    unit = match.group(2)
+    if unit in _VOLUME:
+        return f"{amount * _VOLUME[unit]:g}ML"
+    if unit in _WEIGHT:
+        return f"{amount * _WEIGHT[unit]:g}G"
+    return f"{amount:g}UN"
+
+
+@lru_cache(maxsize=20000)
+def normalize(name: str) -> str:
+    """Canonical form of a product description (see module docstring)."""
+    text = unicodedata.normalize('NFKD', name or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).upper()
+    text = re.sub(r'\b([CS])/\s*', r'\1/ ', text)  # C/SAL -> C/ SAL
+    text = _SIZE_RE.sub(lambda m: ' ' + _size_token(m) + ' ', text)
+    words = []
+    for word in re.sub(r"[^\w/]+", ' ', text).split():
+        word = ABBREVIATIONS.get(word, word)
+        if word in STOPWORDS or word in UNIT_WORDS:
+            continue
+        words.append(word)
+    return ' '.join(' '.join(words).split())
+
+
+def _is_size(token: str) -> bool:
+    return token[:1].isdigit() and token.endswith(('ML', 'G', 'UN'))
+
+
+def _lcs_length(a: str, b: str) -> int:
+    """Longest common subsequence length, bit-parallel (Hyyrö 2004): O(len(b)) big-int ops."""
+    if not a or not b:
+        return 0
+    masks = {}
+    for i, c in enumerate(a):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    v = full
+    for c in b:
+        u = v & masks.get(c, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(a) - v.bit_count()
+
+
+def ratio(a: str, b: str) -> float:
+    """Indel similarity 2*LCS/(len(a)+len(b)) in 0..1 (rapidfuzz.fuzz.ratio / 100)."""
+    if not a and not b:
+        return 1.0
+    if _rapidfuzz_ratio is not None:
+        return _rapidfuzz_ratio(a, b) / 100.0
+    return 2.0 * _lcs_length(a, b) / (len(a) + len(b))
+
+
+def _covers(token: str, candidate_tokens) -> bool:
+    if token in candidate_tokens:
+        return True
+    return len(token) >= 2 and not _is_size(token) and any(
+        t.startswith(token) for t in candidate_tokens)
+
+
+def token_score(query: str, candidate: str) -> float:
+    """Token matcher score in 0..1 for two descriptions (normalized here)."""
+    q_tokens = normalize(query).split()
+    c_tokens = normalize(candidate).split()
+    if not q_tokens or not c_tokens:
+        return 0.0
+    c_set = set(c_tokens)
+    sort_score = ratio(' '.join(sorted(q_tokens)), ' '.join(sorted(c_tokens)))
+    coverage = sum(_covers(t, c_set) for t in q_tokens) / len(q_tokens)
+    # An uncovered query token (INT vs DESNATADO, C/ vs S/) usually means another variant
+    score = SORT_WEIGHT * sort_score + (1 - SORT_WEIGHT) * coverage ** 2
+
+    q_sizes = {t for t in q_tokens if _is_size(t)}
+    c_sizes = {t for t in c_tokens if _is_size(t)}
+    if q_sizes and c_sizes and not q_sizes & c_sizes:
+        score *= SIZE_MISMATCH_FACTOR
+
+    # Catalog words the receipt name doesn't account for: a brand the receipt
+    # doesn't name (SABONETE vs SABONETE DOVE), or a variant it doesn't have (ZERO)
+    uncovered = [t for t in c_tokens if not _is_size(t) and not any(_covers(q, {t}) for q in q_tokens)]
+    words = sum(not _is_size(t) for t in c_tokens)
+    if words and 1 - len(uncovered) / words < MIN_CANDIDATE_COVERAGE:
+        score *= UNCOVERED_FACTOR
+    if VARIANT_WORDS.intersection(uncovered):
+        score *= UNCOVERED_FACTOR
+    return score
+
+
+def same_tokens(a: str, b: str) -> bool:
+    """True if the names differ only in abbreviation: every token of each one
+    is, or is a truncation of, a token of the other (INT / INTEGRAL)."""
+    a_tokens = normalize(a).split()
+    b_tokens = normalize(b).split()
+    return all(_covers(t, b_tokens) or any(_covers(o, {t}) for o in b_tokens) for t in a_tokens) and \
+        all(_covers(t, a_tokens) or any(_covers(o, {t}) for o in a_tokens) for t in b_tokens)
+
+
+def difflib_score(query: str, candidate: str) -> float:
+    """The original scorer: difflib ratio of the upper-cased raw strings."""
+    return difflib.SequenceMatcher(None, (query or '').upper(), (candidate or '').upper()).ratio()
+
+
+MATCHERS = {'token': token_score, 'difflib': difflib_score}
+
+
+def score(query: str, candidate: str, matcher: str = None) -> float:
+    return MATCHERS[matcher or DEFAULT_MATCHER](query, candidate)
+
+
+def threshold(matcher: str = None) -> float:
+    return THRESHOLDS[matcher or DEFAULT_MATCHER]
+
+
+def best_match(query: str, candidates, key=lambda c: c, matcher: str = None):
+    """
+    Best-scoring candidate for query. `key` extracts the description from a
+    candidate. Returns (candidate, score), or (None, -1) with no candidates;
+    compare the score with threshold() to decide whether it is a match.
+    """
+    scorer = MATCHERS[matcher or DEFAULT_MATCHER]
+    best, best_score = None, -1.0
+    for candidate in candidates:
+        candidate_score = scorer(query, key(candidate) or '')
+        if candidate_score > best_score:
+            best, best_score = candidate, candidate_score
+    return best, best_score
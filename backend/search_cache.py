@@ -0,0 +1,101 @@
+"""
+In-process LRU cache for Cosmos product searches.
+
+Receipts repeat the same descriptions ("PAO FRANCES KG", "BANANA NANICA KG")
+over and over, so search_product_on_cosmos results are kept per process,
+keyed by the normalized query plus the NCM filter. Confident matches and
+"no confident match" outcomes are both cached; rate limits and HTTP or
+network errors are not. Entries live for COSMOS_SEARCH_CACHE_TTL_HOURS and
+the cache holds at most COSMOS_SEARCH_CACHE_SIZE of them.
+
+Threads asking for a key that is already being searched wait for that
+search instead of issuing their own.
+"""
+
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+TTL_SECONDS = float(os.getenv('COSMOS_SEARCH_CACHE_TTL_HOURS', '24')) * 3600
+MAX_ENTRIES = max(1, int(os.getenv('COSMOS_SEARCH_CACHE_SIZE', '5000')))
+WAIT_TIMEOUT_SECONDS = 30
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # key -> (value, expires_at monotonic)
+_loading = {}  # key -> threading.Event
+_stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'expired': 0}
+
+
+def normalize(query: str) -> str:
+    """Upper-case, accents and punctuation removed, whitespace collapsed."""
+    text = unicodedata.normalize('NFKD', query or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).upper()
+    return ' '.join(re.sub(r'[^\w]+', ' ', text).split())
+
+
+def key_for(query: str, ncm_filter=None):
+    return normalize(query), ncm_filter or ''
+
+
+def _lookup(key, now):
+    cached = _entries.get(key)
+    if cached is None:
+        return None
+    if cached[1] <= now:
+        del _entries[key]
+        _stats['expired'] += 1
+        return None
+    _entries.move_to_end(key)
+    return cached
+
+
+def get_or_load(key, loader, cacheable):
+    """
+    Cached value for key, else loader() - whose result is stored when
+    cacheable(result) is true. Returns (value, from_cache).
+    """
+    while True:
+        with _lock:
+            cached = _lookup(key, time.monotonic())
+            if cached is not None:
+                _stats['hits'] += 1
+                return cached[0], True
+            event = _loading.get(key)
+            if event is None:
+                _loading[key] = threading.Event()
+                _stats['misses'] += 1
+                break
+            _stats['coalesced'] += 1
+        # Another thread is searching this key; use its answer (or load it ourselves if it fails)
+        if not event.wait(WAIT_TIMEOUT_SECONDS):
+            with _lock:
+                _stats['misses'] += 1
+            return loader(), False
+
+    try:
+        value = loader()
+        if cacheable(value):
+            with _lock:
+                _entries[key] = (value, time.monotonic() + TTL_SECONDS)
+                _entries.move_to_end(key)
+                while len(_entries) > MAX_ENTRIES:
+                    _entries.popitem(last=False)
+                    _stats['evictions'] += 1
+        return value, False
+    finally:
+        with _lock:
+            _loading.pop(key).set()
+
+
+def stats() -> dict:
+    with _lock:
+        lookups = _stats['hits'] + _stats['misses']
+        return {
+            **_stats,
+            'entries': len(_entries),
+            'max_entries': MAX_ENTRIES,
+            'hit_rate': round(_stats['hits'] / lookups, 3) if lookups else 0.0,
+        }
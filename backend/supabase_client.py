@@ -32,3 +32,13 @@ if not SUPABASE_JWT_SECRET:
     )
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+
+
+def or_filter(query, filters: str):
+    """Add a PostgREST or=(...) filter to a query builder.
+
+    postgrest-py 0.13 (pinned through supabase 2.3.5) has no .or_(). `filters`
+    is used as is, so quote values with reserved characters yourself.
+    """
+    query.params = query.params.add('or', f'({filters})')
+    return query
@@ -1,6 +1,7 @@
 """
 Supabase Migration Script - Full Architecture (RESTORED)
-Creates: markets, purchases, unique_products, processed_urls, product_backlog, product_lookup_log, system_locks
+Creates: markets, purchases, unique_products, processed_urls, product_backlog, product_lookup_log, system_locks,
+gtin_cache
 """
 
 import os
@@ -28,7 +29,6 @@ DROP TABLE IF EXISTS purchases CASCADE;
 DROP TABLE IF EXISTS processed_urls CASCADE;
 DROP TABLE IF EXISTS markets CASCADE;
 DROP TABLE IF EXISTS llm_product_decisions CASCADE;
-DROP TABLE IF EXISTS gtin_cache CASCADE;
 DROP TABLE IF EXISTS products CASCADE;
 
 -- ============================================================================
@@ -136,6 +136,19 @@ CREATE TABLE system_locks (
     updated_at TIMESTAMP DEFAULT NOW()
 );
 
+-- 8. GTIN Cache (shared Cosmos lookups, see migration_gtin_cache.sql)
+-- Kept across schema resets: entries are keyed by GTIN only and expire on their own
+CREATE TABLE IF NOT EXISTS gtin_cache (
+    gtin VARCHAR(50) PRIMARY KEY,
+    found BOOLEAN NOT NULL,
+    product_name VARCHAR(500),
+    brand VARCHAR(200),
+    image_url TEXT,
+    ncm VARCHAR(8),
+    fetched_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
 -- Indexes for performance
 CREATE INDEX idx_market_id ON markets(market_id);
 CREATE INDEX idx_purchases_enriched ON purchases(enriched);
@@ -144,6 +157,7 @@ CREATE INDEX idx_unique_products_ean ON unique_products(ean);
 CREATE INDEX idx_unique_products_name ON unique_products(product_name);
 CREATE INDEX idx_processed_status ON processed_urls(status);
 CREATE INDEX idx_processed_original_url ON processed_urls(original_url);
+CREATE INDEX IF NOT EXISTS idx_gtin_cache_expires_at ON gtin_cache(expires_at);
 """
 
     print("\nCopy and run this SQL in Supabase SQL Editor:")
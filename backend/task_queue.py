@@ -1,35 +1,83 @@
 """
-NFCe Task Queue - Single-threaded background processor.
+NFCe Task Queue - in-process intake for the staged NFCe pipeline.
 
 Replaces the thread-per-request pattern with a single daemon consumer thread
-and an in-process queue. This prevents thread explosion (50 threads -> 1 thread)
-and keeps memory usage under the 512MB Render limit.
+and an in-process queue. The consumer feeds nfce_pipeline, whose fixed-size
+stage pools do the actual work, so thread count stays bounded and memory usage
+stays under the 512MB Render limit.
 
 The database lock (acquire_extraction_lock) still coordinates across Gunicorn workers.
+
+processed_urls is the shared queue: a row is runnable when status='queued' and
+next_attempt_at <= now. Fresh submissions are pushed to the local queue of the
+worker that received them, and inserted with a pickup lease (first_attempt_at)
+so other pollers leave them to it; retries (nfce_retry.py), handed-off jobs and swept
+orphans are pulled by whichever consumer is idle, one row at a time, under a short
+pickup lease. The orphan sweep itself runs in one process per cluster at a time,
+guarded by a lease row in system_locks.
+
+On worker exit, shutdown() stops dequeuing, gives in-flight pipeline jobs a
+deadline to finish and hands jobs that never started back to the database
+queue. Jobs still running keep their lease until the process is gone and are
+then reclaimed by the orphan sweep.
 """
 
 import os
 import queue
+import socket
 import threading
 import time
 from datetime import datetime, timedelta, timezone
 
-_task_queue = queue.Queue()
+import nfce_lease
+import nfce_pipeline
+from constants import (
+    STATUS_QUEUED, STATUS_PROCESSING, STATUS_EXTRACTING, STATUS_DEAD,
+    MARKET_ID_QUEUED, MARKET_ID_UNRESOLVED, LANE_INTERACTIVE, LANES,
+)
+from nfce_lanes import LaneQueue, LaneSelector, normalize as normalize_lane
+
+_task_queue = LaneQueue()
+_pull_selector = LaneSelector()
+_pending_ids = set()
+_pending_lock = threading.Lock()
 _worker_started = False
 _worker_lock = threading.Lock()
 
-STALE_RECOVERY_AGE_SECONDS = 120
+_shutdown_event = threading.Event()
+
+RETRY_POLL_INTERVAL_SECONDS = int(os.getenv('NFCE_RETRY_POLL_INTERVAL', '15'))
+PICKUP_LEASE_SECONDS = 60  # a pulled row is hidden from other pollers until its claim
+ORPHAN_SWEEP_LOCK_NAME = 'nfce_orphan_sweep'
+ORPHAN_SWEEP_INTERVAL_SECONDS = int(os.getenv('NFCE_ORPHAN_SWEEP_INTERVAL', '15'))
+_last_sweep_attempt = 0.0
+SHUTDOWN_DRAIN_SECONDS = int(os.getenv('NFCE_SHUTDOWN_DRAIN_SECONDS', '20'))
+
+
+def run_task(url: str, record_id: int, lane: str = LANE_INTERACTIVE):
+    """Submit one NFCe job to the staged pipeline. Blocks while the pipeline is full."""
+    nfce_pipeline.submit(url, record_id, lane=lane)
 
 
 def _consumer_loop():
-    """Single consumer thread that processes NFCe tasks sequentially."""
-    while True:
+    """Single consumer thread that feeds NFCe tasks into the pipeline."""
+    while not _shutdown_event.is_set():
+        try:
+            url, record_id, lane = _task_queue.get(block=True, timeout=RETRY_POLL_INTERVAL_SECONDS)
+        except queue.Empty:
+            _on_idle()
+            continue
+
         try:
-            url, record_id = _task_queue.get(block=True)
-            print(f"[QUEUE] Dequeued record #{record_id}, {_task_queue.qsize()} remaining")
+            if _shutdown_event.is_set():
+                break  # leave it in _pending_ids; shutdown() hands it back
+            print(f"[QUEUE] Dequeued {lane} record #{record_id}, {_task_queue.qsize()} remaining")
 
-            from app import process_nfce_in_background
-            process_nfce_in_background(url, record_id)
+            run_task(url, record_id, lane)
+            with _pending_lock:
+                _pending_ids.discard(record_id)
+            if _task_queue.empty() and not _shutdown_event.is_set():
+                _on_idle()
 
         except Exception as e:
             print(f"[QUEUE] Consumer error: {e}")
@@ -37,11 +85,28 @@ def _consumer_loop():
             traceback.print_exc()
         finally:
             _task_queue.task_done()
+    print("[QUEUE] Consumer thread stopped")
+
+
+def inprocess_enabled() -> bool:
+    return os.getenv('RUN_INPROCESS_WORKER', 'true').lower() != 'false'
+
+
+def first_attempt_at(now: datetime) -> datetime:
+    """
+    next_attempt_at for a fresh row this process will push onto its own queue.
+    Like a pulled row, it is hidden from other pollers for PICKUP_LEASE_SECONDS
+    so they don't claim it while the local consumer is getting to it; if this
+    process dies first, the row simply becomes due.
+    """
+    if not inprocess_enabled():
+        return now  # a separate worker service pulls it from the DB
+    return now + timedelta(seconds=PICKUP_LEASE_SECONDS)
 
 
 def _ensure_worker_started():
     """Start the consumer thread once, if RUN_INPROCESS_WORKER is enabled."""
-    if os.getenv('RUN_INPROCESS_WORKER', 'true').lower() == 'false':
+    if not inprocess_enabled():
         return  # Extraction handled by a separate worker service
     global _worker_started
     if _worker_started:
@@ -59,13 +124,22 @@ def reset_after_fork():
     """Reset thread state after Gunicorn fork. Threads don't survive os.fork()."""
     global _worker_started
     _worker_started = False
+    nfce_pipeline.reset_after_fork()
 
 
-def enqueue_nfce(url: str, record_id: int):
-    """Add an NFCe URL to the processing queue. Starts the consumer if needed."""
+def enqueue_nfce(url: str, record_id: int, lane: str = LANE_INTERACTIVE):
+    """Add an NFCe URL to the processing queue. Starts the consumer if needed.
+    A record already waiting in this process's queue is not added twice."""
+    if _shutdown_event.is_set():
+        print(f"[QUEUE] Shutting down, record #{record_id} left for another worker")
+        return
     _ensure_worker_started()
-    _task_queue.put((url, record_id))
-    print(f"[QUEUE] Enqueued record #{record_id}, queue size: {_task_queue.qsize()}")
+    with _pending_lock:
+        if record_id in _pending_ids:
+            return
+        _pending_ids.add(record_id)
+    _task_queue.put((url, record_id, normalize_lane(lane)))
+    print(f"[QUEUE] Enqueued {lane} record #{record_id}, queue size: {_task_queue.qsize()}")
 
 
 def is_empty() -> bool:
@@ -77,30 +151,254 @@ def queue_size() -> int:
     return _task_queue.qsize()
 
 
-def recover_orphaned_tasks():
+def lane_stats() -> dict:
+    """Per-lane depth and lag of this process's local queue."""
+    return _task_queue.stats()
+
+
+def is_shutting_down() -> bool:
+    return _shutdown_event.is_set()
+
+
+def shutdown(timeout: float = SHUTDOWN_DRAIN_SECONDS):
     """
-    On startup, find records stuck in 'queued' or 'processing' and re-enqueue them.
-    Handles items orphaned by worker restarts or crashes.
+    Graceful drain for worker exit (Gunicorn recycle, deploy, SIGTERM).
+
+    Stops dequeuing immediately and waits up to `timeout` seconds for jobs
+    already in the pipeline to finish. Jobs still waiting in the local queue
+    get next_attempt_at = now so the next worker picks them up right away
+    instead of waiting out the pickup lease.
+
+    Jobs still running are left alone: their threads may yet write the row,
+    and those writes must not land on a row another worker has reclaimed.
+    Their leases lapse when this process exits, and the orphan sweep
+    reclaims them (as a failed attempt) a lease later.
     """
-    if os.getenv('RUN_INPROCESS_WORKER', 'true').lower() == 'false':
-        print("[QUEUE] RUN_INPROCESS_WORKER=false — skipping orphan recovery (handled by worker service)")
+    _shutdown_event.set()
+    if nfce_pipeline.in_flight_count():
+        print(f"[QUEUE] Shutdown: waiting up to {timeout}s for {nfce_pipeline.in_flight_count()} in-flight jobs")
+    drained = nfce_pipeline.wait_idle(timeout)
+
+    unfinished = set() if drained else set(nfce_pipeline.in_flight_ids())
+    with _pending_lock:
+        pending = list(set(_pending_ids) - unfinished)
+        _pending_ids.clear()
+    if unfinished:
+        print(f"[QUEUE] Shutdown: {len(unfinished)} jobs still running, "
+              f"left for the orphan sweep once their lease expires")
+
+    if not pending:
+        print("[QUEUE] Shutdown: nothing to hand off")
         return
+
     try:
         from supabase_client import supabase
 
-        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=STALE_RECOVERY_AGE_SECONDS)).isoformat()
+        now = datetime.now(timezone.utc).isoformat()
+        supabase.table('processed_urls').update({
+            'next_attempt_at': now,
+        }).in_('id', pending).eq('status', STATUS_QUEUED).execute()
+        print(f"[QUEUE] Shutdown: handed off {len(pending)} queued records")
+    except Exception as e:
+        print(f"[QUEUE] Shutdown handoff error: {e}")
 
-        result = supabase.table('processed_urls') \
-            .select('id, nfce_url') \
-            .in_('status', ['queued', 'processing']) \
-            .lt('processed_at', cutoff) \
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def pull_due_job():
+    """
+    Take the oldest runnable row from the shared queue, or None.
+
+    The row is leased by pushing next_attempt_at PICKUP_LEASE_SECONDS forward,
+    conditional on it being unchanged, so concurrent pollers never pull the same
+    row. The claim (resolve stage) clears the pickup lease; if this process
+    dies first, the row simply becomes due again.
+
+    Interactive rows go first; batch rows get their reserved share (nfce_lanes).
+    """
+    from supabase_client import supabase
+
+    now = _utcnow()
+    candidates = {}
+    for lane in LANES:
+        candidates[lane] = supabase.table('processed_urls') \
+            .select('id, nfce_url, next_attempt_at, lane') \
+            .eq('status', STATUS_QUEUED) \
+            .eq('lane', lane) \
+            .lte('next_attempt_at', now.isoformat()) \
+            .order('next_attempt_at') \
+            .limit(3) \
+            .execute().data or []
+
+    first = _pull_selector.choose(*(bool(candidates[lane]) for lane in LANES))
+    if first is None:
+        return None
+    ordered = candidates[first] + [row for lane in LANES if lane != first for row in candidates[lane]]
+
+    for row in ordered:
+        leased = supabase.table('processed_urls') \
+            .update({'next_attempt_at': (now + timedelta(seconds=PICKUP_LEASE_SECONDS)).isoformat()}) \
+            .eq('id', row['id']) \
+            .eq('status', STATUS_QUEUED) \
+            .eq('next_attempt_at', row['next_attempt_at']) \
+            .execute()
+        if leased.data:
+            return row
+    return None
+
+
+def _on_idle():
+    """Idle hook: run the orphan sweep if it's our turn, then pull one due job
+    if the pipeline has room for it."""
+    global _last_sweep_attempt
+    try:
+        if time.monotonic() - _last_sweep_attempt >= ORPHAN_SWEEP_INTERVAL_SECONDS:
+            _last_sweep_attempt = time.monotonic()
+            coordinated_sweep()
+        if not nfce_pipeline.has_capacity():
+            return
+        job = pull_due_job()
+        if job:
+            enqueue_nfce(job['nfce_url'], job['id'], job['lane'])
+    except Exception as e:
+        print(f"[QUEUE] Idle poll error: {e}")
+
+
+def _acquire_sweep_lease() -> bool:
+    """
+    Take the cluster-wide orphan sweep lease (system_locks row).
+
+    The lease is never released: it expires ORPHAN_SWEEP_INTERVAL_SECONDS after
+    it was taken, which also limits sweeps to one per interval across all workers.
+    Both paths are single statements, so two workers cannot win at once.
+    """
+    from supabase_client import supabase
+
+    now = _utcnow()
+    expired_before = (now - timedelta(seconds=ORPHAN_SWEEP_INTERVAL_SECONDS)).isoformat()
+    lease = {
+        'status': 'locked',
+        'locked_by': _owner_id(),
+        'locked_at': now.isoformat(),
+        'updated_at': now.isoformat(),
+    }
+
+    taken = supabase.table('system_locks') \
+        .update(lease) \
+        .eq('lock_name', ORPHAN_SWEEP_LOCK_NAME) \
+        .lt('locked_at', expired_before) \
+        .execute()
+    if taken.data:
+        return True
+
+    try:
+        supabase.table('system_locks').insert({'lock_name': ORPHAN_SWEEP_LOCK_NAME, **lease}).execute()
+        return True
+    except Exception:
+        return False  # row exists and the lease is still held
+
+
+def sweep_orphans() -> int:
+    """
+    Make jobs nobody is working on runnable again through the shared queue.
+
+    Targets 'processing' and 'extracting' rows whose heartbeat lease (nfce_lease)
+    expired, which belonged to a worker that died mid-job and counts as a failed
+    attempt: they are put back to 'queued', or dead-lettered once
+    NFCE_MAX_ATTEMPTS is reached. An orphaned 'extracting' row also frees its
+    extraction slot, even when no job is waiting for one.
+    Also promotes legacy 'queued' rows that were never scheduled (next_attempt_at
+    is null). Returns the number of rows made runnable.
+    """
+    from supabase_client import supabase
+    from nfce_retry import MAX_ATTEMPTS
+
+    now = _utcnow().isoformat()
+    cutoff = (_utcnow() - timedelta(seconds=nfce_lease.LEASE_SECONDS)).isoformat()
+
+    expired = nfce_lease.filter_expired(
+        supabase.table('processed_urls')
+        .select('id, status, attempts')
+        .in_('status', [STATUS_PROCESSING, STATUS_EXTRACTING])
+    ).execute()
+    unscheduled = supabase.table('processed_urls') \
+        .select('id, status, attempts') \
+        .eq('status', STATUS_QUEUED) \
+        .is_('next_attempt_at', 'null') \
+        .lt('processed_at', cutoff) \
+        .execute()
+
+    recovered = 0
+    stale_queued = []
+    for record in (expired.data or []) + (unscheduled.data or []):
+        if record['status'] == STATUS_QUEUED:
+            stale_queued.append(record['id'])
+            continue
+        attempts = (record.get('attempts') or 0) + 1
+        # Re-check the lease in the update itself: the owner may have renewed meanwhile
+        if attempts >= MAX_ATTEMPTS:
+            nfce_lease.filter_expired(supabase.table('processed_urls').update({
+                'status': STATUS_DEAD,
+                'market_id': MARKET_ID_UNRESOLVED,
+                'attempts': attempts,
+                'error_message': 'Worker morreu durante o processamento (tentativas esgotadas)',
+            }).eq('id', record['id']).eq('status', record['status'])).execute()
+            print(f"[QUEUE] Record #{record['id']} dead-lettered after {attempts} attempts")
+            continue
+        reset = nfce_lease.filter_expired(supabase.table('processed_urls').update({
+            'status': STATUS_QUEUED,
+            'market_id': MARKET_ID_QUEUED,
+            'attempts': attempts,
+            'next_attempt_at': now,
+        }).eq('id', record['id']).eq('status', record['status'])).execute()
+        recovered += len(reset.data or [])
+
+    if stale_queued:
+        promoted = supabase.table('processed_urls') \
+            .update({'next_attempt_at': now}) \
+            .in_('id', stale_queued) \
+            .eq('status', STATUS_QUEUED) \
+            .is_('next_attempt_at', 'null') \
             .execute()
+        recovered += len(promoted.data or [])
+
+    return recovered
+
 
-        if result.data:
-            print(f"[QUEUE] Recovering {len(result.data)} orphaned tasks")
-            for record in result.data:
-                enqueue_nfce(record['nfce_url'], record['id'])
-        else:
+def coordinated_sweep():
+    """Run sweep_orphans() if this process holds the cluster-wide sweep lease.
+    Returns the number of recovered rows, or None if another process holds it."""
+    if not _acquire_sweep_lease():
+        return None
+    recovered = sweep_orphans()
+    if recovered:
+        print(f"[QUEUE] Orphan sweep made {recovered} jobs runnable")
+    return recovered
+
+
+def recover_orphaned_tasks():
+    """
+    On startup, start the consumer and sweep records orphaned by worker restarts
+    or crashes back into the shared queue. Only one process per cluster sweeps at
+    a time; idle consumers in every worker then pull the recovered jobs.
+    """
+    global _last_sweep_attempt
+    if os.getenv('RUN_INPROCESS_WORKER', 'true').lower() == 'false':
+        print("[QUEUE] RUN_INPROCESS_WORKER=false — skipping orphan recovery (handled by worker service)")
+        return
+    _ensure_worker_started()  # idle consumers pull due retries and recovered jobs
+    try:
+        _last_sweep_attempt = time.monotonic()
+        recovered = coordinated_sweep()
+        if recovered is None:
+            print("[QUEUE] Orphan sweep lease held by another process, skipping")
+        elif not recovered:
             print("[QUEUE] No orphaned tasks found")
 
     except Exception as e:
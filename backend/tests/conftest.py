@@ -0,0 +1,146 @@
+"""
+Shared fixtures for the backend tests.
+
+The real supabase client is used, pointed at a fake URL, with its PostgREST
+session routed to an in-memory handler. Queries are built exactly as in
+production (filters, quoting, upsert headers); `rest.requests` records them
+and `rest.handler` decides what each one returns. Tables is a handler that
+applies the filters the code uses to in-memory rows.
+"""
+
+import json
+import os
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SUPABASE_URL', 'http://supabase.test')
+os.environ.setdefault('SUPABASE_SERVICE_ROLE_KEY', 'test.service.role')
+
+from supabase_client import supabase  # noqa: E402
+
+
+class FakeRest:
+    def __init__(self):
+        self.requests = []
+        self.handler = lambda request: []
+
+    def __call__(self, http_request):
+        path = http_request.url.path.split('/rest/v1/', 1)[1]
+        request = SimpleNamespace(
+            method=http_request.method,
+            table=path,
+            params=dict(http_request.url.params),
+            body=json.loads(http_request.content) if http_request.content else None,
+            prefer=http_request.headers.get('prefer', ''),
+        )
+        self.requests.append(request)
+        result = self.handler(request)
+        if isinstance(result, httpx.Response):
+            return result
+        return httpx.Response(200, json=result)
+
+    def to(self, table, method=None):
+        return [r for r in self.requests if r.table == table and (method is None or r.method == method)]
+
+
+def _split_top_level(text):
+    parts, depth, quoted, current = [], 0, False, ''
+    for c in text:
+        if c == '"':
+            quoted = not quoted
+        elif c == '(' and not quoted:
+            depth += 1
+        elif c == ')' and not quoted:
+            depth -= 1
+        elif c == ',' and not quoted and depth == 0:
+            parts.append(current)
+            current = ''
+            continue
+        current += c
+    return parts + [current]
+
+
+def _value(text):
+    return text[1:-1] if text.startswith('"') and text.endswith('"') else text
+
+
+def _ordered(a, b):
+    """a and b as comparable values: timestamps, numbers, else strings."""
+    for parse in (datetime.fromisoformat, float):
+        try:
+            return parse(str(a)), parse(str(b))
+        except ValueError:
+            pass
+    return str(a), str(b)
+
+
+def _text(value):
+    return str(value).lower() if isinstance(value, bool) else str(value)
+
+
+def _matches(row, column, condition):
+    op, _, arg = condition.partition('.')
+    if op == 'not':
+        return not _matches(row, column, arg)
+    value = row.get(column)
+    if op == 'is':
+        return value is None if arg == 'null' else _text(value) == arg
+    if op == 'in':
+        return _text(value) in {_value(v) for v in _split_top_level(arg[1:-1])}
+    if value is None:
+        return False
+    if op in ('eq', 'neq'):
+        # eq(col, True) is sent as eq.True; Postgres reads booleans case-insensitively
+        expected = _value(arg).lower() if isinstance(value, bool) else _value(arg)
+        return (_text(value) == expected) == (op == 'eq')
+    left, right = _ordered(value, _value(arg))
+    return {'lt': left < right, 'lte': left <= right, 'gt': left > right, 'gte': left >= right}[op]
+
+
+class Tables:
+    """In-memory tables for select / update (PATCH) with eq, neq, in, is, lt(e), gt(e) and or filters."""
+
+    CONTROL_PARAMS = {'select', 'order', 'limit', 'offset', 'on_conflict', 'columns'}
+
+    def __init__(self, **tables):
+        self.tables = {name: [dict(row) for row in rows] for name, rows in tables.items()}
+
+    def rows(self, table):
+        return self.tables.setdefault(table, [])
+
+    def _filter(self, request):
+        rows = self.rows(request.table)
+        for column, condition in request.params.items():
+            if column in self.CONTROL_PARAMS:
+                continue
+            if column == 'or':
+                terms = [t.split('.', 1) for t in _split_top_level(condition[1:-1])]
+                rows = [r for r in rows if any(_matches(r, col, cond) for col, cond in terms)]
+            else:
+                rows = [r for r in rows if _matches(r, column, condition)]
+        return rows
+
+    def __call__(self, request):
+        matched = self._filter(request)
+        if request.method == 'PATCH':
+            for row in matched:
+                row.update(request.body)
+        return [dict(row) for row in matched]
+
+
+def error_response(code, message):
+    """A PostgREST error body, as raised by execute() as APIError."""
+    return httpx.Response(409 if code == '23505' else 500, json={
+        'code': code, 'message': message, 'details': None, 'hint': None})
+
+
+@pytest.fixture
+def rest(monkeypatch):
+    fake = FakeRest()
+    monkeypatch.setattr(supabase.postgrest.session, '_transport', httpx.MockTransport(fake))
+    return fake
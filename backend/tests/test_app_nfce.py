@@ -0,0 +1,60 @@
+import app
+
+
+def test_release_only_writes_a_row_that_is_still_claimed(rest):
+    rest.handler = lambda request: []  # the sweep already took the row back
+
+    app.fail_nfce_job(42, 1, 'timeout', 'Timeout')
+
+    write = rest.to('processed_urls', 'PATCH')[0]
+    assert write.params['id'] == 'eq.42'
+    assert write.params['status'] == 'in.(processing,extracting)'
+
+
+def test_fallback_claim_starts_a_fresh_lease_window(rest, monkeypatch):
+    from datetime import datetime, timedelta, timezone
+    import task_queue
+    from conftest import Tables
+
+    url = 'https://www.sefaz.rs.gov.br/NFCE/NFCE-COM.aspx?p=43240100000000000001650010000000011000000001|2|1'
+    long_ago = (datetime.now(timezone.utc) - timedelta(hours=1)).isoformat()
+    tables = Tables(processed_urls=[{
+        'id': 7, 'status': 'queued', 'nfce_url': url, 'original_url': url, 'attempts': 1,
+        'processed_at': long_ago, 'next_attempt_at': long_ago, 'lease_expires_at': long_ago,
+    }])
+    rest.handler = tables
+    monkeypatch.setattr(app, 'resolve_nfce_url', lambda raw_url: raw_url)
+    swept_during_resolve = []
+
+    def check_duplicate(resolved_url, exclude_id=None):
+        # The orphan sweep runs while the job is still resolving, before its first lease renewal
+        swept_during_resolve.append(task_queue.sweep_orphans())
+        return None
+    monkeypatch.setattr(app, '_check_nfce_duplicate', check_duplicate)
+
+    app._claim_and_resolve_fallback(app.new_nfce_job(url, 7), url)
+
+    # The lease left by the earlier attempt doesn't count against the new claim
+    assert swept_during_resolve == [0]
+    assert tables.rows('processed_urls')[0]['status'] == 'processing'
+
+
+def test_fetch_gives_the_slot_back_when_another_job_took_the_host(rest, monkeypatch):
+    import nfce_extractor
+    import nfce_hosts
+
+    events = []
+    host_free = iter([False, True])
+    monkeypatch.setattr(nfce_hosts, 'wait_ready', lambda host: events.append('wait_host'))
+    monkeypatch.setattr(nfce_hosts, 'try_start_load', lambda host, requested_at: next(host_free))
+    monkeypatch.setattr(nfce_hosts, 'end_load', lambda host: events.append('end_load'))
+    monkeypatch.setattr(app, 'acquire_extraction_lock', lambda record_id, max_wait_seconds: events.append('slot') or True)
+    monkeypatch.setattr(app, '_free_extraction_slot', lambda record_id: events.append('free_slot'))
+    monkeypatch.setattr(nfce_extractor, 'fetch_nfce_html', lambda url, headless: '<html></html>')
+    job = app.new_nfce_job('https://nfce.example.test/?p=1', 7)
+    job['resolved_url'] = job['url']
+
+    assert app._fetch_nfce_page(job, 'nfce.example.test')
+
+    assert job['html'] == '<html></html>'
+    assert events == ['wait_host', 'slot', 'free_slot', 'wait_host', 'slot', 'end_load', 'free_slot']
@@ -0,0 +1,52 @@
+import pytest
+
+import discovered_index
+from conftest import Tables
+
+LOG = [
+    {'id': 1, 'original_name': 'LEITE UHT INTEGRAL ITALAC 1L', 'ncm': '04012010', 'final_name': 'Leite Italac',
+     'gtin': '7898080640017', 'success': True},
+    {'id': 2, 'original_name': 'REFRIG COCA COLA 2L', 'ncm': '22021000', 'final_name': 'Coca-Cola 2L',
+     'gtin': '7894900011517', 'success': True},
+    {'id': 3, 'original_name': 'SABAO PO OMO 1KG', 'ncm': '34022000', 'final_name': None,
+     'gtin': None, 'success': False},
+]
+
+
+@pytest.fixture(autouse=True)
+def fresh_index(monkeypatch):
+    monkeypatch.setattr(discovered_index, '_entries', {})
+    monkeypatch.setattr(discovered_index, '_names_by_ncm', {})
+    monkeypatch.setattr(discovered_index, '_last_id', 0)
+    monkeypatch.setattr(discovered_index, '_ready', False)
+    monkeypatch.setattr(discovered_index, 'FUZZY_ENABLED', True)
+
+
+def test_refresh_loads_successful_lookups_then_only_new_rows(rest):
+    tables = Tables(product_lookup_log=LOG)
+    rest.handler = tables
+
+    assert discovered_index.refresh() == 2
+    assert discovered_index.ready()
+    assert discovered_index.get('REFRIG. COCA-COLA 2 L', '22021000') == ('7894900011517', 'Coca-Cola 2L')
+    assert discovered_index.get('SABAO PO OMO 1KG', '34022000') is None
+
+    tables.rows('product_lookup_log').append({
+        'id': 4, 'original_name': 'ARROZ TIO JOAO 5KG', 'ncm': '10063021', 'final_name': 'Arroz Tio Joao',
+        'gtin': '7893500018230', 'success': True})
+    assert discovered_index.refresh() == 1
+    assert rest.to('product_lookup_log', 'GET')[-1].params['id'] == 'gt.2'
+
+
+def test_fuzzy_fallback_accepts_abbreviations_but_not_other_variants(rest):
+    rest.handler = Tables(product_lookup_log=LOG)
+    discovered_index.refresh()
+
+    assert discovered_index.get('LEITE UHT INT ITALAC 1L', '04012010') == ('7898080640017', 'Leite Italac')
+    assert discovered_index.get('REFRIG COCA COLA ZERO 2L', '22021000') is None
+    assert discovered_index.get('REFRIG COCA COLA 2L', '99999999') is None
+
+
+def test_record_adds_new_discoveries():
+    discovered_index.record('CAFE PILAO 500G', '09012100', '7896089011983', 'Cafe Pilao')
+    assert discovered_index.get('CAFE PILAO 500 G', '09012100') == ('7896089011983', 'Cafe Pilao')
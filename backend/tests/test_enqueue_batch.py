@@ -0,0 +1,33 @@
+import enqueue_batch
+
+URLS = [
+    'https://www.sefaz.rs.gov.br/NFCE/NFCE-COM.aspx?p=43240112345678000190650010000012341000012345|2|1|1|ABC',
+    'https://www.nfce.fazenda.sp.gov.br/qrcode?p=35240112345678000190650010000056781000056789,2,1',
+]
+
+
+def test_existing_urls_filter_quotes_each_url_once(rest):
+    enqueue_batch.existing_urls(URLS)
+
+    filters = [r.params.get('original_url') or r.params.get('nfce_url') for r in rest.to('processed_urls')]
+    expected = 'in.({})'.format(','.join('"{}"'.format(url) for url in URLS))
+    assert filters == [expected, expected]
+
+
+def test_existing_urls_returns_urls_known_in_either_column(rest):
+    def handler(request):
+        if 'original_url' in request.params:
+            return [{'original_url': URLS[0]}]
+        return [{'nfce_url': URLS[1]}]
+    rest.handler = handler
+
+    assert enqueue_batch.existing_urls(URLS + ['https://example.test/new']) == set(URLS)
+
+
+def test_existing_urls_queries_in_chunks(rest, monkeypatch):
+    monkeypatch.setattr(enqueue_batch, 'CHUNK_SIZE', 2)
+    urls = ['https://example.test/{}'.format(i) for i in range(5)]
+
+    enqueue_batch.existing_urls(urls)
+
+    assert len(rest.to('processed_urls')) == 6  # 3 chunks x 2 columns
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+import enrichment_trigger
+import enrichment_worker
+
+
+@pytest.fixture(autouse=True)
+def fresh_trigger(monkeypatch):
+    enrichment_trigger.reset_after_fork()
+    monkeypatch.setattr(enrichment_trigger, 'DEBOUNCE_SECONDS', 0.05)
+    monkeypatch.setattr(enrichment_trigger, '_stats', {'events': 0, 'coalesced': 0, 'runs': 0, 'errors': 0})
+    yield
+    enrichment_trigger.reset_after_fork()
+
+
+def wait_idle():
+    deadline = time.monotonic() + 5
+    while enrichment_trigger.stats()['running'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_a_burst_of_events_becomes_one_run(monkeypatch):
+    runs = []
+    monkeypatch.setattr(enrichment_worker, 'process_pending_purchases', runs.append)
+
+    assert enrichment_trigger.request('scan-1')
+    assert not any([enrichment_trigger.request(f'scan-{i}') for i in range(2, 11)])
+    wait_idle()
+
+    assert runs == ['scan-10']
+    assert enrichment_trigger.stats()['coalesced'] == 9
+
+
+def test_events_during_a_run_cause_one_more_run(monkeypatch):
+    running, release = threading.Event(), threading.Event()
+    runs = []
+
+    def process(worker_id):
+        runs.append(worker_id)
+        running.set()
+        release.wait(5)
+
+    monkeypatch.setattr(enrichment_worker, 'process_pending_purchases', process)
+    enrichment_trigger.request('first')
+    running.wait(5)
+    enrichment_trigger.request('second')
+    enrichment_trigger.request('third')
+    release.set()
+    wait_idle()
+
+    assert runs == ['first', 'third']
+
+
+def test_a_failed_run_does_not_stop_the_runner(monkeypatch):
+    def process(worker_id):
+        raise RuntimeError('database unavailable')
+
+    monkeypatch.setattr(enrichment_worker, 'process_pending_purchases', process)
+    enrichment_trigger.request()
+    wait_idle()
+
+    assert enrichment_trigger.stats()['errors'] == 1
+    assert not enrichment_trigger.stats()['pending']
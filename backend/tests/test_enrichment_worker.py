@@ -0,0 +1,89 @@
+import pytest
+
+import discovered_index
+import enrichment_worker
+from conftest import error_response
+
+GOOD_EAN = '7894900011517'
+BAD_EAN = '7891000100103'
+
+
+def purchase(row_id, ean):
+    return {
+        'id': row_id, 'market_id': 'm1', 'ean': ean, 'product_name': f'PRODUTO {row_id}', 'ncm': '22021000',
+        'nfce_url': 'https://example.test/nfce', 'purchase_date': '2026-10-01T12:00:00+00:00',
+        'unit_price': 9.9, 'enriched': False, 'enrichment_status': None, 'enrichment_error': None,
+    }
+
+
+class Purchases:
+    """purchases + the upsert_unique_products RPC; `rpc` decides per call whether it fails."""
+
+    def __init__(self, rows, rpc):
+        self.rows = {r['id']: r for r in rows}
+        self.rpc = rpc
+        self.rpc_calls = []
+        self.backlog = []
+
+    def __call__(self, request):
+        if request.table == 'rpc/upsert_unique_products':
+            self.rpc_calls.append(request.body['p_rows'])
+            return self.rpc(request.body['p_rows'])
+        if request.table == 'product_backlog':
+            self.backlog.extend(request.body)
+            return []
+        if request.table == 'purchases' and request.method == 'PATCH':
+            ids = request.params['id'][len('in.('):-1].split(',')
+            for row_id in ids:
+                self.rows[int(row_id)].update(request.body)
+            return []
+        if request.table == 'purchases':
+            return [r for r in self.rows.values() if not r['enriched']]
+        return []
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    monkeypatch.setattr(enrichment_worker.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(enrichment_worker, 'SLEEP_BETWEEN_BATCHES', 0)
+    monkeypatch.setattr(discovered_index, 'refresh', lambda: 0)
+    monkeypatch.setattr(enrichment_worker, '_pending_siblings', lambda table, items, key_fn: [])
+    monkeypatch.setattr(enrichment_worker, '_prefetch_local_matches', lambda items: None)
+    monkeypatch.setattr(enrichment_worker, '_resolve_purchase', lambda item, local=None: {
+        'status': 'resolved', 'ean': item['ean'], 'registry_ncm': None,
+        'canonical_name': item['product_name'], 'cosmos_result': None,
+    })
+    monkeypatch.setattr(enrichment_worker, '_upsert_rpc_available', True)
+
+
+def test_transient_batch_write_error_does_not_fail_the_batch(rest, worker):
+    calls = []
+
+    def rpc(rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            return error_response('57014', 'canceling statement due to statement timeout')
+        return len(rows)
+    table = Purchases([purchase(1, GOOD_EAN), purchase(2, BAD_EAN)], rpc)
+    rest.handler = table
+
+    enrichment_worker._process_purchases_queue()
+
+    assert [r['enrichment_status'] for r in table.rows.values()] == ['completed', 'completed']
+    assert table.backlog == []
+    assert [len(rows) for rows in table.rpc_calls] == [2, 1, 1]  # batch, then one per product
+
+
+def test_write_failure_fails_only_the_failing_product(rest, worker):
+    def rpc(rows):
+        if any(row['ean'] == BAD_EAN for row in rows):
+            return error_response('23502', 'null value in column "product_name" violates not-null constraint')
+        return len(rows)
+    table = Purchases([purchase(1, GOOD_EAN), purchase(2, BAD_EAN)], rpc)
+    rest.handler = table
+
+    enrichment_worker._process_purchases_queue()
+
+    assert table.rows[1]['enrichment_status'] == 'completed'
+    assert table.rows[2]['enrichment_status'] == 'failed'
+    assert [row['purchase_id'] for row in table.backlog] == [2]
@@ -0,0 +1,47 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import gtin_cache
+from conftest import error_response
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(gtin_cache, '_memory', OrderedDict())
+    monkeypatch.setattr(gtin_cache, '_stats', {
+        'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0, 'db_errors': 0})
+    monkeypatch.setattr(gtin_cache, '_db_warned', True)
+
+
+def test_db_hit_is_kept_in_memory(rest):
+    expires_at = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+    rest.handler = lambda request: [{'found': True, 'product_name': 'LEITE', 'brand': None,
+                                     'image_url': None, 'ncm': '04012010', 'expires_at': expires_at}]
+
+    assert gtin_cache.get('789')['product_name'] == 'LEITE'
+    assert gtin_cache.get('789')['product_name'] == 'LEITE'
+    assert len(rest.to('gtin_cache', 'GET')) == 1
+    assert gtin_cache.stats()['db_hits'] == 1 and gtin_cache.stats()['memory_hits'] == 1
+
+
+def test_not_found_answers_are_cached_with_the_shorter_ttl(rest):
+    gtin_cache.put('000', found=False)
+
+    upsert = rest.to('gtin_cache', 'POST')[0]
+    assert upsert.params['on_conflict'] == 'gtin'
+    expires_at = datetime.fromisoformat(upsert.body['expires_at'])
+    fetched_at = datetime.fromisoformat(upsert.body['fetched_at'])
+    assert (expires_at - fetched_at).total_seconds() == gtin_cache.NOT_FOUND_TTL_SECONDS
+    assert gtin_cache.get('000') == {'found': False, 'product_name': None, 'brand': None,
+                                     'image_url': None, 'ncm': None}
+
+
+def test_memory_layer_works_without_the_table(rest):
+    rest.handler = lambda request: error_response('42P01', 'relation "gtin_cache" does not exist')
+
+    assert gtin_cache.get('789') is None
+    gtin_cache.put('789', found=True, product_name='LEITE')
+    assert gtin_cache.get('789')['product_name'] == 'LEITE'
+    assert gtin_cache.stats()['db_errors'] == 2
@@ -0,0 +1,44 @@
+import pytest
+
+import lookup_log_writer
+from conftest import error_response
+
+
+@pytest.fixture(autouse=True)
+def fresh_writer(monkeypatch):
+    lookup_log_writer.reset_after_fork()
+    # Flushed by hand in these tests; no background thread
+    monkeypatch.setattr(lookup_log_writer, '_flusher_started', True)
+    monkeypatch.setattr(lookup_log_writer, '_stats', {
+        'queued': 0, 'written': 0, 'dropped': 0, 'blocked': 0, 'failed_inserts': 0})
+    yield
+    lookup_log_writer.reset_after_fork()
+
+
+def test_flush_groups_rows_by_columns(rest):
+    lookup_log_writer.enqueue({'original_name': 'A', 'success': True})
+    lookup_log_writer.enqueue({'original_name': 'B', 'success': False})
+    lookup_log_writer.enqueue({'original_name': 'C', 'success': True, 'gtin': '789'})
+
+    assert lookup_log_writer.flush() == 0
+    inserts = rest.to('product_lookup_log', 'POST')
+    assert sorted(len(r.body) for r in inserts) == [1, 2]
+    assert lookup_log_writer.stats()['written'] == 3
+
+
+def test_full_buffer_drops_new_rows(monkeypatch):
+    monkeypatch.setattr(lookup_log_writer, 'BUFFER_SIZE', 1)
+    assert lookup_log_writer.enqueue({'original_name': 'A'})
+    assert not lookup_log_writer.enqueue({'original_name': 'B'})
+    assert lookup_log_writer.stats()['dropped'] == 1
+
+
+def test_failed_insert_is_retried_until_out_of_attempts(rest, monkeypatch):
+    monkeypatch.setattr(lookup_log_writer, 'MAX_ATTEMPTS', 2)
+    rest.handler = lambda request: error_response('57014', 'canceling statement due to statement timeout')
+    lookup_log_writer.enqueue({'original_name': 'A'})
+
+    assert lookup_log_writer.flush() == 1  # back in the buffer for the next try
+    assert lookup_log_writer.flush() == 0
+    assert lookup_log_writer.stats()['dropped'] == 1
+    assert len(rest.to('product_lookup_log', 'POST')) == 2
@@ -0,0 +1,61 @@
+import pytest
+
+import nfce_breaker
+
+HOST = 'sefaz.test'
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(nfce_breaker, '_breakers', {})
+    monkeypatch.setattr(nfce_breaker, 'FAILURE_THRESHOLD', 2)
+
+
+def trip():
+    for _ in range(nfce_breaker.FAILURE_THRESHOLD):
+        nfce_breaker.record_failure(HOST)
+
+
+def test_consecutive_failures_open_the_breaker():
+    nfce_breaker.record_failure(HOST)
+    nfce_breaker.record_success(HOST)
+    nfce_breaker.record_failure(HOST)
+    assert nfce_breaker.allow(HOST) == (True, 0)
+
+    nfce_breaker.record_failure(HOST)
+    allowed, retry_after = nfce_breaker.allow(HOST)
+    assert not allowed and retry_after > 0
+    assert nfce_breaker.allow('other.test') == (True, 0)
+
+
+def test_half_open_lets_one_probe_through(monkeypatch):
+    monkeypatch.setattr(nfce_breaker, 'OPEN_SECONDS', 0)
+    trip()
+
+    assert nfce_breaker.allow(HOST, owner=1)[0]
+    assert not nfce_breaker.allow(HOST, owner=2)[0]
+
+    nfce_breaker.record_success(HOST)
+    assert nfce_breaker.stats()[HOST]['state'] == nfce_breaker.CLOSED
+
+
+def test_failed_probe_reopens_the_breaker(monkeypatch):
+    monkeypatch.setattr(nfce_breaker, 'OPEN_SECONDS', 0)
+    trip()
+    assert nfce_breaker.allow(HOST, owner=1)[0]
+
+    nfce_breaker.record_failure(HOST)
+    assert nfce_breaker.stats()[HOST]['state'] == nfce_breaker.OPEN
+    assert nfce_breaker.stats()[HOST]['trips'] == 2
+
+
+def test_release_probe_frees_the_slot_only_for_its_owner(monkeypatch):
+    monkeypatch.setattr(nfce_breaker, 'OPEN_SECONDS', 0)
+    trip()
+    assert nfce_breaker.allow(HOST, owner=1)[0]
+
+    nfce_breaker.release_probe(HOST, owner=2)
+    assert not nfce_breaker.allow(HOST, owner=2)[0]
+
+    nfce_breaker.release_probe(HOST, owner=1)
+    assert nfce_breaker.allow(HOST, owner=2)[0]
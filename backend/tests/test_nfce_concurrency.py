@@ -0,0 +1,35 @@
+import pytest
+
+import nfce_concurrency
+from nfce_retry import ERROR_TIMEOUT, ERROR_EMPTY_EXTRACTION
+
+
+@pytest.fixture(autouse=True)
+def fresh_controller(monkeypatch):
+    nfce_concurrency.reset_after_fork()
+    monkeypatch.setattr(nfce_concurrency, 'MAX_LIMIT', 3)
+    monkeypatch.setattr(nfce_concurrency, 'memory_mb', lambda: 100.0)
+    yield
+    nfce_concurrency.reset_after_fork()
+
+
+def healthy_loads(n):
+    for _ in range(n):
+        nfce_concurrency.record(2.0)
+
+
+def test_healthy_streaks_raise_the_limit_up_to_the_ceiling():
+    healthy_loads(nfce_concurrency.WINDOW)
+    assert nfce_concurrency.limit() == 2
+    healthy_loads(nfce_concurrency.WINDOW * 5)
+    assert nfce_concurrency.limit() == 3
+
+
+def test_timeout_halves_the_limit_and_other_errors_only_reset_the_streak():
+    healthy_loads(nfce_concurrency.WINDOW * 2)
+    assert nfce_concurrency.limit() == 3
+
+    nfce_concurrency.record(60.0, ERROR_EMPTY_EXTRACTION)
+    assert nfce_concurrency.limit() == 3
+    nfce_concurrency.record(60.0, ERROR_TIMEOUT)
+    assert nfce_concurrency.limit() == 1
@@ -0,0 +1,28 @@
+import time
+
+import pytest
+
+import nfce_hosts
+
+
+@pytest.fixture(autouse=True)
+def fresh_hosts(monkeypatch):
+    monkeypatch.setattr(nfce_hosts, '_loads', {})
+    monkeypatch.setattr(nfce_hosts, 'HOST_LIMITS', {'slow.test': (1, 60.0), 'fast.test': (2, 0.0)})
+
+
+def test_a_host_in_its_min_interval_is_not_ready_but_others_are():
+    assert nfce_hosts.try_start_load('slow.test', time.monotonic())
+    nfce_hosts.end_load('slow.test')
+
+    assert not nfce_hosts.try_start_load('slow.test', time.monotonic())
+    assert nfce_hosts.try_start_load('fast.test', time.monotonic())
+
+
+def test_max_concurrency_counts_loads_in_flight():
+    assert nfce_hosts.try_start_load('fast.test', time.monotonic())
+    assert nfce_hosts.try_start_load('fast.test', time.monotonic())
+    assert not nfce_hosts.try_start_load('fast.test', time.monotonic())
+
+    nfce_hosts.end_load('fast.test')
+    assert nfce_hosts.try_start_load('fast.test', time.monotonic())
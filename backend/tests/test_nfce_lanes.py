@@ -0,0 +1,34 @@
+import queue
+
+import pytest
+
+import nfce_lanes
+from constants import LANE_INTERACTIVE, LANE_BATCH
+
+
+def test_selector_reserves_a_share_for_batch_under_contention(monkeypatch):
+    monkeypatch.setattr(nfce_lanes, '_BATCH_EVERY', 5)
+    selector = nfce_lanes.LaneSelector()
+
+    picks = [selector.choose(True, True) for _ in range(10)]
+    assert picks.count(LANE_BATCH) == 2
+    assert picks[4] == LANE_BATCH and picks[9] == LANE_BATCH
+
+
+def test_selector_serves_whichever_lane_has_work():
+    selector = nfce_lanes.LaneSelector()
+    assert selector.choose(False, True) == LANE_BATCH
+    assert selector.choose(True, False) == LANE_INTERACTIVE
+    assert selector.choose(False, False) is None
+
+
+def test_queue_serves_interactive_first_and_normalizes_unknown_lanes():
+    lanes = nfce_lanes.LaneQueue()
+    lanes.put(('backfill', LANE_BATCH))
+    lanes.put(('scan', None))
+
+    assert lanes.qsize(LANE_INTERACTIVE) == 1
+    assert lanes.get() == ('scan', None)
+    assert lanes.get() == ('backfill', LANE_BATCH)
+    with pytest.raises(queue.Empty):
+        lanes.get(timeout=0.01)
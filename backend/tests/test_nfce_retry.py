@@ -0,0 +1,39 @@
+import nfce_retry
+from constants import STATUS_QUEUED, STATUS_ERROR, STATUS_DEAD
+
+
+def test_errors_are_classified_by_message():
+    assert nfce_retry.classify_error(TimeoutError('Page load timed out')) == nfce_retry.ERROR_TIMEOUT
+    assert nfce_retry.classify_error('net::ERR_CONNECTION_RESET') == nfce_retry.ERROR_NETWORK
+    assert nfce_retry.classify_error('SEFAZ server error 503') == nfce_retry.ERROR_SERVER
+    assert nfce_retry.classify_error('Invalid access key') == nfce_retry.ERROR_INVALID_NFCE
+    assert nfce_retry.classify_error('something odd') == nfce_retry.ERROR_UNKNOWN
+
+
+def test_backoff_doubles_and_is_capped():
+    assert 30 <= nfce_retry.backoff_seconds(1) <= 36
+    assert 60 <= nfce_retry.backoff_seconds(2) <= 72
+    assert nfce_retry.backoff_seconds(50) <= nfce_retry.RETRY_MAX_SECONDS * 1.2
+
+
+def test_failure_update_requeues_then_dead_letters(monkeypatch):
+    monkeypatch.setattr(nfce_retry, 'MAX_ATTEMPTS', 3)
+
+    update = nfce_retry.failure_update(2, nfce_retry.ERROR_TIMEOUT, 'timed out')
+    assert update['status'] == STATUS_QUEUED
+    assert update['attempts'] == 2 and update['next_attempt_at']
+
+    update = nfce_retry.failure_update(3, nfce_retry.ERROR_TIMEOUT, 'timed out')
+    assert update['status'] == STATUS_DEAD
+    assert update['next_attempt_at'] is None
+
+
+def test_permanent_errors_are_not_retried():
+    update = nfce_retry.failure_update(1, nfce_retry.ERROR_INVALID_NFCE, 'Invalid access key')
+    assert update['status'] == STATUS_ERROR
+
+
+def test_park_update_does_not_count_an_attempt():
+    update = nfce_retry.park_update(60, nfce_retry.ERROR_CIRCUIT_OPEN, 'breaker open')
+    assert update['status'] == STATUS_QUEUED
+    assert 'attempts' not in update
@@ -0,0 +1,98 @@
+import pytest
+
+import nfce_spool
+import task_queue
+from conftest import error_response
+
+URL_NEW = 'https://www.sefaz.rs.gov.br/NFCE/NFCE-COM.aspx?p=43240100000000000001650010000000011000000001|2|1'
+URL_FAILED = 'https://www.sefaz.rs.gov.br/NFCE/NFCE-COM.aspx?p=43240100000000000001650010000000021000000002|2|1'
+
+
+@pytest.fixture
+def spool(tmp_path, monkeypatch):
+    monkeypatch.setattr(nfce_spool, 'SPOOL_PATH', str(tmp_path / 'spool.db'))
+    monkeypatch.setattr(nfce_spool, '_local', nfce_spool.threading.local())
+    monkeypatch.setattr(nfce_spool, '_flusher_started', True)  # flush by hand
+    enqueued = []
+    monkeypatch.setattr(task_queue, 'enqueue_nfce', lambda url, record_id, *a: enqueued.append((url, record_id)))
+    return enqueued
+
+
+class ProcessedUrls:
+    """processed_urls with one failed row holding URL_FAILED; insert_conflicts
+    are URLs the bulk upsert hits the nfce_url constraint on."""
+
+    def __init__(self, taken=(URL_FAILED,), insert_conflicts=()):
+        self.taken = set(taken)
+        self.insert_conflicts = set(insert_conflicts)
+        self.rows = []
+
+    def __call__(self, request):
+        if request.method == 'POST':
+            rows = request.body if isinstance(request.body, list) else [request.body]
+            if any(r['nfce_url'] in self.insert_conflicts for r in rows):
+                return error_response('23505', 'duplicate key value violates unique constraint "processed_urls_nfce_url_key"')
+            for row in rows:
+                self.rows.append({**row, 'id': 1000 + len(self.rows)})
+            return []
+        if 'nfce_url' in request.params:
+            return [{'id': 7, 'nfce_url': url} for url in self.taken
+                    if '"{}"'.format(url) in request.params['nfce_url']]
+        if 'submission_id' in request.params:
+            return [{'id': r['id'], 'submission_id': r['submission_id']} for r in self.rows]
+        return []
+
+
+def test_flush_rejects_url_held_by_failed_row(rest, spool):
+    rest.handler = ProcessedUrls()
+    new_id, _ = nfce_spool.append(URL_NEW, 'user-1', 'key-new')
+    failed_id, _ = nfce_spool.append(URL_FAILED, 'user-1', 'key-failed')
+
+    assert nfce_spool.flush_once() == 2
+
+    assert nfce_spool.lookup(failed_id)['state'] == nfce_spool.STATE_REJECTED
+    assert nfce_spool.lookup(failed_id)['detail'] == nfce_spool.URL_TAKEN_DETAIL
+    assert nfce_spool.lookup(new_id)['state'] == nfce_spool.STATE_FLUSHED
+    assert spool == [(URL_NEW, nfce_spool.lookup(new_id)['record_id'])]
+    # Rejected before the insert: only the new URL was sent
+    assert [r.body for r in rest.to('processed_urls', 'POST')][0][0]['nfce_url'] == URL_NEW
+
+
+def test_flush_taken_query_quotes_urls_once(rest, spool):
+    rest.handler = ProcessedUrls(taken=())
+    nfce_spool.append(URL_NEW, 'user-1', 'key-new')
+
+    nfce_spool.flush_once()
+
+    taken_query = next(r for r in rest.to('processed_urls', 'GET') if 'nfce_url' in r.params)
+    assert taken_query.params['nfce_url'] == 'in.("{}")'.format(URL_NEW)
+    active_query = next(r for r in rest.to('processed_urls', 'GET') if 'or' in r.params)
+    assert 'nfce_url.in.("{}")'.format(URL_NEW) in active_query.params['or']
+
+
+def test_insert_conflict_rejects_only_the_conflicting_row(rest, spool):
+    rest.handler = ProcessedUrls(taken=(), insert_conflicts=(URL_FAILED,))
+    new_id, _ = nfce_spool.append(URL_NEW, 'user-1', 'key-new')
+    failed_id, _ = nfce_spool.append(URL_FAILED, 'user-1', 'key-failed')
+
+    assert nfce_spool.flush_once() == 2
+
+    assert nfce_spool.lookup(new_id)['state'] == nfce_spool.STATE_FLUSHED
+    assert nfce_spool.lookup(failed_id)['state'] == nfce_spool.STATE_REJECTED
+    assert len(rest.to('processed_urls', 'POST')) == 3  # bulk attempt, then one per row
+    assert [url for url, _ in spool] == [URL_NEW]
+
+
+def test_other_insert_errors_put_the_batch_back(rest, spool):
+    def handler(request):
+        if request.method == 'POST':
+            return error_response('57014', 'canceling statement due to statement timeout')
+        return []
+    rest.handler = handler
+    new_id, _ = nfce_spool.append(URL_NEW, 'user-1', 'key-new')
+
+    with pytest.raises(Exception):
+        nfce_spool.flush_once()
+
+    assert nfce_spool.lookup(new_id)['state'] == nfce_spool.STATE_PENDING
+    assert spool == []
@@ -0,0 +1,31 @@
+import bench_matcher
+import product_matcher
+
+
+def test_token_matcher_separates_the_labeled_pairs():
+    result = bench_matcher.evaluate('token', bench_matcher.load_pairs())
+    assert result['errors'] == []
+
+
+def test_normalize_expands_abbreviations_and_sizes():
+    assert product_matcher.normalize('Refrig. Coca-Cola 2 L') == product_matcher.normalize('REFRIG COCA COLA 2000ML')
+    assert product_matcher.normalize('Açúcar  Cristal 1kg') == product_matcher.normalize('ACUCAR CRISTAL 1000G')
+
+
+def test_ratio_matches_the_indel_similarity():
+    assert product_matcher.ratio('ABC', 'ABC') == 1.0
+    assert product_matcher.ratio('', '') == 1.0
+    assert product_matcher._lcs_length('LEITE INTEGRAL', 'LEITE INT') == 9
+
+
+def test_same_tokens_allows_truncations_only():
+    assert product_matcher.same_tokens('LEITE UHT INT 1L', 'LEITE UHT INTEGRAL 1L')
+    assert not product_matcher.same_tokens('REFRIG COCA COLA 2L', 'REFRIG COCA COLA ZERO 2L')
+
+
+def test_best_match_picks_the_highest_score():
+    candidates = [{'name': 'LEITE UHT DESNATADO PARMALAT 1L'}, {'name': 'LEITE UHT INTEGRAL PARMALAT 1L'}]
+    best, score = product_matcher.best_match('LEITE UHT INT PARMALAT 1L', candidates, key=lambda c: c['name'])
+    assert best['name'] == 'LEITE UHT INTEGRAL PARMALAT 1L'
+    assert score >= product_matcher.threshold()
+    assert product_matcher.best_match('X', []) == (None, -1)
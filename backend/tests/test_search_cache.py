@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+import search_cache
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(search_cache, '_entries', OrderedDict())
+    monkeypatch.setattr(search_cache, '_loading', {})
+    monkeypatch.setattr(search_cache, '_stats', {
+        'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'expired': 0})
+
+
+def test_keys_ignore_case_accents_and_punctuation():
+    assert search_cache.key_for('Pão  francês, kg') == search_cache.key_for('PAO FRANCES KG')
+    assert search_cache.key_for('PAO', '1905') != search_cache.key_for('PAO')
+
+
+def test_only_cacheable_results_are_stored():
+    key = search_cache.key_for('BANANA NANICA KG')
+    assert search_cache.get_or_load(key, lambda: 'rate limited', lambda v: False) == ('rate limited', False)
+    assert search_cache.get_or_load(key, lambda: 'match', lambda v: True) == ('match', False)
+    assert search_cache.get_or_load(key, lambda: 'other', lambda v: True) == ('match', True)
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    monkeypatch.setattr(search_cache, 'MAX_ENTRIES', 2)
+    for name in ('A', 'B'):
+        search_cache.get_or_load(search_cache.key_for(name), lambda: name, lambda v: True)
+    search_cache.get_or_load(search_cache.key_for('A'), lambda: None, lambda v: True)
+    search_cache.get_or_load(search_cache.key_for('C'), lambda: 'C', lambda v: True)
+
+    assert search_cache.get_or_load(search_cache.key_for('A'), lambda: 'reloaded', lambda v: True) == ('A', True)
+    assert search_cache.get_or_load(search_cache.key_for('B'), lambda: 'reloaded', lambda v: True) == ('reloaded', False)
+
+
+def test_concurrent_misses_share_one_search():
+    key = search_cache.key_for('REFRIG COCA COLA 2L')
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_search():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'match'
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(search_cache.get_or_load(key, slow_search, bool)))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: results.append(search_cache.get_or_load(key, slow_search, bool)))
+    second.start()
+    deadline = time.monotonic() + 5
+    while search_cache.stats()['coalesced'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    first.join(5)
+    second.join(5)
+
+    assert len(calls) == 1
+    assert sorted(results) == [('match', False), ('match', True)]
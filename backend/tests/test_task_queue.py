@@ -0,0 +1,69 @@
+import pytest
+
+import nfce_pipeline
+import task_queue
+
+
+@pytest.fixture
+def queue_state(monkeypatch):
+    monkeypatch.setattr(task_queue, '_shutdown_event', task_queue.threading.Event())
+    monkeypatch.setattr(task_queue, '_pending_ids', set())
+
+
+def test_shutdown_hands_off_waiting_jobs_but_not_running_ones(rest, queue_state, monkeypatch):
+    monkeypatch.setattr(nfce_pipeline, 'wait_idle', lambda timeout: False)
+    monkeypatch.setattr(nfce_pipeline, 'in_flight_ids', lambda: [1])
+    task_queue._pending_ids.update({1, 2})
+
+    task_queue.shutdown(timeout=0)
+
+    writes = rest.to('processed_urls', 'PATCH')
+    assert len(writes) == 1
+    assert writes[0].params['id'] == 'in.(2)'
+    assert writes[0].params['status'] == 'eq.queued'
+    assert set(writes[0].body) == {'next_attempt_at'}
+    assert task_queue.is_shutting_down()
+
+
+def _ago(seconds):
+    from datetime import datetime, timedelta, timezone
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds)).isoformat()
+
+
+def _ahead(seconds):
+    return _ago(-seconds)
+
+
+def test_sweep_reclaims_expired_processing_and_extracting_rows(rest):
+    from conftest import Tables
+
+    tables = Tables(processed_urls=[
+        {'id': 1, 'status': 'processing', 'attempts': 0, 'processed_at': _ago(120), 'lease_expires_at': _ago(60)},
+        {'id': 2, 'status': 'extracting', 'attempts': 1, 'processed_at': _ago(120), 'lease_expires_at': None},
+        {'id': 3, 'status': 'extracting', 'attempts': 0, 'processed_at': _ago(120), 'lease_expires_at': _ahead(10)},
+        {'id': 4, 'status': 'success', 'attempts': 0, 'processed_at': _ago(120), 'lease_expires_at': None},
+    ])
+    rest.handler = tables
+
+    assert task_queue.sweep_orphans() == 2
+
+    rows = {row['id']: row for row in tables.rows('processed_urls')}
+    assert (rows[1]['status'], rows[1]['attempts']) == ('queued', 1)
+    assert (rows[2]['status'], rows[2]['attempts']) == ('queued', 2)
+    assert rows[3]['status'] == 'extracting'  # lease still being renewed
+    assert rows[4]['status'] == 'success'
+
+
+def test_sweep_dead_letters_an_orphan_out_of_attempts(rest, monkeypatch):
+    import nfce_retry
+    from conftest import Tables
+
+    monkeypatch.setattr(nfce_retry, 'MAX_ATTEMPTS', 3)
+    tables = Tables(processed_urls=[
+        {'id': 1, 'status': 'extracting', 'attempts': 2, 'processed_at': _ago(120), 'lease_expires_at': _ago(60)},
+    ])
+    rest.handler = tables
+
+    task_queue.sweep_orphans()
+
+    assert tables.rows('processed_urls')[0]['status'] == 'dead'